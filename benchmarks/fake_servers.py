@@ -0,0 +1,310 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import typing as t
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+
+BOT_DID = "did:plc:benchbot"
+BOT_HANDLE = "bot.bench.test"
+
+# ログインは計測の対象外なので、遅延もエラーも入れない
+SESSION_METHODS = {"com.atproto.server.createSession", "com.atproto.server.refreshSession", "app.bsky.actor.getProfile"}
+
+
+def iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def fake_cid(uri: str) -> str:
+    return "bafyrei" + hashlib.sha256(uri.encode()).hexdigest()[:52]
+
+
+def token(scope: str, expires_in: int = 24 * 60 * 60) -> str:
+    now = int(time.time())
+    return jwt.encode({"exp": now + expires_in, "iat": now, "scope": scope, "sub": BOT_DID}, "secret", algorithm="HS256")
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status: int, body: t.Optional[dict], headers: t.Optional[t.Dict[str, str]] = None):
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        if body is not None:
+            # atprotoはこのContent-Typeのときだけ応答をJSONとして読む
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer:
+    def __init__(self, handler: t.Type[BaseHTTPRequestHandler]):
+        handler.server_state = self
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self) -> "FakeServer":
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+class FakePDS(FakeServer):
+    # 再生するトラフィックの投稿が、開始からのat秒後に通知として見えるようになるXRPCサーバー
+    # イベント: {"at", "uri", "did", "handle", "text", "reason"(Noneなら通知しない), "root", "parent"}
+    def __init__(self, events: t.List[t.Dict[str, t.Any]], latency: float = 0.0, error_rate: float = 0.0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts: t.Counter[str] = Counter()
+        self.errors: t.Counter[str] = Counter()
+        self.started_at = time.time()
+        self.posts: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self.children: t.Dict[str, t.List[str]] = {}
+        self.notifications: t.List[t.Dict[str, t.Any]] = []
+        # 返信先の通知のURI -> (見えるようになった時刻, 返信が作成された時刻)
+        self.visible_at: t.Dict[str, float] = {}
+        self.replied_at: t.Dict[str, float] = {}
+        self.seen_at: t.Optional[str] = None
+        self.events = sorted(events, key=lambda e: e["at"])
+        super().__init__(PDSHandler)
+
+    def start(self) -> "FakePDS":
+        self.started_at = time.time()
+        for event in self.events:
+            self.add_post(event["uri"], event["did"], event["handle"], event["text"], self.started_at + event["at"], event.get("root"), event.get("parent"))
+            if event.get("reason") is not None:
+                self.notifications.append({"uri": event["uri"], "reason": event["reason"]})
+                self.visible_at[event["uri"]] = self.started_at + event["at"]
+        return super().start()
+
+    def add_post(self, uri: str, did: str, handle: str, text: str, indexed_at: float, root: t.Optional[str] = None, parent: t.Optional[str] = None):
+        record = {"$type": "app.bsky.feed.post", "text": text, "createdAt": iso(indexed_at)}
+        if parent is not None:
+            record["reply"] = {"root": {"uri": root or parent, "cid": fake_cid(root or parent)}, "parent": {"uri": parent, "cid": fake_cid(parent)}}
+            self.children.setdefault(parent, []).append(uri)
+        self.posts[uri] = {"uri": uri, "cid": fake_cid(uri), "author": {"did": did, "handle": handle}, "record": record, "indexedAt": iso(indexed_at), "_indexed_at": indexed_at}
+
+    def post_view(self, uri: str) -> t.Dict[str, t.Any]:
+        post = self.posts[uri]
+        return {k: v for k, v in post.items() if not k.startswith("_")}
+
+    def thread_view(self, uri: str, depth: int, parent_height: int) -> t.Dict[str, t.Any]:
+        view = {"$type": "app.bsky.feed.defs#threadViewPost", "post": self.post_view(uri), "replies": self.replies_view(uri, depth)}
+        node = view
+        parent = self.posts[uri]["record"].get("reply", {}).get("parent", {}).get("uri")
+        for _ in range(parent_height):
+            if parent is None or parent not in self.posts:
+                break
+            node["parent"] = {"$type": "app.bsky.feed.defs#threadViewPost", "post": self.post_view(parent)}
+            node = node["parent"]
+            parent = self.posts[parent]["record"].get("reply", {}).get("parent", {}).get("uri")
+        return view
+
+    def replies_view(self, uri: str, depth: int) -> t.List[t.Dict[str, t.Any]]:
+        if depth <= 0:
+            return []
+        now = time.time()
+        return [
+            {"$type": "app.bsky.feed.defs#threadViewPost", "post": self.post_view(child), "replies": self.replies_view(child, depth - 1)}
+            for child in self.children.get(uri, [])
+            if self.posts[child]["_indexed_at"] <= now
+        ]
+
+    def list_notifications(self, limit: int, cursor: t.Optional[str]) -> t.Dict[str, t.Any]:
+        now = time.time()
+        visible = sorted((n for n in self.notifications if self.visible_at[n["uri"]] <= now), key=lambda n: self.visible_at[n["uri"]], reverse=True)
+        start = int(cursor or 0)
+        page = visible[start : start + limit]
+        notifications = []
+        for n in page:
+            post = self.posts[n["uri"]]
+            notifications.append(
+                {
+                    "uri": post["uri"],
+                    "cid": post["cid"],
+                    "author": post["author"],
+                    "reason": n["reason"],
+                    "record": post["record"],
+                    "isRead": False,
+                    "indexedAt": post["indexedAt"],
+                }
+            )
+        next_cursor = str(start + limit) if start + limit < len(visible) else None
+        return {"notifications": notifications, "cursor": next_cursor}
+
+    def create_record(self, data: t.Dict[str, t.Any]) -> t.Tuple[int, t.Dict[str, t.Any]]:
+        rkey = data.get("rkey") or f"{len(self.posts):013d}"
+        uri = f"at://{data['repo']}/{data['collection']}/{rkey}"
+        if uri in self.posts:
+            return 400, {"error": "InvalidRequest", "message": "Record already exists"}
+        record = data["record"]
+        reply = record.get("reply") or {}
+        parent = reply.get("parent", {}).get("uri")
+        now = time.time()
+        self.add_post(uri, BOT_DID, BOT_HANDLE, record.get("text", ""), now, reply.get("root", {}).get("uri"), parent)
+        if parent in self.visible_at and parent not in self.replied_at:
+            self.replied_at[parent] = now
+        return 200, {"uri": uri, "cid": fake_cid(uri)}
+
+    def get_record(self, params: t.Dict[str, str]) -> t.Tuple[int, t.Dict[str, t.Any]]:
+        uri = f"at://{params['repo']}/{params['collection']}/{params['rkey']}"
+        if uri not in self.posts:
+            return 400, {"error": "RecordNotFound", "message": f"Could not locate record: {uri}"}
+        return 200, {"uri": uri, "cid": fake_cid(uri), "value": self.posts[uri]["record"]}
+
+    def handle(self, method: str, nsid: str, params: t.Dict[str, str], body: t.Dict[str, t.Any]) -> t.Tuple[int, t.Optional[t.Dict[str, t.Any]]]:
+        if nsid == "com.atproto.server.createSession" or nsid == "com.atproto.server.refreshSession":
+            return 200, {"accessJwt": token("com.atproto.access"), "refreshJwt": token("com.atproto.refresh"), "did": BOT_DID, "handle": BOT_HANDLE}
+        if nsid == "app.bsky.actor.getProfile":
+            return 200, {"did": BOT_DID, "handle": BOT_HANDLE}
+        if nsid == "app.bsky.notification.listNotifications":
+            return 200, self.list_notifications(int(params.get("limit", 50)), params.get("cursor"))
+        if nsid == "app.bsky.notification.updateSeen":
+            self.seen_at = body.get("seenAt")
+            return 200, None
+        if nsid == "app.bsky.feed.getPostThread":
+            if params["uri"] not in self.posts:
+                return 400, {"error": "NotFound", "message": f"Post not found: {params['uri']}"}
+            return 200, {"thread": self.thread_view(params["uri"], int(params.get("depth", 6)), int(params.get("parentHeight", 80)))}
+        if nsid == "com.atproto.repo.createRecord":
+            return self.create_record(body)
+        if nsid == "com.atproto.repo.getRecord":
+            return self.get_record(params)
+        return 501, {"error": "MethodNotImplemented", "message": nsid}
+
+
+class PDSHandler(JSONHandler):
+    server_state: FakePDS
+
+    def dispatch(self, method: str):
+        pds = self.server_state
+        url = urlparse(self.path)
+        nsid = url.path[len("/xrpc/") :]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.read_json() if method == "POST" else {}
+        if nsid not in SESSION_METHODS:
+            with pds.lock:
+                pds.counts[nsid] += 1
+                failed = pds.random.random() < pds.error_rate
+            if pds.latency > 0:
+                time.sleep(pds.latency)
+            if failed:
+                with pds.lock:
+                    pds.errors[nsid] += 1
+                self.send_json(503, {"error": "InternalServerError", "message": "injected error"})
+                return
+        with pds.lock:
+            status, response = pds.handle(method, nsid, params, body)
+        self.send_json(status, response)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+
+class FakeOpenAI(FakeServer):
+    # /v1/chat/completions だけを持つOpenAI互換サーバー。stream=Trueならtoken_delayごとに1チャンクずつ返す
+    def __init__(self, latency: float = 0.0, token_delay: float = 0.0, error_rate: float = 0.0, reply: str = "Thanks for the mention! Have a nice day.", seed: int = 0):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.error_rate = error_rate
+        self.reply = reply
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.aborted = 0  # クライアントが途中で切ったストリーム
+        super().__init__(OpenAIHandler)
+
+    def chunks(self) -> t.List[str]:
+        words = self.reply.split(" ")
+        return [w if i == 0 else " " + w for i, w in enumerate(words)]
+
+
+class OpenAIHandler(JSONHandler):
+    server_state: FakeOpenAI
+
+    def do_POST(self):
+        llm = self.server_state
+        body = self.read_json()
+        with llm.lock:
+            llm.requests += 1
+            failed = llm.random.random() < llm.error_rate
+        if llm.latency > 0:
+            time.sleep(llm.latency)
+        if failed:
+            with llm.lock:
+                llm.errors += 1
+            self.send_json(500, {"error": {"message": "injected error", "type": "server_error", "param": None, "code": None}})
+            return
+        model = body.get("model", "gpt-4")
+        if not body.get("stream"):
+            time.sleep(llm.token_delay * len(llm.chunks()))
+            self.send_json(
+                200,
+                {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": llm.reply}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": len(llm.chunks()), "total_tokens": len(llm.chunks())},
+                },
+            )
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for chunk in llm.chunks() + [None]:
+                delta = {} if chunk is None else {"content": chunk}
+                event = {
+                    "id": "chatcmpl-bench",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if chunk is None else None}],
+                }
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode())
+                self.wfile.flush()
+                if chunk is not None and llm.token_delay > 0:
+                    time.sleep(llm.token_delay)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            with llm.lock:
+                llm.aborted += 1  # 途中で打ち切られた
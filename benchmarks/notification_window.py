@@ -0,0 +1,93 @@
+import argparse
+import json
+import time
+import typing as t
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from dateutil.parser import parse
+
+from bsky_aibot.app import filter_unread_notifications, filter_unread_pages
+from bsky_aibot.timestamps import timestamp
+
+# 大きな通知のページから未読の範囲を求める時間を、以前の方法(dateutil.parser.parseで1件ずつ)と比べる
+
+START = datetime(2023, 7, 2, 20, 0, tzinfo=timezone.utc)
+
+
+def indexed_at(i: int) -> str:
+    # 実際の応答と同じく、精度やタイムゾーンの表記が混ざったものにする
+    value = START - timedelta(seconds=i, microseconds=i * 137 % 1000000)
+    if i % 3 == 0:
+        return value.strftime("%Y-%m-%dT%H:%M:%S.") + f"{value.microsecond // 1000:03d}Z"
+    if i % 3 == 1:
+        return value.isoformat()
+    return value.astimezone(timezone(timedelta(hours=9))).isoformat()
+
+
+def notification_pages(pages: int, page_size: int) -> t.List[t.List[SimpleNamespace]]:
+    # 新しい順。i秒前にIndexされた通知
+    return [[SimpleNamespace(uri=f"at://did:plc:user/app.bsky.feed.post/{p * page_size + j}", reason="mention", indexedAt=indexed_at(p * page_size + j)) for j in range(page_size)] for p in range(pages)]
+
+
+def dateutil_scan(pages: t.List[t.List[SimpleNamespace]], seen_at: datetime) -> t.List[SimpleNamespace]:
+    cutoff = seen_at - timedelta(minutes=2)
+    result = []
+    for page in pages:
+        for n in page:
+            if parse(n.indexedAt) <= cutoff:
+                return result
+            result.append(n)
+    return result
+
+
+def measure(window: t.Callable[[], t.List[SimpleNamespace]], iterations: int, cold: bool) -> t.Dict[str, t.Any]:
+    # cold: 初めて見る通知だけのとき(キャッシュを毎回空にする)、warm: 前回のポーリングと同じ通知を見るとき
+    timestamp.cache_clear()
+    window()
+    elapsed = 0.0
+    for _ in range(iterations):
+        if cold:
+            timestamp.cache_clear()
+        started_at = time.perf_counter()
+        result = window()
+        elapsed += time.perf_counter() - started_at
+    return {"ms_per_poll": round(elapsed / iterations * 1000, 3), "unread": len(result)}
+
+
+def run(pages: int = 10, page_size: int = 100, unread: int = 750, iterations: int = 20) -> t.Dict[str, t.Any]:
+    data = notification_pages(pages, page_size)
+    # unread件目の通知が、既読の境目(seen_atの2分前)のすぐ後になるようにする
+    seen_at = START - timedelta(seconds=unread) + timedelta(minutes=2, microseconds=1)
+    results = {
+        "dateutil_scan": measure(lambda: dateutil_scan(data, seen_at), iterations, cold=True),
+        "strict_scan_cold": measure(lambda: list(filter_unread_notifications((n for page in data for n in page), seen_at)), iterations, cold=True),
+        "bisect_cold": measure(lambda: list(filter_unread_pages(data, seen_at)), iterations, cold=True),
+        "bisect_warm": measure(lambda: list(filter_unread_pages(data, seen_at)), iterations, cold=False),
+    }
+    assert len({r["unread"] for r in results.values()}) == 1, results
+    baseline = results["dateutil_scan"]["ms_per_poll"]
+    for r in results.values():
+        r["speedup"] = round(baseline / r["ms_per_poll"], 2) if r["ms_per_poll"] else None
+    return {"notifications": pages * page_size, "page_size": page_size, **results}
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare finding the unread window of large notification pages with dateutil and with the strict parser and bisect.")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--unread", type=int, default=750, help="number of notifications newer than the checkpoint")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = json.dumps(run(args.pages, args.page_size, args.unread, args.iterations), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
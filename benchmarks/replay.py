@@ -0,0 +1,167 @@
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import time
+import typing as t
+
+from benchmarks.fake_servers import FakeOpenAI, FakePDS
+
+# 再生するトラフィックは {"at", "uri", "did", "handle", "text", "reason", "root", "parent"} のJSON Lines
+
+
+def synthetic_traffic(threads: int = 20, posts_per_thread: int = 3, spread: float = 5.0, seed: int = 0) -> t.List[t.Dict[str, t.Any]]:
+    # スレッドごとに、ボットへのメンションから始まり、同じ人が続けて返信する
+    rng = random.Random(seed)
+    events = []
+    for i in range(threads):
+        did, handle = f"did:plc:user{i}", f"user{i}.bench.test"
+        at = rng.uniform(0, spread)
+        root = parent = None
+        for j in range(posts_per_thread):
+            uri = f"at://{did}/app.bsky.feed.post/{i:04d}{j:04d}"
+            reason = "mention" if j == 0 or rng.random() < 0.5 else "reply"
+            events.append({"at": round(at, 3), "uri": uri, "did": did, "handle": handle, "text": f"@bot.bench.test question {j} in thread {i}", "reason": reason, "root": root, "parent": parent})
+            root, parent = root or uri, uri
+            at += rng.uniform(0, spread / posts_per_thread)
+    return events
+
+
+def load_traffic(path: str) -> t.List[t.Dict[str, t.Any]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def percentile(values: t.List[float], p: float) -> t.Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    # nearest-rank
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def run(
+    events: t.List[t.Dict[str, t.Any]],
+    pds_latency: float = 0.0,
+    pds_error_rate: float = 0.0,
+    llm_latency: float = 0.0,
+    llm_token_delay: float = 0.0,
+    llm_error_rate: float = 0.0,
+    max_in_flight: int = 4,
+    poll_interval: float = 0.2,
+    timeout: float = 60.0,
+    seed: int = 0,
+) -> t.Dict[str, t.Any]:
+    # 設定を環境変数から読むので、app は呼び出し側が環境を整えてから読み込む
+    from atproto import Client
+
+    from bsky_aibot import app
+    from bsky_aibot.outbox import Outbox
+    from bsky_aibot.replied_index import RepliedIndex
+    from bsky_aibot.thread_cache import ThreadCache
+    from bsky_aibot.transport import Transport
+
+    expected = sum(1 for e in events if e.get("reason") is not None)
+    with FakePDS(events, pds_latency, pds_error_rate, seed) as pds, FakeOpenAI(llm_latency, llm_token_delay, llm_error_rate, seed=seed) as llm:
+        services = app.Services(replied_index=RepliedIndex(":memory:"), thread_cache=ThreadCache(), outbox=Outbox(":memory:"), transport=Transport(pool_size=max(10, max_in_flight * 2)))
+        client = Client(base_url=f"{pds.url}/xrpc")
+        services.transport.install(client)
+        client.login("bot.bench.test", "password")
+        openai = app.get_openai()
+        openai.api_base = f"{llm.url}/v1"
+        openai.api_key = "sk-bench"
+
+        seen_at = None
+        cycles = failed_cycles = 0
+        deadline = pds.started_at + timeout
+        while len(pds.replied_at) < expected and time.time() < deadline:
+            cycles += 1
+            try:
+                seen_at = app.read_notifications_and_reply(client, seen_at, max_in_flight, services)
+            except Exception as e:
+                failed_cycles += 1
+                logging.debug(f"cycle failed: {e!r}")
+            time.sleep(poll_interval)
+
+        latencies = [pds.replied_at[uri] - pds.visible_at[uri] for uri in pds.replied_at]
+        finished_at = max(pds.replied_at.values(), default=time.time())
+        replies = len(pds.replied_at)
+        rpcs = sum(pds.counts.values())
+        return {
+            "notifications": expected,
+            "replies": replies,
+            "duration_seconds": round(finished_at - pds.started_at, 3),
+            "replies_per_second": round(replies / max(finished_at - pds.started_at, 1e-9), 3),
+            "latency_seconds": {
+                "p50": percentile(latencies, 50),
+                "p99": percentile(latencies, 99),
+                "max": max(latencies, default=None),
+            },
+            "rpcs": dict(sorted(pds.counts.items())),
+            "rpcs_per_reply": round(rpcs / replies, 3) if replies else None,
+            "rpc_errors": sum(pds.errors.values()),
+            "llm_requests": llm.requests,
+            "llm_errors": llm.errors,
+            "connections": services.transport.stats(),
+            "llm_routing": services.llm.stats() if services.llm is not None else {},
+            "cycles": cycles,
+            "failed_cycles": failed_cycles,
+            "config": {
+                "pds_latency": pds_latency,
+                "pds_error_rate": pds_error_rate,
+                "llm_latency": llm_latency,
+                "llm_token_delay": llm_token_delay,
+                "llm_error_rate": llm_error_rate,
+                "max_in_flight": max_in_flight,
+                "poll_interval": poll_interval,
+            },
+        }
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay notifications against local fake PDS and OpenAI servers and report throughput and latency as JSON.")
+    parser.add_argument("--traffic", help="JSON Lines file of recorded events. Synthetic traffic is generated if omitted.")
+    parser.add_argument("--threads", type=int, default=20)
+    parser.add_argument("--posts-per-thread", type=int, default=3)
+    parser.add_argument("--spread", type=float, default=5.0, help="seconds over which synthetic traffic arrives")
+    parser.add_argument("--pds-latency", type=float, default=0.02)
+    parser.add_argument("--pds-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--llm-token-delay", type=float, default=0.01)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    events = load_traffic(args.traffic) if args.traffic else synthetic_traffic(args.threads, args.posts_per_thread, args.spread, args.seed)
+    result = run(
+        events,
+        pds_latency=args.pds_latency,
+        pds_error_rate=args.pds_error_rate,
+        llm_latency=args.llm_latency,
+        llm_token_delay=args.llm_token_delay,
+        llm_error_rate=args.llm_error_rate,
+        max_in_flight=args.max_in_flight,
+        poll_interval=args.poll_interval,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+    report = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    if result["replies"] < result["notifications"]:
+        logging.warning(f"Only {result['replies']} of {result['notifications']} notifications were answered before the timeout")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    main()
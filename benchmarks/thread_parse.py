@@ -0,0 +1,107 @@
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+import typing as t
+
+from atproto.xrpc_client import models
+from atproto.xrpc_client.models.utils import get_or_create
+
+from bsky_aibot.posts import decode_thread
+
+# getPostThreadの応答をSDKのモデルにする場合と、bsky_aibot.postsの軽い表現にする場合の、時間とメモリを比べる
+
+
+def post_json(i: int, authors: int) -> t.Dict[str, t.Any]:
+    # 実際の応答と同じく、使わない項目(アバター、ラベル、viewerなど)も含める
+    did = f"did:plc:user{i % authors}"
+    return {
+        "uri": f"at://{did}/app.bsky.feed.post/{i:013d}",
+        "cid": f"bafyreib{i:052d}",
+        "author": {
+            "did": did,
+            "handle": f"user{i % authors}.bsky.social",
+            "displayName": f"User {i % authors}",
+            "avatar": f"https://cdn.bsky.app/img/avatar/plain/{did}/bafkrei{i:050d}@jpeg",
+            "viewer": {"muted": False, "blockedBy": False},
+            "labels": [],
+        },
+        "record": {
+            "$type": "app.bsky.feed.post",
+            "text": f"Post number {i} in a long conversation about cheese and crackers.",
+            "createdAt": "2023-07-02T20:00:00.000Z",
+            "langs": ["en"],
+        },
+        "replyCount": 1,
+        "repostCount": 0,
+        "likeCount": 3,
+        "indexedAt": "2023-07-02T20:00:00.000Z",
+        "viewer": {},
+        "labels": [],
+    }
+
+
+def thread_json(depth: int = 50, replies: int = 5, authors: int = 3) -> t.Dict[str, t.Any]:
+    # 根からdepth件続くスレッドの末尾の投稿を、直接の返信replies件と一緒に取得したときの応答
+    root = None
+    for i in range(depth):
+        node = {"$type": "app.bsky.feed.defs#threadViewPost", "post": post_json(i, authors)}
+        if root is not None:
+            node["parent"] = root
+        root = node
+    root["replies"] = [{"$type": "app.bsky.feed.defs#threadViewPost", "post": post_json(depth + j, authors), "replies": []} for j in range(replies)]
+    return {"thread": root}
+
+
+def measure(parse: t.Callable[[t.Dict[str, t.Any]], t.Any], payload: bytes, iterations: int) -> t.Dict[str, float]:
+    # JSONのデコードも含めた時間と、1回分の結果が持っているメモリ(tracemallocで数えたもの)
+    started_at = time.perf_counter()
+    for _ in range(iterations):
+        parse(json.loads(payload))
+    seconds = (time.perf_counter() - started_at) / iterations
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = parse(json.loads(payload))
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return {"ms_per_thread": round(seconds * 1000, 3), "retained_bytes": retained}
+
+
+def run(depth: int = 50, replies: int = 5, authors: int = 3, iterations: int = 20) -> t.Dict[str, t.Any]:
+    payload = json.dumps(thread_json(depth, replies, authors)).encode()
+    sdk = measure(lambda data: get_or_create(data, models.AppBskyFeedGetPostThread.Response), payload, iterations)
+    compact = measure(lambda data: decode_thread(data["thread"]), payload, iterations)
+    return {
+        "posts": depth + replies,
+        "payload_bytes": len(payload),
+        "sdk": sdk,
+        "compact": compact,
+        "speedup": round(sdk["ms_per_thread"] / compact["ms_per_thread"], 2) if compact["ms_per_thread"] else None,
+        "memory_ratio": round(compact["retained_bytes"] / sdk["retained_bytes"], 3) if sdk["retained_bytes"] else None,
+    }
+
+
+def main(argv: t.Optional[t.List[str]] = None):
+    parser = argparse.ArgumentParser(description="Compare parsing getPostThread responses into SDK models and into compact posts.")
+    parser.add_argument("--depth", type=int, default=50, help="number of ancestors including the post itself")
+    parser.add_argument("--replies", type=int, default=5)
+    parser.add_argument("--authors", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = json.dumps(run(args.depth, args.replies, args.authors, args.iterations), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,139 @@
+import contextlib
+import dataclasses
+import functools
+import json
 import logging
 import os
+import signal
 import sys
+import threading
 import time
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 
-import openai
 from atproto import Client
+from atproto.exceptions import BadRequestError, RequestErrorBase, RequestException
 from atproto.xrpc_client import models
-from dateutil.parser import parse
+from atproto.xrpc_client.models import ids
 from dotenv import load_dotenv
 
+from bsky_aibot.checkpoint import load_checkpoint, save_checkpoint
+from bsky_aibot.context import build_context, count_messages_tokens, count_tokens
+from bsky_aibot.llm import Backend, OpenAIBackend, Route, Router, StubBackend, parse_routes
+from bsky_aibot.metrics import METRICS
+from bsky_aibot.outbox import Outbox, OutboxItem, new_tid
+from bsky_aibot.posts import Author, Post, Record, Thread, ThreadView, decode_thread
+from bsky_aibot.priority import ReplyPolicy, parse_weights
+from bsky_aibot.profiling import Profiler
+from bsky_aibot.rate_limit import RateLimiter
+from bsky_aibot.replied_index import RepliedIndex
+from bsky_aibot.reply_cache import ReplyCache, cache_key
+from bsky_aibot.scheduler import PollScheduler
+from bsky_aibot.session import SessionStore, attach_session, resume_session
+from bsky_aibot.summaries import SummaryStore
+from bsky_aibot.tenants import Account, FairShare, load_accounts
+from bsky_aibot.thread_cache import ThreadCache
+from bsky_aibot.timestamps import indexed_timestamp, timestamp
+from bsky_aibot.transport import Transport
+from bsky_aibot.workers import WorkerPool, WorkQueue, decode_notification, encode_notification, work
+
 load_dotenv(verbose=True)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 HANDLE = os.getenv("HANDLE")
 PASSWORD = os.getenv("PASSWORD")
-openai.organization = os.environ.get("OPENAI_ORGANIZATION")
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+# 設定すると、このJSONファイルに書いたアカウントをすべて1つのプロセスで動かす(HANDLE/PASSWORDは使わない)
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE")
+# 同時に処理するスレッド数の上限。1にすると従来通り逐次処理になる
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", "4"))
+# listNotificationsのlimitは最大100
+NOTIFICATIONS_PAGE_SIZE = min(int(os.getenv("NOTIFICATIONS_PAGE_SIZE", "100")), 100)
+# 長く止まっていた後でも、チェックポイントから遡るのはこのページ数まで
+MAX_UNREAD_PAGES = int(os.getenv("MAX_UNREAD_PAGES", "10"))
+# これより古い通知には返信しない(返信済みの記録を残す期間と同じ)
+MAX_NOTIFICATION_AGE = float(os.getenv("MAX_NOTIFICATION_AGE", str(24 * 60 * 60)))
+STATE_DIR = os.getenv("STATE_DIR", "state")
+# poll: listNotificationsを定期的に取得する / stream: subscribeReposを購読し、切断中はpollに戻る
+INGESTION_MODE = os.getenv("INGESTION_MODE", "poll")
+FIREHOSE_URL = os.getenv("FIREHOSE_URL")
+# streamモードで接続している間、この秒数ごとに既読・チェックポイント・セッションの保存と未送信の返信の再送を行う
+STREAM_HOUSEKEEPING_INTERVAL = float(os.getenv("STREAM_HOUSEKEEPING_INTERVAL", "60"))
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "120"))
+# gpt-4(8k)のコンテキストから返信の分を引いた程度。スレッドが長いときは間の投稿を省く
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_RECENT_TURNS = int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+# 同じスレッドへの通知をまとめる待ち時間(秒)。0ならまとめない
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "0.5"))
+# each: まとめた通知それぞれに返信する / latest: 一番新しい通知にだけ返信する
+COALESCE_MODE = os.getenv("COALESCE_MODE", "each")
+COALESCE_THREAD_DEPTH = int(os.getenv("COALESCE_THREAD_DEPTH", "50"))
+SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", "Reply friendly in 280 characters or less. No @mentions.")
+# 返信をストリーミングで受け取り、投稿の文字数上限に達したら打ち切る
+GENERATION_STREAM = os.getenv("GENERATION_STREAM", "1") == "1"
+# 返信に使うモデル。"gpt-3.5-turbo?messages<=4&latency<=3,gpt-4" のように条件付きで並べると、最初に合うものを使う
+# "local/<model>" はLOCAL_LLM_BASE_URLのOpenAI互換サーバー、"stub" はネットワークを使わない決まった返信
+LLM_ROUTES = parse_routes(os.getenv("LLM_ROUTES", "gpt-4"))
+# 設定すると、LLM_FALLBACK_TIMEOUT秒以内に応答が始まらないときや失敗したときにこのモデルで生成し直す
+LLM_FALLBACK = os.getenv("LLM_FALLBACK")
+LLM_FALLBACK_TIMEOUT = float(os.getenv("LLM_FALLBACK_TIMEOUT", "20"))
+LOCAL_LLM_BASE_URL = os.getenv("LOCAL_LLM_BASE_URL", "http://127.0.0.1:8000/v1")
+LOCAL_LLM_API_KEY = os.getenv("LOCAL_LLM_API_KEY")
+# 設定するとPrometheus形式のメトリクスを http://127.0.0.1:METRICS_PORT/metrics で公開する
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_ENABLED = os.getenv("METRICS", "0") == "1" or METRICS_PORT is not None
+THREAD_CACHE_MAX_ENTRIES = int(os.getenv("THREAD_CACHE_MAX_ENTRIES", "1024"))
+THREAD_CACHE_TTL = float(os.getenv("THREAD_CACHE_TTL", "600"))
+THREAD_CACHE_MAX_BYTES = int(os.getenv("THREAD_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# 同じ内容の投稿には生成済みの返信を使い回す。REPLY_CACHE_MAX_DEPTH件以下の投稿からなるスレッドだけが対象で、0なら使わない
+REPLY_CACHE_MAX_DEPTH = int(os.getenv("REPLY_CACHE_MAX_DEPTH", "1"))
+REPLY_CACHE_MAX_ENTRIES = int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "1024"))
+REPLY_CACHE_TTL = float(os.getenv("REPLY_CACHE_TTL", str(24 * 60 * 60)))
+REPLY_CACHE_PERSIST = os.getenv("REPLY_CACHE_PERSIST", "1") == "1"
+# スレッドの投稿がこれより多くなったら、古い投稿を要約にまとめて直近のSUMMARY_KEEP_RECENT件と一緒に送る。0なら要約しない
+SUMMARY_THRESHOLD = int(os.getenv("SUMMARY_THRESHOLD", "20"))
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "8"))
+# クライアント側のレート制限。PDSは秒あたり、LLMは分あたりの上限で、応答ヘッダーを見て調整する
+PDS_READ_RATE = float(os.getenv("PDS_READ_RATE", "10"))
+PDS_WRITE_RATE = float(os.getenv("PDS_WRITE_RATE", "0.13"))  # 返信(createRecord)の回数。ヘッダーではこれより速くしない
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "200"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "40000"))
+# 返信待ちが溜まったときの優先度。重みは "handle_or_did=2,..." の形式で、期限と上限は0なら無効
+REASON_WEIGHTS = parse_weights(os.getenv("REASON_WEIGHTS", "mention=2,reply=1"))
+AUTHOR_WEIGHTS = parse_weights(os.getenv("AUTHOR_WEIGHTS"))
+PRIORITY_HALF_LIFE = float(os.getenv("PRIORITY_HALF_LIFE", "300"))
+REPLY_DEADLINE = float(os.getenv("REPLY_DEADLINE", "0")) or None
+# drop: 期限を過ぎたものには返信しない / defer: 期限内のものを先に済ませてから返信する
+REPLY_DEADLINE_ACTION = os.getenv("REPLY_DEADLINE_ACTION", "drop")
+BACKLOG_HIGH_WATER = int(os.getenv("BACKLOG_HIGH_WATER", "0")) or None
+# PDSとOpenAIへの接続。GETは接続エラーや5xxのときにHTTP_RETRIES回まで再試行する
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "120"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(max(10, MAX_IN_FLIGHT * 2))))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP2 = os.getenv("HTTP2", "0") == "1"
+# SIGUSR1を送るか、PROFILE_TRIGGERのファイルを作ると、次のPROFILE_CYCLES回のサイクルをPROFILE_DIRに記録する
+# PROFILE=1なら起動直後から記録する。PROFILE_MODEはcprofile(決定的)かsample(サンプリング、オーバーヘッドが小さい)
+PROFILE_AT_START = os.getenv("PROFILE", "0") == "1"
+PROFILE_CYCLES = int(os.getenv("PROFILE_CYCLES", "3"))
+PROFILE_MODE = os.getenv("PROFILE_MODE", "cprofile")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+PROFILE_MEMORY = os.getenv("PROFILE_MEMORY", "1") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(STATE_DIR, "profiles"))
+PROFILE_TRIGGER = os.getenv("PROFILE_TRIGGER", os.path.join(STATE_DIR, "profile"))
+# 1以上にすると、このプロセスは通知を取得してキューに積むだけになり、返信はこの数のワーカープロセスが行う
+# 各ワーカーはMAX_IN_FLIGHT個のスレッドで処理する。0なら従来通り1プロセスで処理する
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "0"))
+# 読み込みのレート制限のうち、通知を取得するプロセスが使う割合。残りをワーカーで等分する
+POLLER_READ_SHARE = float(os.getenv("POLLER_READ_SHARE", "0.1"))
+# ワーカーがこの秒数のうちに終えなかった通知は、落ちたものとみなして他のワーカーが取り直す
+WORK_QUEUE_LEASE = float(os.getenv("WORK_QUEUE_LEASE", "600"))
+# SIGTERMを受けたら取得をやめ、キューが空になるまでこの秒数だけ待ってから止まる
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "60"))
 
 
 class OpenAIMessage(t.TypedDict):
@@ -28,46 +143,143 @@ class OpenAIMessage(t.TypedDict):
     function_call: t.Optional[t.Dict]
 
 
-def get_notifications(client: Client):
-    response = client.bsky.notification.list_notifications()
-    return response.notifications
+@dataclass
+class Services:
+    # 通知の処理をまたいで共有する状態。未設定のものは使わずに従来通り動く
+    replied_index: t.Optional[RepliedIndex] = None
+    thread_cache: t.Optional[ThreadCache] = None
+    scheduler: t.Optional[PollScheduler] = None
+    outbox: t.Optional[Outbox] = None
+    rate_limiter: t.Optional[RateLimiter] = None
+    reply_policy: t.Optional[ReplyPolicy] = None
+    transport: t.Optional[Transport] = None
+    llm: t.Optional[Router] = None
+    reply_cache: t.Optional[ReplyCache] = None
+    summaries: t.Optional[SummaryStore] = None
+    # 複数のアカウントを動かすときの、アカウントごとの設定と、アカウント間で処理の枠を分けるもの
+    account: t.Optional[str] = None
+    system_prompt: t.Optional[str] = None
+    fair_share: t.Optional[FairShare] = None
+    profiler: t.Optional[Profiler] = None
+
+
+def get_notifications(client: Client, cursor: t.Optional[str] = None, limit: int = NOTIFICATIONS_PAGE_SIZE) -> "models.AppBskyNotificationListNotifications.Response":
+    params = {"limit": limit}
+    if cursor is not None:
+        params["cursor"] = cursor
+    with METRICS.time("get_notifications"):
+        return client.bsky.notification.list_notifications(params)
+
+
+def iter_notification_pages(client: Client, limit: int = NOTIFICATIONS_PAGE_SIZE, max_pages: t.Optional[int] = None) -> t.Iterator[t.List["models.AppBskyNotificationListNotifications.Notification"]]:
+    # 次のページは必要になった時点で取得する。呼び出し側が途中でやめればそれ以上リクエストしない
+    cursor = None
+    pages = 0
+    while max_pages is None or pages < max_pages:
+        response = get_notifications(client, cursor, limit)
+        pages += 1
+        yield response.notifications
+        cursor = response.cursor
+        if cursor is None or len(response.notifications) == 0:
+            return
+
+
+def iter_notifications(client: Client, limit: int = NOTIFICATIONS_PAGE_SIZE, max_pages: t.Optional[int] = None) -> t.Iterator["models.AppBskyNotificationListNotifications.Notification"]:
+    for page in iter_notification_pages(client, limit, max_pages):
+        yield from page
 
 
 def update_seen(client: Client, seenAt: datetime):
-    response = client.bsky.notification.update_seen({"seenAt": seenAt.isoformat()})
+    with METRICS.time("update_seen"):
+        response = client.bsky.notification.update_seen({"seenAt": seenAt.isoformat()})
     return
 
 
-def filter_mentions_and_replies_from_notifications(ns: t.List["models.AppBskyNotificationListNotifications.Notification"]) -> t.List[models.AppBskyNotificationListNotifications.Notification]:
-    return [n for n in ns if n.reason in ("mention", "reply")]
+def filter_mentions_and_replies_from_notifications(ns: t.Iterable["models.AppBskyNotificationListNotifications.Notification"]) -> t.Iterator[models.AppBskyNotificationListNotifications.Notification]:
+    return (n for n in ns if n.reason in ("mention", "reply"))
 
 
-def filter_unread_notifications(ns: t.List["models.AppBskyNotificationListNotifications.Notification"], seen_at: datetime) -> t.List["models.AppBskyNotificationListNotifications.Notification"]:
+def unread_cutoff(seen_at: datetime) -> float:
     # IndexされてからNotificationで取得できるまでにラグがあるので、最後に見た時刻より少し前ににIndexされたものから取得する
-    return [n for n in ns if seen_at - timedelta(minutes=2) < parse(n.indexedAt)]
+    return (seen_at - timedelta(minutes=2)).timestamp()
+
+
+def filter_unread_notifications(ns: t.Iterable["models.AppBskyNotificationListNotifications.Notification"], seen_at: datetime) -> t.Iterator["models.AppBskyNotificationListNotifications.Notification"]:
+    # 通知は新しい順に返ってくるので、古いものに到達したらそれ以降(次のページも含めて)は見ない
+    cutoff = unread_cutoff(seen_at)
+    for n in ns:
+        if timestamp(n.indexedAt) <= cutoff:
+            return
+        yield n
+
 
+def unread_window(page: t.Sequence["models.AppBskyNotificationListNotifications.Notification"], cutoff: float) -> int:
+    # 新しい順に並んだページのうち、cutoffより新しい先頭の件数を二分探索で求める(解析するのはlog2(len(page))件だけ)
+    # bisectのkey=はPython 3.10からなので、自前で書く
+    lo, hi = 0, len(page)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if timestamp(page[mid].indexedAt) > cutoff:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
 
-def get_thread(client: Client, uri: str) -> "models.AppBskyFeedDefs.FeedViewPost":
-    return client.bsky.feed.get_post_thread({"uri": uri})
 
+def filter_unread_pages(pages: t.Iterable[t.Sequence["models.AppBskyNotificationListNotifications.Notification"]], seen_at: datetime) -> t.Iterator["models.AppBskyNotificationListNotifications.Notification"]:
+    # filter_unread_notificationsと同じ結果を、ページごとの二分探索で求める。既読の通知を含むページで止める
+    cutoff = unread_cutoff(seen_at)
+    for page in pages:
+        n = unread_window(page, cutoff)
+        yield from page[:n]
+        if n < len(page):
+            return
 
-# TODO: receive models.AppBskyFeedDefs.ThreadViewPost
-def is_already_replied_to(feed_view: models.AppBskyFeedDefs.FeedViewPost, did: str) -> bool:
+
+def get_thread(client: Client, uri: str, parent_height: t.Optional[int] = None, depth: t.Optional[int] = None) -> Thread:
+    params = {"uri": uri}
+    if parent_height is not None:
+        params["parentHeight"] = parent_height
+    if depth is not None:
+        params["depth"] = depth
+    with METRICS.time("get_thread"):
+        # SDKのモデルは作らず、使う項目だけを応答のJSONから直接読む
+        response = client.invoke_query("app.bsky.feed.getPostThread", params=models.AppBskyFeedGetPostThread.Params(**params))
+        content = json.loads(response.content) if isinstance(response.content, bytes) else response.content
+        return Thread(decode_thread(content["thread"]))
+
+
+def is_already_replied_to(feed_view: Thread, did: str) -> bool:
     replies = feed_view.thread.replies
     if replies is None:
         return False
     else:
-        return any([reply.post.author.did == did for reply in replies])
+        return any(getattr(reply, "post", None) is not None and reply.post.author.did == did for reply in replies)
 
 
-def flatten_posts(thread: "models.AppBskyFeedDefs.ThreadViewPost") -> t.List[t.Dict[str, any]]:
-    posts = [thread.post]
+def flatten_posts(thread: ThreadView) -> t.List[Post]:
+    # 投稿から根に向かって(新しい順に)並べる。深いスレッドでも再帰の上限に当たらないようにループでたどる
+    posts = []
+    while thread is not None and getattr(thread, "post", None) is not None:
+        posts.append(thread.post)
+        thread = thread.parent
+    return posts
 
-    parent = thread.parent
-    if parent is not None:
-        posts.extend(flatten_posts(parent))
 
-    return posts
+def find_post_chains(thread: ThreadView, uris: t.Set[str], did: str) -> t.Dict[str, t.Tuple[t.List[Post], bool]]:
+    # 根から返信をたどり、uris それぞれについて(根までのチェーン(新しい順), 返信済みか)を返す
+    found = {}
+    stack = [(thread, [])]
+    while stack:
+        view, ancestors = stack.pop()
+        if getattr(view, "post", None) is None:
+            continue  # NotFoundPost, BlockedPost
+        chain = [view.post] + ancestors
+        replies = [reply for reply in view.replies or [] if getattr(reply, "post", None) is not None]
+        if view.post.uri in uris:
+            found[view.post.uri] = (chain, any(reply.post.author.did == did for reply in replies))
+        stack.extend((reply, chain) for reply in replies)
+    return found
 
 
 def get_openai_chat_message_name(name: str) -> str:
@@ -75,8 +287,8 @@ def get_openai_chat_message_name(name: str) -> str:
     return name.replace(".", "_")
 
 
-def posts_to_sorted_messages(posts: t.List[models.AppBskyFeedDefs.PostView], assistant_did: str) -> t.List[OpenAIMessage]:
-    sorted_posts = sorted(posts, key=lambda post: post.indexedAt)
+def posts_to_sorted_messages(posts: t.List[Post], assistant_did: str) -> t.List[OpenAIMessage]:
+    sorted_posts = sorted(posts, key=indexed_timestamp)
     messages = []
     for post in sorted_posts:
         role = "assistant" if post.author.did == assistant_did else "user"
@@ -84,7 +296,36 @@ def posts_to_sorted_messages(posts: t.List[models.AppBskyFeedDefs.PostView], ass
     return messages
 
 
-def thread_to_messages(thread: "models.AppBskyFeedGetPostThread.Response", did: str) -> t.List[OpenAIMessage]:
+def summarize_messages(services: Services, summary: t.Optional[str], messages: t.List[OpenAIMessage]) -> str:
+    llm = get_router(services)
+    posts = "\n".join(f"{m.get('name') or m['role']}: {m['content']}" for m in messages)
+    prompt = [
+        {"role": "system", "content": "Summarize the conversation in 280 characters or less. Keep who said what and any open questions."},
+        {"role": "user", "content": (f"Summary so far: {summary}\n\n" if summary else "") + f"New posts:\n{posts}"},
+    ]
+    with METRICS.time("summarize"):
+        text, _, backend = llm.generate(prompt, len(messages))
+    logging.info(f"Summarized {len(messages)} posts with {backend}")
+    return text
+
+
+def thread_messages(posts: t.List[Post], did: str, services: Services) -> t.List[OpenAIMessage]:
+    # 長いスレッドは、古い投稿をスレッドの根ごとに保存した要約に置き換える
+    if services.summaries is None:
+        return posts_to_sorted_messages(posts, did)
+    sorted_posts = sorted(posts, key=indexed_timestamp)
+    messages = posts_to_sorted_messages(sorted_posts, did)
+    uris = [post.uri for post in sorted_posts]
+    try:
+        return services.summaries.compact(uris[0], uris, messages, functools.partial(summarize_messages, services))
+    except Exception as e:
+        # 要約できなくても返信はする。送りきれない古い投稿はbuild_contextが削る
+        logging.warning(f"Could not summarize {uris[0]}: {e!r}")
+        METRICS.inc("summary_errors_total")
+        return messages
+
+
+def thread_to_messages(thread: Thread, did: str) -> t.List[OpenAIMessage]:
     if thread is None:
         return []
     posts = flatten_posts(thread.thread)
@@ -92,16 +333,110 @@ def thread_to_messages(thread: "models.AppBskyFeedGetPostThread.Response", did:
     return messages
 
 
-def generate_reply(post_messages: t.List[OpenAIMessage]):
-    # <https://platform.openai.com/docs/api-reference/chat/create>
-    messages = [{"role": "system", "content": "Reply friendly in 280 characters or less. No @mentions."}]
-    messages.extend(post_messages)
-    chat_completion = openai.ChatCompletion.create(
-        model="gpt-4",
-        messages=messages,
-    )
-    first = chat_completion.choices[0]
-    return first.message.content
+def get_thread_posts(client: Client, notification: models.AppBskyNotificationListNotifications.Notification, did: str, thread_cache: t.Optional[ThreadCache] = None) -> t.Optional[t.List[Post]]:
+    # 返信済みならNoneを返す。親までのチェーンがキャッシュにあれば、通知された投稿とその返信だけを取得する
+    ancestors = None
+    if thread_cache is not None and notification.record.reply is not None:
+        ancestors = thread_cache.get(notification.record.reply.parent.uri)
+
+    thread = get_thread(client, notification.uri, parent_height=None if ancestors is None else 0)
+    if is_already_replied_to(thread, did):
+        return None
+
+    posts = flatten_posts(thread.thread) if ancestors is None else [thread.thread.post] + ancestors
+    if thread_cache is not None:
+        thread_cache.put_chain(posts)
+    return posts
+
+
+def sent_post_view(client: Client, response: "models.ComAtprotoRepoCreateRecord.Response", text: str) -> Post:
+    now = datetime.now(tz=timezone.utc)
+    return Post(response.uri, response.cid, Author(client.me.did, client.me.handle), Record(text, now.isoformat()), now.isoformat(), now.timestamp())
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai():
+    # openaiの読み込みには時間がかかるので、返信を生成するときまで遅らせる
+    import openai
+
+    openai.organization = os.environ.get("OPENAI_ORGANIZATION")
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    return openai
+
+
+def prepare_openai(services: Services):
+    openai = get_openai()
+    if services.transport is not None:
+        services.transport.install_openai(openai)
+    if services.rate_limiter is not None:
+        services.rate_limiter.install_openai(openai)
+    return openai
+
+
+def create_backend(name: str, services: Services) -> Backend:
+    if name == "stub":
+        return StubBackend()
+    timeouts = {} if services.transport is None else {"connect_timeout": services.transport.connect_timeout, "read_timeout": services.transport.llm_read_timeout}
+    if name.startswith("local/"):
+        return OpenAIBackend(name[len("local/") :], functools.partial(prepare_openai, services), GENERATION_STREAM, LOCAL_LLM_BASE_URL, LOCAL_LLM_API_KEY, name=name, **timeouts)
+    return OpenAIBackend(name, functools.partial(prepare_openai, services), GENERATION_STREAM, rate_limiter=services.rate_limiter, **timeouts)
+
+
+def create_router(services: Services, routes: t.Optional[t.List[Route]] = None, backends: t.Optional[t.Dict[str, Backend]] = None) -> Router:
+    # backendsを渡すと、同じ名前のバックエンドは作らずにそれを使う(アカウント間で接続やレート制限を共有する)
+    routes = routes or LLM_ROUTES
+    backends = {} if backends is None else backends
+    names = {route.backend for route in routes} | ({LLM_FALLBACK} if LLM_FALLBACK else set())
+    for name in names:
+        if name not in backends:
+            backends[name] = create_backend(name, services)
+    return Router({name: backends[name] for name in names}, routes, LLM_FALLBACK, LLM_FALLBACK_TIMEOUT)
+
+
+ROUTER_LOCK = threading.Lock()
+
+
+def get_router(services: Services) -> Router:
+    # ふつうはcreate_services, account_servicesで作ってある。返信のスレッドから同時に呼ばれても、Routerは1つだけ作る
+    if services.llm is None:
+        with ROUTER_LOCK:
+            if services.llm is None:
+                services.llm = create_router(services)
+    return services.llm
+
+
+def generate_reply(post_messages: t.List[OpenAIMessage], services: t.Optional[Services] = None, handle: t.Optional[str] = None):
+    services = services or Services()
+    system_messages = [{"role": "system", "content": services.system_prompt or SYSTEM_PROMPT}]
+    llm = get_router(services)
+    key = None
+    if services.reply_cache is not None and services.reply_cache.eligible(post_messages):
+        # システムプロンプトか、使うモデルが変わったら別のキーになる(キャッシュはアカウント間で共有する)
+        namespace = json.dumps([system_messages[0]["content"], llm.names()], ensure_ascii=False)
+        key = cache_key(post_messages, namespace=namespace, handle=handle)
+        cached = services.reply_cache.get(key)
+        METRICS.inc("reply_cache_total", result="miss" if cached is None else "hit")
+        if cached is not None:
+            logging.info("Reusing a cached reply")
+            return cached
+
+    messages, saved_tokens = build_context(system_messages, post_messages, CONTEXT_TOKEN_BUDGET, CONTEXT_RECENT_TURNS)
+    if saved_tokens > 0:
+        logging.info(f"Context trimmed: {len(post_messages) + 1 - len(messages)} messages, {saved_tokens} tokens saved")
+    if METRICS.enabled:
+        METRICS.inc("llm_tokens_total", count_messages_tokens(messages), kind="prompt")
+        METRICS.inc("llm_tokens_total", saved_tokens, kind="saved")
+
+    reply, timing, backend = llm.generate(messages, len(post_messages))
+    ttft = "-" if timing.time_to_first_token is None else f"{timing.time_to_first_token:.2f}"
+    logging.info(f"Generated reply with {backend}: time to first token {ttft}s, total {timing.total:.2f}s, truncated: {timing.truncated}")
+    if METRICS.enabled:
+        METRICS.inc("llm_tokens_total", count_tokens(reply), kind="completion")
+        if timing.time_to_first_token is not None:
+            METRICS.observe("llm_time_to_first_token_seconds", timing.time_to_first_token)
+    if key is not None:
+        services.reply_cache.put(key, reply)
+    return reply
 
 
 def reply_to(notification: models.AppBskyNotificationListNotifications.Notification) -> t.Union[models.AppBskyFeedPost.ReplyRef, models.AppBskyFeedDefs.ReplyRef]:
@@ -115,43 +450,410 @@ def reply_to(notification: models.AppBskyNotificationListNotifications.Notificat
         return {"root": notification.record.reply.root, "parent": parent}
 
 
-def read_notifications_and_reply(client: Client, last_seen_at: datetime = None) -> datetime:
+def thread_root_uri(notification: models.AppBskyNotificationListNotifications.Notification) -> str:
+    if notification.record.reply is None:
+        return notification.uri
+    else:
+        return notification.record.reply.root.uri
+
+
+def mark_replied(notification: models.AppBskyNotificationListNotifications.Notification, services: Services):
+    if services.replied_index is not None:
+        services.replied_index.add(notification.uri, notification.cid)
+
+
+def reply_to_notification(client: Client, notification: models.AppBskyNotificationListNotifications.Notification, did: str, services: Services):
+    if services.replied_index is not None and notification.uri in services.replied_index:
+        logging.info(f"Already replied to {notification.uri} (index)")
+        METRICS.inc("notifications_skipped_total", reason="index")
+        return
+
+    posts = get_thread_posts(client, notification, did, services.thread_cache)
+    if posts is None:
+        logging.info(f"Already replied to {notification.uri}")
+        METRICS.inc("notifications_skipped_total", reason="thread")
+        mark_replied(notification, services)
+        return
+
+    send_reply(client, notification, posts, did, services)
+
+
+def outbox_item(notification: models.AppBskyNotificationListNotifications.Notification, text: str) -> OutboxItem:
+    ref = reply_to(notification)
+    root = ref["root"] if isinstance(ref["root"], dict) else {"uri": ref["root"].uri, "cid": ref["root"].cid}
+    return OutboxItem(
+        key=notification.uri,
+        rkey=new_tid(),
+        text=text,
+        root_uri=root["uri"],
+        root_cid=root["cid"],
+        parent_uri=ref["parent"]["uri"],
+        parent_cid=ref["parent"]["cid"],
+    )
+
+
+def create_post(client: Client, item: OutboxItem) -> models.ComAtprotoRepoCreateRecord.Response:
+    # send_postと同じだが、レコードキーを指定して再送しても同じ投稿になるようにする
+    return client.com.atproto.repo.create_record(
+        models.ComAtprotoRepoCreateRecord.Data(
+            repo=client.me.did,
+            collection=ids.AppBskyFeedPost,
+            rkey=item.rkey,
+            record=models.AppBskyFeedPost.Main(createdAt=datetime.now(tz=timezone.utc).isoformat(), text=item.text, reply=item.reply_ref()),
+        )
+    )
+
+
+def get_sent_post(client: Client, item: OutboxItem) -> t.Optional["models.ComAtprotoRepoGetRecord.Response"]:
+    try:
+        return client.com.atproto.repo.get_record({"repo": client.me.did, "collection": ids.AppBskyFeedPost, "rkey": item.rkey})
+    except BadRequestError:
+        return None  # RecordNotFound
+
+
+def is_permanent_failure(e: Exception) -> bool:
+    # 送り直しても成功しないもの(400、429以外の4xx)。接続エラー、タイムアウト、5xx、429、認証切れは一時的なものとして送り直す
+    if isinstance(e, BadRequestError):
+        return True
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    return isinstance(e, RequestException) and status is not None and 400 <= status < 500 and status not in (401, 403, 408, 429)
+
+
+def deliver(client: Client, item: OutboxItem, outbox: Outbox) -> t.Union["models.ComAtprotoRepoCreateRecord.Response", "models.ComAtprotoRepoGetRecord.Response"]:
+    if item.attempts > 0:
+        # 前回、投稿はできたが応答を受け取る前に失敗していたかもしれない
+        sent = get_sent_post(client, item)
+        if sent is not None:
+            outbox.mark_sent(item.key, sent.uri)
+            return sent
+    outbox.attempt(item.key)
+    try:
+        with METRICS.time("send_post"):
+            response = create_post(client, item)
+    except Exception as e:
+        if outbox.fail(item.key, permanent=is_permanent_failure(e)):
+            logging.error(f"Gave up replying to {item.key} after {item.attempts + 1} attempts: {e!r}")
+            METRICS.inc("outbox_dead_total")
+        raise
+    outbox.mark_sent(item.key, response.uri)
+    return response
+
+
+def flush_outbox(client: Client, services: Services, older_than: float = 0) -> int:
+    # 生成済みで未送信の返信を、LLMを呼ばずに送り直す。送れないものがあっても、残りと新しい通知の処理は続ける
+    items = services.outbox.pending(older_than)
+    sent = 0
+    for item in items:
+        logging.info(f"Resending reply to {item.key} (attempts: {item.attempts})")
+        try:
+            deliver(client, item, services.outbox)
+        except Exception as e:
+            logging.warning(f"Could not resend reply to {item.key}: {e!r}")
+            continue
+        sent += 1
+        if services.replied_index is not None:
+            services.replied_index.add(item.key, item.parent_cid)
+    return sent
+
+
+def send_reply(client: Client, notification: models.AppBskyNotificationListNotifications.Notification, posts: t.List[Post], did: str, services: Services):
+    if services.outbox is None:
+        post_messages = thread_messages(posts, did, services)
+        with METRICS.time("generate_reply"):
+            reply = generate_reply(post_messages, services, client.me.handle)
+        with METRICS.time("send_post"):
+            response = client.send_post(text=f"{reply}", reply_to=reply_to(notification))
+    else:
+        item = services.outbox.get(notification.uri)
+        if item is None:
+            post_messages = thread_messages(posts, did, services)
+            with METRICS.time("generate_reply"):
+                reply = generate_reply(post_messages, services, client.me.handle)
+            item = services.outbox.add(outbox_item(notification, reply))
+        if item.sent_uri is not None:
+            logging.info(f"Already replied to {notification.uri} (outbox)")
+            METRICS.inc("notifications_skipped_total", reason="outbox")
+            mark_replied(notification, services)
+            return
+        if services.outbox.is_dead(item.key):
+            logging.info(f"Gave up replying to {notification.uri} (outbox)")
+            METRICS.inc("notifications_skipped_total", reason="dead")
+            mark_replied(notification, services)  # 重なりの窓で読むたびにスレッドを取得し直さない
+            return
+        if services.outbox.is_waiting(item.key):
+            # 一時的な失敗の後。間を空けてflush_outboxが送り直す
+            logging.info(f"Waiting to resend reply to {notification.uri} (outbox)")
+            METRICS.inc("notifications_skipped_total", reason="outbox_retry")
+            return
+        reply = item.text
+        response = deliver(client, item, services.outbox)
+    mark_replied(notification, services)
+    if services.thread_cache is not None:
+        # 次に届く返信の親は自分の投稿なので、祖先チェーンごとキャッシュしておく
+        services.thread_cache.put(response.uri, [sent_post_view(client, response, reply)] + posts)
+
+
+def reply_to_thread_notifications(client: Client, ns: t.List["models.AppBskyNotificationListNotifications.Notification"], did: str, services: Services, mode: str = COALESCE_MODE):
+    # 同じスレッドへの通知をまとめて、スレッドの取得を1回で済ませる
+    if services.replied_index is not None:
+        ns = [n for n in ns if n.uri not in services.replied_index]
+    if len(ns) <= 1:
+        for notification in ns:
+            reply_to_notification(client, notification, did, services)
+        return
+
+    thread = get_thread(client, thread_root_uri(ns[0]), depth=COALESCE_THREAD_DEPTH)
+    chains = find_post_chains(thread.thread, {n.uri for n in ns}, did)
+    if mode == "latest":
+        latest = max(ns, key=indexed_timestamp)
+        for notification in ns:
+            if notification is not latest:
+                logging.info(f"Coalesced {notification.uri} into {latest.uri}")
+                METRICS.inc("notifications_skipped_total", reason="coalesced")
+                mark_replied(notification, services)
+        ns = [latest]
+
+    for notification in ns:
+        if notification.uri not in chains:
+            # 根から深すぎて取得できなかったものは個別に処理する
+            reply_to_notification(client, notification, did, services)
+            continue
+        posts, replied = chains[notification.uri]
+        if replied:
+            logging.info(f"Already replied to {notification.uri}")
+            METRICS.inc("notifications_skipped_total", reason="thread")
+            mark_replied(notification, services)
+            continue
+        if services.thread_cache is not None:
+            services.thread_cache.put_chain(posts)
+        send_reply(client, notification, posts, did, services)
+
+
+def reply_to_notifications(
+    client: Client,
+    ns: t.Iterable["models.AppBskyNotificationListNotifications.Notification"],
+    did: str,
+    max_in_flight: int = MAX_IN_FLIGHT,
+    services: t.Optional[Services] = None,
+    coalesce_window: float = COALESCE_WINDOW,
+    clock: t.Callable[[], float] = time.time,
+    on_error: t.Optional[t.Callable[[Exception], None]] = None,
+) -> int:
+    # on_error: 指定すると、返信に失敗しても例外を送出せずにこれを(nsを読むスレッドで)呼び、残りの通知の処理を続ける
+    services = services or Services()
+    policy = services.reply_policy
+    # 同じスレッドへの返信は届いた順に1つのワーカーで逐次処理し、異なるスレッドは並行に処理する
+    # 空いたワーカーは、待っているスレッドのうち優先度が一番高いものを取る(ポリシーが無ければ届いた順)
+    queues: t.Dict[str, t.List["models.AppBskyNotificationListNotifications.Notification"]] = {}
+    ready: t.Dict[str, int] = {}  # ワーカーを待っているスレッドの根 -> 届いた順番
+    pending = 0
+    lock = threading.Lock()
+    exhausted = threading.Event()  # nsを最後まで読んだ(これ以上通知が届かない)
+    errors: t.List[Exception] = []
+
+    def rank(root: str, now: float) -> t.Tuple[bool, float, int]:
+        if policy is None:
+            return True, 0.0, -ready[root]
+        return (*policy.priority(queues[root], now), -ready[root])
+
+    def discard(ns: t.List["models.AppBskyNotificationListNotifications.Notification"], reason: str):
+        nonlocal pending
+        pending -= len(ns)
+        METRICS.add_gauge("queued_notifications", -len(ns))
+        for notification in ns:
+            logging.info(f"Skipped {notification.uri} ({reason})")
+            METRICS.inc("notifications_skipped_total", reason=reason)
+
+    def shed():
+        # 溜まりすぎたら、優先度の低いスレッドから待ちの通知を捨てる
+        now = clock()
+        while pending > policy.high_water and ready:
+            root = min(ready, key=lambda root: rank(root, now))
+            del ready[root]
+            discard(queues.pop(root), "shed")
+
+    def take(root: str) -> t.Optional[t.List["models.AppBskyNotificationListNotifications.Notification"]]:
+        nonlocal pending
+        with lock:
+            queue = queues[root]
+            if len(queue) == 0:
+                del queues[root]
+                return None
+            batch = queue[:]
+            queue.clear()
+            if policy is not None and policy.deadline_action == "drop":
+                now = clock()
+                expired = [n for n in batch if policy.expired(n, now)]
+                if expired:
+                    discard(expired, "deadline")
+                    batch = [n for n in batch if not policy.expired(n, now)]
+            pending -= len(batch)
+            return batch
+
+    def drain():
+        # 少し待って、その間に届いた同じスレッドへの通知をまとめて処理する
+        # 取得済みのページのように入力を読み終えていれば、もう届かないので待たない
+        if coalesce_window > 0:
+            exhausted.wait(coalesce_window)
+        with lock:
+            if len(ready) == 0:
+                return  # 捨てられた
+            now = clock()
+            root = max(ready, key=lambda root: rank(root, now))
+            del ready[root]
+        while True:
+            batch = take(root)
+            if batch is None:
+                return
+            if len(batch) == 0:
+                continue
+            try:
+                with contextlib.nullcontext() if services.fair_share is None else services.fair_share.slot(services.account):
+                    reply_to_thread_notifications(client, batch, did, services)
+            except Exception as e:
+                if on_error is None:
+                    raise
+                # 失敗したバッチだけを諦め、同じスレッドに後から届いた通知は処理し続ける
+                with lock:
+                    errors.append(e)
+            finally:
+                METRICS.add_gauge("queued_notifications", -len(batch))
+
+    def report_errors():
+        with lock:
+            failed = errors[:]
+            errors.clear()
+        for e in failed:
+            on_error(e)
+
+    count = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight)) as executor:
+        futures = []
+        try:
+            for notification in ns:
+                count += 1
+                METRICS.add_gauge("queued_notifications", 1)
+                root = thread_root_uri(notification)
+                with lock:
+                    pending += 1
+                    if root in queues:
+                        queues[root].append(notification)
+                    else:
+                        queues[root] = [notification]
+                        ready[root] = count
+                        futures.append(executor.submit(drain))
+                    if policy is not None and policy.high_water is not None:
+                        shed()
+                # ストリームのように終わらない入力でも溜め込まないよう、終わったものは都度回収する
+                for future in [f for f in futures if f.done()]:
+                    futures.remove(future)
+                    future.result()
+                report_errors()
+        finally:
+            exhausted.set()
+        # 1件でも失敗したら例外を送出し、update_seenは呼ばない(従来と同じ挙動)
+        for future in futures:
+            future.result()
+    report_errors()
+    return count
+
+
+def unread_notifications(
+    client: Client,
+    last_seen_at: t.Optional[datetime],
+    max_pages: int = MAX_UNREAD_PAGES,
+    max_age: float = MAX_NOTIFICATION_AGE,
+    now: t.Optional[datetime] = None,
+) -> t.Iterator["models.AppBskyNotificationListNotifications.Notification"]:
+    # unread countで判断するアプローチは、たまたまbsky.appで既読をつけてしまった場合に弱い
+    if last_seen_at is None:
+        # チェックポイントが無いときは全履歴を遡らず、最初のページだけを見る
+        ns = iter_notifications(client, max_pages=1)
+    else:
+        # 長く止まっていた後は、max_ageより古い通知やmax_pagesより先のページまでは遡らない(古いメンションに今さら返信しない)
+        oldest = (now or datetime.now(tz=timezone.utc)) - timedelta(seconds=max_age)
+        if last_seen_at < oldest:
+            logging.warning(f"Checkpoint {last_seen_at.isoformat()} is older than {max_age:.0f}s; skipping older notifications")
+            last_seen_at = oldest
+        ns = filter_unread_pages(iter_notification_pages(client, max_pages=max_pages), last_seen_at)
+    return filter_mentions_and_replies_from_notifications(ns)
+
+
+def read_notifications_and_reply(client: Client, last_seen_at: datetime = None, max_in_flight: int = MAX_IN_FLIGHT, services: t.Optional[Services] = None) -> datetime:
+    services = services or Services()
     logging.info(f"last_seen_at: {last_seen_at}")
     did = client.me.did
 
     seen_at = datetime.now(tz=timezone.utc)
 
-    # unread countで判断するアプローチは、たまたまbsky.appで既読をつけてしまった場合に弱い
-    ns = get_notifications(client)
-    ns = filter_mentions_and_replies_from_notifications(ns)
-    if last_seen_at is not None:
-        ns = filter_unread_notifications(ns, last_seen_at)
+    if services.outbox is not None:
+        flush_outbox(client, services)
 
-    if (len(ns) == 0):
+    count = reply_to_notifications(client, unread_notifications(client, last_seen_at), did, max_in_flight, services)
+    if services.scheduler is not None:
+        services.scheduler.record(count)
+        logging.info(f"poll interval: {services.scheduler.interval:.1f}s, hit rate: {services.scheduler.hit_rate:.2f}")
+    if count == 0:
         logging.info("No unread notifications")  # avoid to call update_seen unnecessarily.
         return seen_at
 
-    for notification in ns:
-        thread = get_thread(client, notification.uri)
-        if is_already_replied_to(thread, did):
-            logging.info(f"Already replied to {notification.uri}")
-            continue
+    update_seen(client, seen_at)
+    if services.replied_index is not None:
+        services.replied_index.compact()
+    if services.outbox is not None:
+        services.outbox.compact()
+    if services.thread_cache is not None:
+        logging.info(f"thread cache: {services.thread_cache.stats()}")
+    if services.transport is not None:
+        logging.info(f"connections: {services.transport.stats()}")
+    if services.llm is not None:
+        logging.info(f"llm: {services.llm.stats()}")
+    if services.reply_cache is not None:
+        logging.info(f"reply cache: {services.reply_cache.stats()}")
+    if services.summaries is not None:
+        logging.info(f"summaries: {services.summaries.stats()}")
+    return seen_at
+
+
+def enqueue_notifications(client: Client, last_seen_at: t.Optional[datetime], queue: WorkQueue, services: t.Optional[Services] = None) -> datetime:
+    # read_notifications_and_replyのうち、返信をワーカープロセスに任せるもの
+    services = services or Services()
+    logging.info(f"last_seen_at: {last_seen_at}")
+    seen_at = datetime.now(tz=timezone.utc)
 
-        post_messages = thread_to_messages(thread, did)
-        reply = generate_reply(post_messages)
-        client.send_post(text=f"{reply}", reply_to=reply_to(notification))
+    count = 0
+    for notification in unread_notifications(client, last_seen_at):
+        count += queue.put(notification.uri, thread_root_uri(notification), encode_notification(notification))
+    if services.scheduler is not None:
+        services.scheduler.record(count)
+        logging.info(f"poll interval: {services.scheduler.interval:.1f}s, hit rate: {services.scheduler.hit_rate:.2f}")
+    if count == 0:
+        logging.info("No unread notifications")
+        return seen_at
 
+    # キューに積んだ通知は失われないので、返信を待たずに既読にする。update_seenを呼ぶのはこのプロセスだけ
     update_seen(client, seen_at)
+    queue.compact()
+    if services.replied_index is not None:
+        services.replied_index.compact()
+    if services.outbox is not None:
+        services.outbox.compact()
+    logging.info(f"work queue: {queue.stats()}")
     return seen_at
 
 
-def login(client: Client, initial_wait: int):
+def login(client: Client, initial_wait: int, session_store: t.Optional[SessionStore] = None, handle: t.Optional[str] = None, password: t.Optional[str] = None):
     sleep_duration = initial_wait
     max_sleep_duration = 3600  # 1 hour
 
     while True:
         try:
-            client.login(HANDLE, PASSWORD)
+            # createSessionは厳しくレート制限されるので、できるだけ保存済みのセッションをリフレッシュして使う
+            if session_store is not None and resume_session(client, session_store):
+                return
+            client.login(handle or HANDLE, password or PASSWORD)
+            if session_store is not None:
+                session_store.save(client)
             return  # if login is successful, exit the loop
         except Exception as e:
             logging.exception(f"An error occurred during login: {e}")
@@ -162,19 +864,305 @@ def login(client: Client, initial_wait: int):
             sleep_duration *= 2  # double the sleep duration on failure
 
 
+def create_services(rate_share: float = 1.0, shared: bool = False, read_share: t.Optional[float] = None) -> Services:
+    # shared: 複数のアカウントで共有する分だけを作る。返信済みの記録とOutboxはaccount_servicesでアカウントごとに開く
+    services = Services(
+        replied_index=None if shared else RepliedIndex(os.path.join(STATE_DIR, "replied.sqlite3")),
+        thread_cache=ThreadCache(THREAD_CACHE_MAX_ENTRIES, THREAD_CACHE_TTL, THREAD_CACHE_MAX_BYTES),
+        scheduler=PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL),
+        outbox=None if shared else Outbox(os.path.join(STATE_DIR, "outbox.sqlite3")),
+        rate_limiter=RateLimiter(PDS_READ_RATE, write_rate=PDS_WRITE_RATE, llm_requests_per_minute=LLM_REQUESTS_PER_MINUTE, llm_tokens_per_minute=LLM_TOKENS_PER_MINUTE, share=rate_share, read_share=read_share),
+        reply_policy=ReplyPolicy(REASON_WEIGHTS, AUTHOR_WEIGHTS, PRIORITY_HALF_LIFE, REPLY_DEADLINE, REPLY_DEADLINE_ACTION, BACKLOG_HIGH_WATER),
+        transport=Transport(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, LLM_READ_TIMEOUT, HTTP_POOL_SIZE, retries=HTTP_RETRIES, http2=HTTP2),
+        summaries=SummaryStore(SUMMARY_THRESHOLD, SUMMARY_KEEP_RECENT),
+        reply_cache=ReplyCache(REPLY_CACHE_MAX_ENTRIES, REPLY_CACHE_TTL, REPLY_CACHE_MAX_DEPTH, os.path.join(STATE_DIR, "reply_cache.sqlite3") if REPLY_CACHE_PERSIST else None),
+        profiler=Profiler(PROFILE_DIR, PROFILE_CYCLES, PROFILE_MODE, PROFILE_SAMPLE_INTERVAL, PROFILE_MEMORY, PROFILE_TRIGGER),
+    )
+    if PROFILE_AT_START:
+        services.profiler.request()
+    services.llm = create_router(services)
+    return services
+
+
+def create_stream(did: str):
+    # httpx_wsの読み込みを、streamモードのときだけにする
+    from bsky_aibot.firehose import RepoStream
+
+    kwargs = {} if FIREHOSE_URL is None else {"url": FIREHOSE_URL}
+    return RepoStream(did, cursor_path=os.path.join(STATE_DIR, "firehose_cursor"), **kwargs)
+
+
+def start_metrics():
+    METRICS.enabled = METRICS_ENABLED
+    if METRICS_PORT is not None:
+        METRICS.serve(int(METRICS_PORT))
+
+
+def profile_cycle(services: Services) -> t.ContextManager[None]:
+    return contextlib.nullcontext() if services.profiler is None else services.profiler.cycle()
+
+
+def log_cycle_summary():
+    if METRICS.enabled:
+        logging.info(f"cycle: {METRICS.cycle_summary()}")
+
+
+def run_once():
+    # cronなどから1回だけ実行する。チェックポイントを読み、1バッチ処理して保存したら終わる
+    METRICS.enabled = METRICS_ENABLED
+    services = create_services()
+    client = Client()
+    services.transport.install(client)
+    services.rate_limiter.install(client)
+    session_store = SessionStore(os.path.join(STATE_DIR, "session.json"))
+    login(client, initial_wait=1, session_store=session_store)
+    checkpoint_path = os.path.join(STATE_DIR, "checkpoint")
+    with profile_cycle(services):
+        seen_at = read_notifications_and_reply(client, load_checkpoint(checkpoint_path), services=services)
+    save_checkpoint(checkpoint_path, seen_at)
+    session_store.save_if_changed(client)
+    log_cycle_summary()
+
+
+def handle_cycle_error(e: Exception, client: Client, services: Services, session_store: SessionStore, account: t.Optional[Account] = None):
+    logging.exception(f"An error occurred: {e}")
+    if isinstance(e, RequestErrorBase) and e.response is not None:
+        # レート制限ならRetry-Afterなどで指定された時刻まで次のポーリングを遅らせる
+        services.scheduler.observe_headers(e.response.headers)
+        if e.response.status_code == 429:
+            return  # セッションは有効なので、ログインし直さない
+    if account is None:
+        login(client, initial_wait=60, session_store=session_store)
+    else:
+        login(client, initial_wait=60, session_store=session_store, handle=account.handle, password=account.password)
+
+
+def handle_reply_error(e: Exception, client: Client, services: Services, session_store: SessionStore):
+    # streamモードで1件の返信に失敗したとき。購読は続け、PDSのエラー(セッション切れなど)だけはポーリングのサイクルと同じように扱う
+    METRICS.inc("reply_errors_total")
+    if isinstance(e, RequestErrorBase):
+        handle_cycle_error(e, client, services, session_store)
+    else:
+        logging.error(f"Could not reply: {e!r}", exc_info=e)
+
+
+def stream_housekeeping(
+    client: Client,
+    services: Services,
+    session_store: SessionStore,
+    checkpoint_path: str,
+    interval: float = STREAM_HOUSEKEEPING_INTERVAL,
+    clock: t.Callable[[], float] = time.monotonic,
+) -> t.Callable[[], None]:
+    # 接続している間はポーリングのサイクルが回らないので、その後始末をinterval秒ごとに行う関数を返す(RepoStreamのon_tickに渡す)
+    # 既読とチェックポイントは前回実行した時刻まで進める。それより後に届いた通知には、まだ返信している途中かもしれない
+    last_run = clock()
+    previous = datetime.now(tz=timezone.utc)
+
+    def tick():
+        nonlocal last_run, previous
+        if clock() - last_run < interval:
+            return
+        last_run = clock()
+        seen_at, previous = previous, datetime.now(tz=timezone.utc)
+        try:
+            if services.outbox is not None:
+                # 追加されたばかりのものは、返信のスレッドが送っている途中かもしれないので除く
+                flush_outbox(client, services, older_than=interval)
+                services.outbox.compact()
+            if services.replied_index is not None:
+                services.replied_index.compact()
+            update_seen(client, seen_at)
+            save_checkpoint(checkpoint_path, seen_at)
+            session_store.save_if_changed(client)
+        except Exception as e:
+            logging.warning(f"Housekeeping failed while streaming: {e!r}")
+
+    return tick
+
+
+def worker_main(index: int, stop) -> None:
+    # ワーカープロセス。SIGTERMやCtrl-Cは親が受け、キューを空にしてからstopで止める
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    parent = os.getppid()
+    # 読み込みの上限のPOLLER_READ_SHAREは通知を取得する親が使うので、残りをワーカーで分ける
+    workers = max(1, WORKER_PROCESSES)
+    services = create_services(rate_share=1 / workers, read_share=(1 - POLLER_READ_SHARE) / workers)
+    services.profiler.install_signal()  # ワーカーのpidに送る
+    client = Client()
+    services.transport.install(client)
+    services.rate_limiter.install(client)
+    session_store = SessionStore(os.path.join(STATE_DIR, "session.json"))
+    queue = WorkQueue(os.path.join(STATE_DIR, "work_queue.sqlite3"), WORK_QUEUE_LEASE)
+    lock = threading.Lock()
+
+    def handle(payloads: t.List[str]):
+        with lock:
+            # 親がリフレッシュしたセッションに切り替える
+            if not attach_session(client, session_store):
+                raise RuntimeError("No session has been saved yet")
+        # ワーカーではスレッド1つ分の処理を1サイクルとしてプロファイルする
+        with profile_cycle(services):
+            reply_to_thread_notifications(client, [decode_notification(p) for p in payloads], client.me.did, services)
+
+    def should_stop() -> bool:
+        return stop.is_set() or os.getppid() != parent  # 親が落ちたら止まる
+
+    threads = max(1, MAX_IN_FLIGHT)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(work, queue, str(os.getpid()), handle, should_stop) for _ in range(threads)]
+        processed = sum(future.result() for future in futures)
+    logging.info(f"Worker {index} stopped after {processed} notifications")
+    queue.close()
+
+
+def run_workers():
+    # 通知を取得してキューに積むプロセス。返信はWORKER_PROCESSES個のワーカープロセスが行う
+    start_metrics()
+    # 親は通知の取得(読み込み)だけをする。書き込みはワーカーを起動する前のflush_outboxだけで、LLMは使わない
+    services = create_services(read_share=POLLER_READ_SHARE)
+    client = Client()
+    services.transport.install(client)
+    services.rate_limiter.install(client)
+    session_store = SessionStore(os.path.join(STATE_DIR, "session.json"))
+    login(client, initial_wait=1, session_store=session_store)
+    if INGESTION_MODE == "stream":
+        logging.warning("INGESTION_MODE=stream is not supported with WORKER_PROCESSES; polling instead")
+    # 前回送れなかった返信は、ワーカーを起動する前に送っておく
+    flush_outbox(client, services)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    services.scheduler.sleep = stopping.wait  # 待っている間にSIGTERMを受けたらすぐに止める
+    services.profiler.install_signal()
+
+    queue = WorkQueue(os.path.join(STATE_DIR, "work_queue.sqlite3"), WORK_QUEUE_LEASE)
+    pool = WorkerPool(worker_main, WORKER_PROCESSES, queue)
+    pool.start()
+    checkpoint_path = os.path.join(STATE_DIR, "checkpoint")
+    seen_at = load_checkpoint(checkpoint_path)
+    try:
+        while not stopping.is_set():
+            try:
+                with profile_cycle(services):
+                    seen_at = enqueue_notifications(client, seen_at, queue, services)
+                save_checkpoint(checkpoint_path, seen_at)
+                # ワーカーはこのファイルのセッションを使う
+                session_store.save_if_changed(client)
+            except Exception as e:
+                handle_cycle_error(e, client, services, session_store)
+            finally:
+                log_cycle_summary()
+                services.scheduler.wait()
+    finally:
+        logging.info(f"Draining {queue.pending()} queued notifications")
+        if not pool.drain(DRAIN_TIMEOUT):
+            logging.warning(f"Stopped with {queue.pending()} notifications left in the queue")
+        pool.stop()
+        queue.close()
+
+
+def account_services(shared: Services, account: Account, fair_share: FairShare, backends: t.Dict[str, Backend]) -> Services:
+    # 接続、読み込みとLLMのレート制限、スレッドのキャッシュ、LLMのバックエンドは共有する
+    # 返信済みかどうかはアカウントごとに違うので、RepliedIndexとOutboxはアカウントごとに持つ
+    state_dir = os.path.join(STATE_DIR, "accounts", account.handle)
+    services = dataclasses.replace(
+        shared,
+        replied_index=RepliedIndex(os.path.join(state_dir, "replied.sqlite3")),
+        scheduler=PollScheduler(POLL_MIN_INTERVAL, POLL_MAX_INTERVAL),
+        outbox=Outbox(os.path.join(state_dir, "outbox.sqlite3")),
+        rate_limiter=shared.rate_limiter.for_account(),
+        account=account.handle,
+        system_prompt=account.system_prompt,
+        fair_share=fair_share,
+    )
+    services.llm = create_router(services, parse_routes(account.routes) if account.routes else None, backends)
+    return services
+
+
+def run_account(account: Account, services: Services):
+    # アカウントごとのスレッドで、mainと同じようにポーリングして返信する
+    client = Client()
+    services.transport.install(client)
+    services.rate_limiter.install(client)
+    state_dir = os.path.join(STATE_DIR, "accounts", account.handle)
+    session_store = SessionStore(os.path.join(state_dir, "session.json"))
+    login(client, initial_wait=1, session_store=session_store, handle=account.handle, password=account.password)
+    checkpoint_path = os.path.join(state_dir, "checkpoint")
+    seen_at = load_checkpoint(checkpoint_path)
+    while True:
+        try:
+            with profile_cycle(services):
+                seen_at = read_notifications_and_reply(client, seen_at, services=services)
+            save_checkpoint(checkpoint_path, seen_at)
+            session_store.save_if_changed(client)
+        except Exception as e:
+            handle_cycle_error(e, client, services, session_store, account)
+        finally:
+            services.scheduler.wait()
+
+
+def run_accounts(path: str):
+    start_metrics()
+    accounts = load_accounts(path)
+    shared = create_services(shared=True)
+    shared.profiler.install_signal()
+    # 同時に処理するスレッド数(MAX_IN_FLIGHT)は全アカウントで共有し、重みの比で分ける
+    fair_share = FairShare(max(1, MAX_IN_FLIGHT), {account.handle: account.weight for account in accounts})
+    backends = dict(shared.llm.backends)
+    threads = []
+    for account in accounts:
+        services = account_services(shared, account, fair_share, backends)
+        thread = threading.Thread(target=run_account, args=(account, services), name=account.handle, daemon=True)
+        thread.start()
+        threads.append(thread)
+    logging.info(f"Running {len(accounts)} accounts")
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(60)
+        log_cycle_summary()
+
+
 def main():
+    if ACCOUNTS_FILE is not None:
+        return run_accounts(ACCOUNTS_FILE)
+    if WORKER_PROCESSES > 0:
+        return run_workers()
+    start_metrics()
+    services = create_services()
+    services.profiler.install_signal()
     client = Client()
-    login(client, initial_wait=1)
-    seen_at = None
+    services.transport.install(client)
+    # ログインも含めてすべてのXRPC呼び出しを制限する
+    services.rate_limiter.install(client)
+    session_store = SessionStore(os.path.join(STATE_DIR, "session.json"))
+    login(client, initial_wait=1, session_store=session_store)
+    stream = create_stream(client.me.did) if INGESTION_MODE == "stream" else None
+    checkpoint_path = os.path.join(STATE_DIR, "checkpoint")
+    seen_at = load_checkpoint(checkpoint_path)
     while True:
         try:
-            seen_at = read_notifications_and_reply(client, seen_at)
+            with profile_cycle(services):
+                seen_at = read_notifications_and_reply(client, seen_at, services=services)
+            save_checkpoint(checkpoint_path, seen_at)
+            session_store.save_if_changed(client)
+            if stream is not None:
+                # ポーリングで取りこぼしを拾ってから購読する。切断されたら次のループでまたポーリングする
+                stream.on_tick = stream_housekeeping(client, services, session_store, checkpoint_path)
+                on_error = functools.partial(handle_reply_error, client=client, services=services, session_store=session_store)
+                reply_to_notifications(client, stream, client.me.did, services=services, on_error=on_error)
+                # 接続している間に進めたチェックポイントから、またポーリングする
+                seen_at = load_checkpoint(checkpoint_path) or seen_at
         except Exception as e:
-            logging.exception(f"An error occurred: {e}")
-            login(client, initial_wait=60)
+            handle_cycle_error(e, client, services, session_store)
         finally:
-            time.sleep(10)
+            log_cycle_summary()
+            services.scheduler.wait()
 
 
 if __name__ == "__main__":
-    main()
+    if "--once" in sys.argv[1:]:
+        run_once()
+    else:
+        main()
@@ -0,0 +1,22 @@
+import os
+import typing as t
+from datetime import datetime
+
+
+def load_checkpoint(path: str) -> t.Optional[datetime]:
+    try:
+        with open(path) as f:
+            return datetime.fromisoformat(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_checkpoint(path: str, seen_at: datetime):
+    # 書き込み途中で落ちても壊れたファイルが残らないよう、一時ファイルに書いてから置き換える
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(seen_at.isoformat())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
@@ -0,0 +1,87 @@
+import functools
+import typing as t
+
+# <https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb>
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def estimate_tokens(text: str) -> int:
+    # tiktokenが無いときの概算。英数字はおよそ4文字で1トークン、日本語などは1文字1トークン程度
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+@functools.lru_cache(maxsize=4096)
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(message: t.Mapping[str, t.Any], model: str = "gpt-4") -> int:
+    tokens = TOKENS_PER_MESSAGE + count_tokens(message.get("content") or "", model)
+    if message.get("name"):
+        tokens += TOKENS_PER_NAME + count_tokens(message["name"], model)
+    return tokens
+
+
+def count_messages_tokens(messages: t.Sequence[t.Mapping[str, t.Any]], model: str = "gpt-4") -> int:
+    return sum(count_message_tokens(m, model) for m in messages) + TOKENS_PER_REPLY
+
+
+def elision_message(omitted: int) -> t.Dict[str, str]:
+    return {"role": "system", "content": f"({omitted} earlier posts in this thread are omitted.)"}
+
+
+def build_context(
+    system_messages: t.List[t.Dict],
+    post_messages: t.List[t.Dict],
+    budget: int,
+    recent_turns: int,
+    model: str = "gpt-4",
+) -> t.Tuple[t.List[t.Dict], int]:
+    # システムプロンプト、スレッドの最初の投稿、直近recent_turns件は残し、間の投稿を予算に収まるまで省く
+    # 戻り値は(送るメッセージ, 省いたトークン数)
+    full = count_messages_tokens(system_messages + post_messages, model)
+    if full <= budget or len(post_messages) <= 1:
+        return system_messages + post_messages, 0
+
+    root, rest = post_messages[:1], post_messages[1:]
+    recent = rest[-recent_turns:] if recent_turns > 0 else []
+    middle = rest[: len(rest) - len(recent)]
+
+    def assemble(root, kept_middle, recent) -> t.List[t.Dict]:
+        omitted = len(post_messages) - len(root) - len(kept_middle) - len(recent)
+        elision = [elision_message(omitted)] if omitted > 0 else []
+        return system_messages + root + elision + kept_middle + recent
+
+    # 直近だけでも予算を超えるなら、古い方から削る。最後の1件と根の投稿は最後まで残す
+    while len(recent) > 1 and count_messages_tokens(assemble(root, [], recent), model) > budget:
+        recent = recent[1:]
+    if count_messages_tokens(assemble(root, [], recent), model) > budget:
+        root = []
+
+    # 余った予算で、直近に近い方から間の投稿を戻す
+    kept_middle: t.List[t.Dict] = []
+    for message in reversed(middle):
+        if count_messages_tokens(assemble(root, [message] + kept_middle, recent), model) > budget:
+            break
+        kept_middle.insert(0, message)
+
+    messages = assemble(root, kept_middle, recent)
+    return messages, full - count_messages_tokens(messages, model)
@@ -0,0 +1,131 @@
+import logging
+import os
+import queue
+import time
+import typing as t
+from dataclasses import dataclass
+
+import httpx
+from atproto import CAR, models
+from atproto.exceptions import FirehoseError
+from atproto.firehose import parse_subscribe_repos_message
+from atproto.firehose.models import ErrorFrame, Frame
+from atproto.xrpc_client.models import ids
+from atproto.xrpc_client.models.utils import get_or_create
+from httpx_ws import HTTPXWSException, connect_ws
+
+FIREHOSE_URL = "wss://bsky.social/xrpc/com.atproto.sync.subscribeRepos"
+MAX_MESSAGE_SIZE_BYTES = 5 * 1024 * 1024
+
+
+@dataclass
+class StreamNotification:
+    # listNotificationsの通知のうち、返信処理で使う項目だけを持つ
+    uri: str
+    cid: str
+    reason: str
+    indexedAt: str
+    record: models.AppBskyFeedPost.Main
+
+
+def load_cursor(path: str) -> t.Optional[int]:
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_cursor(path: str, seq: int):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        f.write(str(seq))
+    os.replace(tmp, path)
+
+
+def notification_reason(record: models.AppBskyFeedPost.Main, did: str) -> t.Optional[str]:
+    # AppViewと同じく、親か根が自分の投稿なら返信とする(自分が始めたスレッドの深いところへの返信も含める)
+    if record.reply is not None and (record.reply.parent.uri.startswith(f"at://{did}/") or record.reply.root.uri.startswith(f"at://{did}/")):
+        return "reply"
+    for facet in record.facets or []:
+        for feature in facet.features:
+            if getattr(feature, "did", None) == did:
+                return "mention"
+    return None
+
+
+def commit_to_notifications(commit: models.ComAtprotoSyncSubscribeRepos.Commit, did: str) -> t.Iterator[StreamNotification]:
+    if commit.repo == did or commit.tooBig:
+        return
+    ops = [op for op in commit.ops if op.action == "create" and op.path.startswith(f"{ids.AppBskyFeedPost}/")]
+    if len(ops) == 0:
+        return  # 投稿の作成を含まないコミットはCARをデコードしない
+
+    car = CAR.from_bytes(commit.blocks)
+    for op in ops:
+        raw = car.blocks.get(op.cid)
+        if raw is None:
+            continue
+        record = get_or_create(raw, strict=False)
+        if not isinstance(record, models.AppBskyFeedPost.Main):
+            continue  # 独自フィールドを持つレコードなど、SDKのモデルに変換できないもの
+        reason = notification_reason(record, did)
+        if reason is not None:
+            yield StreamNotification(uri=f"at://{commit.repo}/{op.path}", cid=str(op.cid), reason=reason, indexedAt=commit.time, record=record)
+
+
+class RepoStream:
+    # subscribeReposを購読し、自分宛てのメンションと返信だけを通知として流す
+    # 切断されたらイテレーションを終える。次に購読するときは保存したカーソルから再開する
+    def __init__(
+        self,
+        did: str,
+        url: str = FIREHOSE_URL,
+        cursor_path: t.Optional[str] = None,
+        cursor_save_interval: float = 5.0,
+        receive_timeout: float = 30.0,
+        connect: t.Callable = connect_ws,
+        clock: t.Callable[[], float] = time.monotonic,
+        on_tick: t.Optional[t.Callable[[], None]] = None,
+    ):
+        self.did = did
+        self.url = url
+        self.cursor_path = cursor_path
+        self.cursor_save_interval = cursor_save_interval
+        # ネットワーク全体のイベントが流れてくるので、しばらく何も届かなければ切断されたとみなす
+        self.receive_timeout = receive_timeout
+        self.connect = connect
+        self.clock = clock
+        # フレームを受け取るたび(自分宛てでなくても)に呼ぶ。接続している間の定期的な処理に使う
+        self.on_tick = on_tick
+        self.seq = load_cursor(cursor_path) if cursor_path is not None else None
+        self.dropped = False
+
+    def __iter__(self) -> t.Iterator[StreamNotification]:
+        self.dropped = False
+        params = {} if self.seq is None else {"cursor": self.seq}
+        saved_at = self.clock()
+        try:
+            with self.connect(self.url, params=params, max_message_size_bytes=MAX_MESSAGE_SIZE_BYTES) as ws:
+                logging.info(f"Subscribed to {self.url} from cursor {self.seq}")
+                while True:
+                    frame = Frame.from_bytes(ws.receive_bytes(timeout=self.receive_timeout))
+                    if self.on_tick is not None:
+                        self.on_tick()
+                    if isinstance(frame, ErrorFrame):
+                        raise FirehoseError(f"{frame.body.error}: {frame.body.message}")
+                    if frame.type != "#commit":
+                        continue
+                    commit = parse_subscribe_repos_message(frame)
+                    yield from commit_to_notifications(commit, self.did)
+                    self.seq = commit.seq
+                    if self.cursor_path is not None and self.clock() - saved_at >= self.cursor_save_interval:
+                        save_cursor(self.cursor_path, self.seq)
+                        saved_at = self.clock()
+        except (HTTPXWSException, httpx.HTTPError, FirehoseError, queue.Empty) as e:
+            logging.warning(f"Repo stream dropped at cursor {self.seq}: {e}")
+            self.dropped = True
+        finally:
+            if self.cursor_path is not None and self.seq is not None:
+                save_cursor(self.cursor_path, self.seq)
@@ -0,0 +1,257 @@
+import abc
+import hashlib
+import logging
+import threading
+import time
+import typing as t
+from dataclasses import dataclass
+
+from bsky_aibot.context import count_messages_tokens
+from bsky_aibot.metrics import METRICS
+from bsky_aibot.rate_limit import LLM_REQUESTS, LLM_TOKENS, RateLimiter
+from bsky_aibot.streaming import POST_MAX_GRAPHEMES, GenerationTiming, read_stream, truncate_graphemes
+
+# 返信の分として見込むトークン数(300書記素程度)
+COMPLETION_TOKENS = 400
+
+
+class Backend(abc.ABC):
+    # 返信を生成するLLM。timeoutは最初のトークン(ストリーミングでなければ応答)を待つ秒数
+    name: str
+
+    @abc.abstractmethod
+    def generate(self, messages: t.List[t.Dict], timeout: t.Optional[float] = None) -> t.Tuple[str, GenerationTiming]:
+        ...
+
+
+_responses = threading.local()
+
+
+def capture_response(response, *args, **kwargs):
+    # openaiはrequestsのResponseを返さないので、このスレッドで最後に受け取ったものを覚えておく
+    _responses.last = response
+
+
+def install_response_capture(openai) -> None:
+    # openaiがスレッドごとに作るセッションに、capture_responseのフックを足す(Transport, RateLimiterのフックとは重ねて使える)
+    import requests
+
+    factory = openai.requestssession
+    if getattr(factory, "captures_responses", False):
+        return
+    if isinstance(factory, requests.Session):
+        if capture_response not in factory.hooks["response"]:
+            factory.hooks["response"].append(capture_response)
+        return
+
+    def session() -> requests.Session:
+        s = factory() if callable(factory) else requests.Session()
+        s.hooks["response"].append(capture_response)
+        return s
+
+    session.captures_responses = True
+    openai.requestssession = session
+
+
+def extend_read_timeout(response, seconds: float) -> None:
+    # 応答を受け取り始めた後は、チャンクの間隔をseconds秒まで待つ(urllib3の接続のソケットに設定する)
+    # Connection: closeの応答では、接続はソケットを手放していてhttp.clientの応答だけが持っている
+    raw = getattr(response, "raw", None)
+    sock = getattr(getattr(raw, "_connection", None), "sock", None)
+    if sock is None:
+        sock = getattr(getattr(getattr(getattr(raw, "_fp", None), "fp", None), "raw", None), "_sock", None)
+    if sock is not None:
+        sock.settimeout(seconds)
+
+
+class OpenAIBackend(Backend):
+    # OpenAI、またはapi_baseを指定してOpenAI互換のローカルサーバー(llama.cpp, vLLM, Ollamaなど)を使う
+    def __init__(
+        self,
+        model: str,
+        get_openai: t.Callable[[], t.Any],
+        stream: bool = True,
+        api_base: t.Optional[str] = None,
+        api_key: t.Optional[str] = None,
+        rate_limiter: t.Optional[RateLimiter] = None,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 120.0,
+        name: t.Optional[str] = None,
+    ):
+        self.name = name or model
+        self.model = model
+        self.get_openai = get_openai
+        self.stream = stream
+        self.api_base = api_base
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def generate(self, messages: t.List[t.Dict], timeout: t.Optional[float] = None) -> t.Tuple[str, GenerationTiming]:
+        # <https://platform.openai.com/docs/api-reference/chat/create>
+        openai = self.get_openai()
+        install_response_capture(openai)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(LLM_REQUESTS)
+            self.rate_limiter.acquire(LLM_TOKENS, count_messages_tokens(messages) + COMPLETION_TOKENS)
+        kwargs = {}
+        if self.api_base is not None:
+            kwargs.update(api_base=self.api_base, api_key=self.api_key or "local")
+
+        started_at = time.monotonic()
+        if not self.stream:
+            # 応答の最初のバイトは生成がすべて終わってから届くので、timeout(予備に切り替えるまでの秒数)は使わない
+            chat_completion = openai.ChatCompletion.create(model=self.model, messages=messages, request_timeout=(self.connect_timeout, self.read_timeout), **kwargs)
+            text = truncate_graphemes(chat_completion.choices[0].message.content, POST_MAX_GRAPHEMES)
+            return text, GenerationTiming(None, time.monotonic() - started_at, False)
+
+        # timeoutは応答の最初のバイト(ヘッダー)までの待ち時間にだけ使い、その後はread_timeoutまで待つ
+        _responses.last = None
+        chunks = openai.ChatCompletion.create(model=self.model, messages=messages, stream=True, request_timeout=(self.connect_timeout, timeout or self.read_timeout), **kwargs)
+        response = _responses.last
+        if timeout is not None and response is not None:
+            extend_read_timeout(response, self.read_timeout)
+        try:
+            return read_stream((chunk.choices[0].delta.get("content") for chunk in chunks), POST_MAX_GRAPHEMES, started_at)
+        finally:
+            # 途中で打ち切ったときは、ジェネレータだけでなくHTTPの応答も閉じてリクエストを止め、接続を解放する
+            chunks.close()
+            if response is not None:
+                response.close()
+
+
+class StubBackend(Backend):
+    # ネットワークを使わない決定的な返信。負荷試験やオフラインでの動作確認に使う
+    def __init__(self, name: str = "stub", latency: float = 0.0, sleep: t.Callable[[float], None] = time.sleep):
+        self.name = name
+        self.latency = latency
+        self.sleep = sleep
+
+    def reply_for(self, messages: t.List[t.Dict]) -> str:
+        last = messages[-1] if messages else {}
+        digest = hashlib.sha256((last.get("content") or "").encode()).hexdigest()[:8]
+        return f"Thanks for your post, {last.get('name') or 'friend'}! This is a canned reply ({digest})."
+
+    def generate(self, messages: t.List[t.Dict], timeout: t.Optional[float] = None) -> t.Tuple[str, GenerationTiming]:
+        started_at = time.monotonic()
+        if self.latency > 0:
+            if timeout is not None and self.latency > timeout:
+                self.sleep(timeout)
+                raise TimeoutError(f"{self.name} did not respond in {timeout}s")
+            self.sleep(self.latency)
+        words = self.reply_for(messages).split(" ")
+        return read_stream([w if i == 0 else " " + w for i, w in enumerate(words)], POST_MAX_GRAPHEMES, started_at)
+
+
+@dataclass
+class Route:
+    # 条件をすべて満たすスレッドをbackendに送る。Noneの条件は見ない
+    backend: str
+    max_messages: t.Optional[int] = None
+    max_tokens: t.Optional[int] = None
+    # backendの最近の応答時間がこれを超えていたら、次のルートを使う
+    latency_budget: t.Optional[float] = None
+
+
+def parse_routes(value: str) -> t.List[Route]:
+    # "gpt-3.5-turbo?messages<=4&latency<=3,gpt-4" のような形式。先に書いたものから順に試す
+    keys = {"messages": "max_messages", "tokens": "max_tokens", "latency": "latency_budget"}
+    routes = []
+    for item in value.split(","):
+        name, _, query = item.strip().partition("?")
+        kwargs = {}
+        for condition in filter(None, query.split("&")):
+            key, _, limit = condition.partition("<=")
+            if key not in keys or not limit:
+                raise ValueError(f"Unknown routing condition: {condition}")
+            kwargs[keys[key]] = float(limit) if key == "latency" else int(limit)
+        if name:
+            routes.append(Route(name, **kwargs))
+    return routes
+
+
+class Router:
+    # スレッドの長さと各バックエンドの応答時間でバックエンドを選び、遅いときや失敗したときは予備に切り替える
+    def __init__(
+        self,
+        backends: t.Dict[str, Backend],
+        routes: t.List[Route],
+        fallback: t.Optional[str] = None,
+        fallback_timeout: t.Optional[float] = None,
+        smoothing: float = 0.2,
+        probe_interval: float = 60.0,
+        clock: t.Callable[[], float] = time.monotonic,
+    ):
+        self.backends = backends
+        self.routes = routes
+        self.fallback = fallback
+        self.fallback_timeout = fallback_timeout
+        self.smoothing = smoothing
+        self.probe_interval = probe_interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        # バックエンドごとの応答時間の指数移動平均
+        self.latency: t.Dict[str, float] = {}
+        self.decisions: t.Dict[t.Tuple[str, str], int] = {}
+        self.last_used: t.Dict[str, float] = {}
+
+    def names(self) -> t.List[str]:
+        # 返信を生成しうるバックエンドの名前。ルートの順で、最後に予備
+        names = [route.backend for route in self.routes]
+        return names + [self.fallback] if self.fallback is not None else names
+
+    def record_latency(self, name: str, seconds: float):
+        METRICS.observe("llm_duration_seconds", seconds, backend=name)
+        with self._lock:
+            previous = self.latency.get(name)
+            self.latency[name] = seconds if previous is None else previous + self.smoothing * (seconds - previous)
+
+    def record_decision(self, name: str, reason: str):
+        METRICS.inc("llm_routed_total", backend=name, reason=reason)
+        with self._lock:
+            self.decisions[(name, reason)] = self.decisions.get((name, reason), 0) + 1
+            self.last_used[name] = self.clock()
+
+    def too_slow(self, route: Route) -> bool:
+        # 遅いと判断したバックエンドも、probe_intervalごとに1回は使って応答時間を測り直す
+        if route.latency_budget is None or self.latency.get(route.backend, 0.0) <= route.latency_budget:
+            return False
+        return self.clock() - self.last_used.get(route.backend, 0.0) < self.probe_interval
+
+    def select(self, messages: int, tokens: int) -> str:
+        for route in self.routes:
+            if route.max_messages is not None and messages > route.max_messages:
+                continue
+            if route.max_tokens is not None and tokens > route.max_tokens:
+                continue
+            if self.too_slow(route):
+                continue
+            return route.backend
+        return self.routes[-1].backend
+
+    def generate(self, messages: t.List[t.Dict], thread_length: int) -> t.Tuple[str, GenerationTiming, str]:
+        name = self.select(thread_length, count_messages_tokens(messages))
+        use_fallback = self.fallback is not None and self.fallback != name
+        self.record_decision(name, "route")
+        started_at = time.monotonic()
+        try:
+            text, timing = self.backends[name].generate(messages, self.fallback_timeout if use_fallback else None)
+        except Exception as e:
+            self.record_latency(name, time.monotonic() - started_at)
+            if not use_fallback:
+                raise
+            logging.warning(f"{name} failed ({e!r}), falling back to {self.fallback}")
+            name = self.fallback
+            self.record_decision(name, "fallback")
+            started_at = time.monotonic()
+            text, timing = self.backends[name].generate(messages)
+        self.record_latency(name, time.monotonic() - started_at)
+        return text, timing, name
+
+    def stats(self) -> t.Dict[str, t.Any]:
+        with self._lock:
+            return {
+                "latency": {name: round(seconds, 3) for name, seconds in self.latency.items()},
+                "decisions": {f"{name}/{reason}": count for (name, reason), count in sorted(self.decisions.items())},
+            }
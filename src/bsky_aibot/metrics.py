@@ -0,0 +1,177 @@
+import bisect
+import logging
+import threading
+import time
+import typing as t
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = t.Tuple[t.Tuple[str, str], ...]
+
+
+class Histogram:
+    def __init__(self, buckets: t.Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        # 1サイクル分の集計。cycle_summaryで読んだらリセットする
+        self.cycle_sum = 0.0
+        self.cycle_count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.cycle_sum += value
+        self.cycle_count += 1
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics: "Metrics", stage: str, tracer=None):
+        self.metrics = metrics
+        self.stage = stage
+        self.tracer = tracer
+
+    def __enter__(self):
+        if self.tracer is not None:
+            self.span = self.tracer.begin(self.stage)
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe("stage_duration_seconds", time.perf_counter() - self.started_at, stage=self.stage)
+        if exc_type is not None:
+            self.metrics.inc("stage_errors_total", stage=self.stage)
+        if self.tracer is not None:
+            self.tracer.end(self.span, exc_type is not None)
+        return False
+
+
+class Metrics:
+    # 無効のときは何も記録せず、計測のコストがかからないようにする
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: t.Dict[str, t.Dict[Labels, float]] = {}
+        self._gauges: t.Dict[str, t.Dict[Labels, float]] = {}
+        self._histograms: t.Dict[str, t.Dict[Labels, Histogram]] = {}
+        self._cycle_counters: t.Dict[t.Tuple[str, Labels], float] = {}
+        # プロファイル中だけ設定され、time()の区間をステージ名付きで記録する(bsky_aibot.profiling.Capture)
+        self.tracer = None
+
+    def time(self, stage: str) -> t.Union[_Timer, _NullTimer]:
+        tracer = self.tracer
+        if tracer is not None:
+            return _Timer(self, stage, tracer)
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, stage)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+            self._cycle_counters[(name, key)] = self._cycle_counters.get((name, key), 0) + value
+
+    def add_gauge(self, name: str, value: float, **labels: str):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str):
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def exposition(self) -> str:
+        # <https://prometheus.io/docs/instrumenting/exposition_formats/>
+        def format_labels(labels: Labels, extra: t.Optional[t.Tuple[str, str]] = None) -> str:
+            pairs = list(labels) + ([extra] if extra else [])
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE bsky_aibot_{name} counter")
+                lines.extend(f"bsky_aibot_{name}{format_labels(labels)} {value}" for labels, value in sorted(series.items()))
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE bsky_aibot_{name} gauge")
+                lines.extend(f"bsky_aibot_{name}{format_labels(labels)} {value}" for labels, value in sorted(series.items()))
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE bsky_aibot_{name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append(f"bsky_aibot_{name}_bucket{format_labels(labels, ('le', str(bound)))} {cumulative}")
+                    lines.append(f"bsky_aibot_{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(f"bsky_aibot_{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def cycle_summary(self) -> str:
+        # 前回呼ばれてからの各ステージの回数と平均時間、カウンタの増分を1行にまとめる
+        if not self.enabled:
+            return ""
+        parts = []
+        with self._lock:
+            for labels, histogram in sorted(self._histograms.get("stage_duration_seconds", {}).items()):
+                if histogram.cycle_count > 0:
+                    stage = dict(labels).get("stage")
+                    parts.append(f"{stage}={histogram.cycle_count}x{histogram.cycle_sum / histogram.cycle_count:.2f}s")
+                histogram.cycle_sum = 0.0
+                histogram.cycle_count = 0
+            for (name, labels), value in sorted(self._cycle_counters.items()):
+                suffix = ",".join(v for _, v in labels)
+                parts.append(f"{name}{'[' + suffix + ']' if suffix else ''}={value:g}")
+            self._cycle_counters.clear()
+        return " ".join(parts)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+
+METRICS = Metrics()
@@ -0,0 +1,142 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+import typing as t
+from dataclasses import dataclass
+
+TID_ALPHABET = "234567abcdefghijklmnopqrstuvwxyz"
+
+
+def new_tid(now: t.Optional[float] = None, clock_id: t.Optional[int] = None) -> str:
+    # <https://atproto.com/specs/record-key#record-key-type-tid>
+    micros = int((time.time() if now is None else now) * 1_000_000)
+    clock_id = random.getrandbits(10) if clock_id is None else clock_id
+    n = (micros << 10) | clock_id
+    return "".join(TID_ALPHABET[(n >> (5 * i)) & 31] for i in reversed(range(13)))
+
+
+@dataclass
+class OutboxItem:
+    # key: 返信先の通知のURI。rkey: 作成する投稿のレコードキー(再送しても同じ投稿になる)
+    key: str
+    rkey: str
+    text: str
+    root_uri: str
+    root_cid: str
+    parent_uri: str
+    parent_cid: str
+    attempts: int = 0
+    sent_uri: t.Optional[str] = None
+
+    def reply_ref(self) -> t.Dict[str, t.Dict[str, str]]:
+        return {
+            "root": {"uri": self.root_uri, "cid": self.root_cid},
+            "parent": {"uri": self.parent_uri, "cid": self.parent_cid},
+        }
+
+
+class Outbox:
+    # 生成した返信を送信前に保存し、送信に失敗しても再生成せずに再送する
+    # 送り直しても成功しない失敗(親の投稿が削除された、本文が不正などの400)がmax_attempts回続いたものは諦めて、以後は送らない
+    # 接続エラーや5xx、429のような一時的な失敗は数えず、retry_delayから倍々に(max_retry_delayまで)間を空けて送り直し続ける
+    def __init__(
+        self,
+        path: str,
+        retention: float = 24 * 60 * 60,
+        clock: t.Callable[[], float] = time.time,
+        max_attempts: int = 5,
+        retry_delay: float = 30.0,
+        max_retry_delay: float = 30 * 60,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.retention = retention
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " key TEXT PRIMARY KEY, rkey TEXT NOT NULL, text TEXT NOT NULL,"
+            " root_uri TEXT NOT NULL, root_cid TEXT NOT NULL, parent_uri TEXT NOT NULL, parent_cid TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, sent_uri TEXT, created_at REAL NOT NULL, sent_at REAL,"
+            " failures INTEGER NOT NULL DEFAULT 0, retry_at REAL, dead_at REAL)"
+        )
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")]
+        for name, definition in (("failures", "INTEGER NOT NULL DEFAULT 0"), ("retry_at", "REAL"), ("dead_at", "REAL")):
+            if name not in columns:
+                # この列が無かった頃に作ったファイル
+                self._conn.execute(f"ALTER TABLE outbox ADD COLUMN {name} {definition}")
+
+    def add(self, item: OutboxItem) -> OutboxItem:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO outbox (key, rkey, text, root_uri, root_cid, parent_uri, parent_cid, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (item.key, item.rkey, item.text, item.root_uri, item.root_cid, item.parent_uri, item.parent_cid, self.clock()),
+            )
+        return self.get(item.key)
+
+    def get(self, key: str) -> t.Optional[OutboxItem]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT key, rkey, text, root_uri, root_cid, parent_uri, parent_cid, attempts, sent_uri FROM outbox WHERE key = ?", (key,)
+            ).fetchone()
+        return None if row is None else OutboxItem(*row)
+
+    def pending(self, older_than: float = 0) -> t.List[OutboxItem]:
+        # older_than: 追加してからこの秒数が経っていないもの(返信のスレッドがちょうど送っているかもしれない)は除く
+        now = self.clock()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, rkey, text, root_uri, root_cid, parent_uri, parent_cid, attempts, sent_uri FROM outbox"
+                " WHERE sent_uri IS NULL AND dead_at IS NULL AND (retry_at IS NULL OR retry_at <= ?) AND created_at <= ? ORDER BY created_at",
+                (now, now - older_than),
+            ).fetchall()
+        return [OutboxItem(*row) for row in rows]
+
+    def attempt(self, key: str):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET attempts = attempts + 1 WHERE key = ?", (key,))
+
+    def fail(self, key: str, permanent: bool = False) -> bool:
+        # 送信に失敗したとき(attemptの後)に呼ぶ。送り直さない失敗がmax_attempts回になって諦めたらTrueを返す
+        now = self.clock()
+        with self._lock:
+            row = self._conn.execute("SELECT attempts, failures FROM outbox WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return False
+            attempts, failures = row[0], row[1] + (1 if permanent else 0)
+            retry_at = now + min(self.max_retry_delay, self.retry_delay * 2 ** max(0, attempts - 1))
+            dead_at = now if failures >= self.max_attempts else None
+            self._conn.execute("UPDATE outbox SET failures = ?, retry_at = ?, dead_at = ? WHERE key = ?", (failures, retry_at, dead_at, key))
+        return dead_at is not None
+
+    def is_dead(self, key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT dead_at FROM outbox WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def is_waiting(self, key: str) -> bool:
+        # 前回の失敗から、次に送り直すまでの間
+        with self._lock:
+            row = self._conn.execute("SELECT retry_at FROM outbox WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] is not None and row[0] > self.clock()
+
+    def mark_sent(self, key: str, sent_uri: str):
+        with self._lock:
+            self._conn.execute("UPDATE outbox SET sent_uri = ?, sent_at = ? WHERE key = ?", (sent_uri, self.clock(), key))
+
+    def compact(self) -> int:
+        with self._lock:
+            cutoff = self.clock() - self.retention
+            cursor = self._conn.execute("DELETE FROM outbox WHERE (sent_uri IS NOT NULL AND sent_at < ?) OR dead_at < ?", (cutoff, cutoff))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
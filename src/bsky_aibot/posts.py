@@ -0,0 +1,107 @@
+import typing as t
+
+from bsky_aibot.timestamps import timestamp
+
+# getPostThreadの応答から、ボットが使う項目だけを持つ軽い表現を作る
+# 属性名はSDKのモデル(PostView, ThreadViewPost)と同じなので、どちらを渡しても同じように扱える
+# アバター、ラベル、viewerなどは読まず、SDKのモデルの検証(dacite)も通さない
+
+
+class Author(t.NamedTuple):
+    did: str
+    handle: str
+
+
+class StrongRef(t.NamedTuple):
+    uri: str
+    cid: str
+
+
+class ReplyRef(t.NamedTuple):
+    root: StrongRef
+    parent: StrongRef
+
+
+class Record(t.NamedTuple):
+    text: str
+    createdAt: t.Optional[str] = None
+    reply: t.Optional[ReplyRef] = None
+
+
+class Post(t.NamedTuple):
+    uri: str
+    cid: str
+    author: Author
+    record: Record
+    indexedAt: str
+    # indexedAtのepoch秒。並べ替えのたびに文字列を解析しないよう、デコードするときに1回だけ求める
+    timestamp: float
+
+
+class ThreadView:
+    # 親と返信を後から埋めるので、タプルではなく__slots__のクラスにする
+    __slots__ = ("post", "parent", "replies")
+
+    def __init__(self, post: Post, parent: t.Optional["ThreadView"] = None, replies: t.Optional[t.List["ThreadView"]] = None):
+        self.post = post
+        self.parent = parent
+        self.replies = replies
+
+
+class Thread(t.NamedTuple):
+    # app.bsky.feed.getPostThreadの応答
+    thread: t.Optional[ThreadView]
+
+
+def decode_reply_ref(data: t.Optional[t.Mapping[str, t.Any]]) -> t.Optional[ReplyRef]:
+    if data is None:
+        return None
+    root, parent = data["root"], data["parent"]
+    return ReplyRef(StrongRef(root["uri"], root["cid"]), StrongRef(parent["uri"], parent["cid"]))
+
+
+def decode_post(data: t.Mapping[str, t.Any], authors: t.Optional[t.Dict[str, Author]] = None) -> Post:
+    # authorsを渡すと、同じ投稿者のAuthorを1つにまとめる
+    author = data["author"]
+    did = author["did"]
+    decoded_author = None if authors is None else authors.get(did)
+    if decoded_author is None:
+        decoded_author = Author(did, author["handle"])
+        if authors is not None:
+            authors[did] = decoded_author
+    record = data.get("record") or {}
+    return Post(
+        data["uri"],
+        data["cid"],
+        decoded_author,
+        Record(record.get("text", ""), record.get("createdAt"), decode_reply_ref(record.get("reply"))),
+        data["indexedAt"],
+        timestamp(data["indexedAt"]),
+    )
+
+
+def decode_thread(data: t.Optional[t.Mapping[str, t.Any]]) -> t.Optional[ThreadView]:
+    # 親方向にも返信方向にも、再帰せずにたどる。NotFoundPost, BlockedPostはNoneにする(返信からは除く)
+    authors: t.Dict[str, Author] = {}
+
+    def node(data: t.Optional[t.Mapping[str, t.Any]]) -> t.Optional[ThreadView]:
+        if data is None or "post" not in data:
+            return None
+        return ThreadView(decode_post(data["post"], authors))
+
+    root = node(data)
+    stack = [] if root is None else [(root, data)]
+    while stack:
+        view, data = stack.pop()
+        view.parent = node(data.get("parent"))
+        if view.parent is not None:
+            stack.append((view.parent, data["parent"]))
+        replies = data.get("replies")
+        if replies is not None:
+            view.replies = []
+            for reply in replies:
+                child = node(reply)
+                if child is not None:
+                    view.replies.append(child)
+                    stack.append((child, reply))
+    return root
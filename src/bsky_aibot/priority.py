@@ -0,0 +1,61 @@
+import math
+import typing as t
+from dataclasses import dataclass, field
+
+from bsky_aibot.timestamps import indexed_timestamp
+
+DEFAULT_REASON_WEIGHTS = {"mention": 2.0, "reply": 1.0}
+
+
+def parse_weights(value: t.Optional[str]) -> t.Dict[str, float]:
+    # "alice.bsky.social=2,did:plc:xxx=0.5" のような形式
+    weights = {}
+    for item in (value or "").split(","):
+        key, sep, weight = item.strip().rpartition("=")
+        if sep and key:
+            weights[key] = float(weight)
+    return weights
+
+
+def author_keys(notification) -> t.List[str]:
+    # ストリームの通知にはauthorが無いので、URIのDIDでも引けるようにする
+    keys = [notification.uri[len("at://") :].split("/", 1)[0]]
+    author = getattr(notification, "author", None)
+    if author is not None:
+        keys.extend([author.did, author.handle])
+    return keys
+
+
+@dataclass
+class ReplyPolicy:
+    # 返信待ちの通知の優先度。理由(mention > reply)、新しさ、投稿者の重みで決める
+    reason_weights: t.Dict[str, float] = field(default_factory=lambda: dict(DEFAULT_REASON_WEIGHTS))
+    author_weights: t.Dict[str, float] = field(default_factory=dict)
+    # half_life秒古くなるごとに優先度が半分になる
+    half_life: float = 300.0
+    # これより古い通知は、drop: 返信しない / defer: 新しい通知がすべて済んでから返信する
+    deadline: t.Optional[float] = None
+    deadline_action: str = "drop"
+    # 待ちの通知がこれを超えたら、優先度の低いものから捨てる
+    high_water: t.Optional[int] = None
+
+    def age(self, notification, now: float) -> float:
+        return now - indexed_timestamp(notification)
+
+    def score(self, notification, now: float) -> float:
+        # 対数で表すので、時間が経っても通知どうしの順序は変わらない
+        weight = self.reason_weights.get(notification.reason, 1.0)
+        for key in author_keys(notification):
+            if key in self.author_weights:
+                weight *= self.author_weights[key]
+                break
+        if weight <= 0:
+            return -math.inf
+        return math.log2(weight) - self.age(notification, now) / self.half_life
+
+    def expired(self, notification, now: float) -> bool:
+        return self.deadline is not None and self.age(notification, now) > self.deadline
+
+    def priority(self, ns: t.Sequence, now: float) -> t.Tuple[bool, float]:
+        # スレッド単位の優先度。期限内の通知があるスレッドを先にし、その中でスコアの高いものを先にする
+        return any(not self.expired(n, now) for n in ns), max(self.score(n, now) for n in ns)
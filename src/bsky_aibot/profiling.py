@@ -0,0 +1,235 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+import typing as t
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from bsky_aibot.metrics import METRICS
+
+CPROFILE = "cprofile"
+SAMPLE = "sample"
+
+
+class Capture:
+    # 1回分の記録。METRICS.timeの区間(get_thread, generate_reply, send_postなど)をステージ名付きのspanとして残す
+    # cprofile: 記録を始めたスレッドと、記録中に起動したスレッド(返信のワーカー)を決定的にプロファイルする
+    # sample: すべてのスレッドのスタックを一定間隔で集め、今いるステージ名を先頭に付けた折りたたみ形式で書き出す
+    def __init__(self, path: str, mode: str = CPROFILE, sample_interval: float = 0.005, trace_memory: bool = True):
+        if mode not in (CPROFILE, SAMPLE):
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.spans: t.List[t.Dict[str, t.Any]] = []
+        self.samples: t.Counter[str] = Counter()
+        self._stages: t.Dict[int, t.List[str]] = {}
+        self._profiles: t.List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._sampler: t.Optional[threading.Thread] = None
+        self._started_tracemalloc = False
+        self._memory_start: t.Optional[tracemalloc.Snapshot] = None
+
+    def begin(self, stage: str) -> t.Tuple[str, int, float]:
+        thread = threading.get_ident()
+        with self._lock:
+            self._stages.setdefault(thread, []).append(stage)
+        return stage, thread, time.perf_counter()
+
+    def end(self, token: t.Tuple[str, int, float], error: bool):
+        stage, thread, started_at = token
+        now = time.perf_counter()
+        with self._lock:
+            stages = self._stages.get(thread)
+            if stages:
+                stages.pop()
+            # Chromeのtrace event形式(chrome://tracing, Perfettoで開ける)
+            self.spans.append(
+                {"name": stage, "ph": "X", "ts": round((started_at - self.started_at) * 1e6), "dur": round((now - started_at) * 1e6), "pid": os.getpid(), "tid": thread, "args": {"error": error}}
+            )
+
+    def _enable_profile(self):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Python 3.12以降は、同時に有効にできるプロファイラが1つだけ
+            logging.warning(f"Could not profile {threading.current_thread().name}: {e}")
+            return
+        with self._lock:
+            self._profiles.append(profile)
+
+    def _bootstrap(self, frame, event, arg):
+        # 記録中に起動したスレッドで最初に呼ばれ、そのスレッド用のプロファイラに差し替える
+        sys.setprofile(None)
+        self._enable_profile()
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self._lock:
+                stages = {thread: "[" + "/".join(names) + "]" for thread, names in self._stages.items() if names}
+            for thread, frame in frames.items():
+                if thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                if thread in stages:
+                    stack.insert(0, stages[thread])
+                self.samples[";".join(stack)] += 1
+
+    def start(self):
+        self.started_at = time.perf_counter()
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(10)
+                self._started_tracemalloc = True
+            self._memory_start = tracemalloc.take_snapshot()
+        if self.mode == CPROFILE:
+            threading.setprofile(self._bootstrap)
+            self._enable_profile()
+        else:
+            self._sampler = threading.Thread(target=self._sample, name="profile-sampler", daemon=True)
+            self._sampler.start()
+
+    def stop(self) -> t.List[str]:
+        # 書き出したファイルのパスを返す
+        os.makedirs(self.path, exist_ok=True)
+        files = []
+        if self.mode == CPROFILE:
+            threading.setprofile(None)
+            with self._lock:
+                profiles = list(self._profiles)
+            for profile in profiles:
+                profile.disable()
+            if profiles:
+                stats = pstats.Stats(*profiles)
+                files.append(os.path.join(self.path, "profile.prof"))
+                stats.dump_stats(files[-1])
+                report = io.StringIO()
+                pstats.Stats(*profiles, stream=report).sort_stats("cumulative").print_stats(50)
+                files.append(os.path.join(self.path, "profile.txt"))
+                with open(files[-1], "w") as f:
+                    f.write(report.getvalue())
+        else:
+            self._stopped.set()
+            self._sampler.join()
+            files.append(os.path.join(self.path, "profile.collapsed"))
+            with open(files[-1], "w") as f:
+                for stack, count in self.samples.most_common():
+                    f.write(f"{stack} {count}\n")
+
+        files.append(os.path.join(self.path, "spans.json"))
+        with open(files[-1], "w") as f:
+            with self._lock:
+                json.dump({"traceEvents": self.spans, "displayTimeUnit": "ms"}, f)
+
+        if self._memory_start is not None:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            files.append(os.path.join(self.path, "memory.txt"))
+            with open(files[-1], "w") as f:
+                f.write(f"traced: {current} bytes, peak: {peak} bytes\n\n")
+                for stat in snapshot.compare_to(self._memory_start, "lineno")[:30]:
+                    f.write(f"{stat}\n")
+            files.append(os.path.join(self.path, "memory.snapshot"))
+            snapshot.dump(files[-1])
+            if self._started_tracemalloc:
+                tracemalloc.stop()
+        return files
+
+
+class Profiler:
+    # 要求されたら(SIGUSR1、トリガーファイル、起動時の設定)、次のcycles回のサイクルを記録してoutput_dirに書き出す
+    def __init__(
+        self,
+        output_dir: str,
+        cycles: int = 3,
+        mode: str = CPROFILE,
+        sample_interval: float = 0.005,
+        trace_memory: bool = True,
+        trigger_path: t.Optional[str] = None,
+    ):
+        self.output_dir = output_dir
+        self.cycles = cycles
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.trace_memory = trace_memory
+        self.trigger_path = trigger_path
+        self.captures = 0
+        self._requested = 0
+        self._remaining = 0
+        self._owner: t.Optional[int] = None
+        self._capture: t.Optional[Capture] = None
+        self._lock = threading.Lock()
+
+    def request(self, cycles: t.Optional[int] = None):
+        # シグナルハンドラからも呼ぶので、代入だけにする
+        self._requested = cycles or self.cycles
+
+    def install_signal(self, signum: int = getattr(signal, "SIGUSR1", 0)) -> bool:
+        if not signum:
+            return False  # Windows
+        signal.signal(signum, lambda *_: self.request())
+        return True
+
+    def _triggered(self) -> bool:
+        if self.trigger_path is None or not os.path.exists(self.trigger_path):
+            return False
+        try:
+            os.remove(self.trigger_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _begin(self):
+        if self._capture is None and self._triggered():
+            self.request()
+        with self._lock:
+            if self._capture is not None or self._requested <= 0:
+                return
+            self._remaining, self._requested = self._requested, 0
+            name = datetime.now(tz=timezone.utc).strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+            self._capture = Capture(os.path.join(self.output_dir, name), self.mode, self.sample_interval, self.trace_memory)
+            self._owner = threading.get_ident()
+            logging.info(f"Profiling the next {self._remaining} cycles into {self._capture.path}")
+            self._capture.start()
+            METRICS.tracer = self._capture
+
+    def _end(self):
+        # 記録を始めたスレッドのサイクルだけを数える(cProfileはスレッドごとに有効にするため)
+        with self._lock:
+            if self._capture is None or self._owner != threading.get_ident():
+                return
+            self._remaining -= 1
+            if self._remaining > 0:
+                return
+            capture, self._capture, self._owner = self._capture, None, None
+            METRICS.tracer = None
+            files = capture.stop()
+            self.captures += 1
+        logging.info(f"Wrote profile: {', '.join(files)}")
+
+    @contextmanager
+    def cycle(self) -> t.Iterator[None]:
+        self._begin()
+        try:
+            yield
+        finally:
+            self._end()
@@ -0,0 +1,238 @@
+import re
+import threading
+import time
+import typing as t
+
+from bsky_aibot.metrics import METRICS
+from bsky_aibot.scheduler import retry_delay_from_headers
+
+READ = "read"
+WRITE = "write"
+LLM_REQUESTS = "llm_requests"
+LLM_TOKENS = "llm_tokens"
+
+# createRecordなどリポジトリへの書き込みは、他のAPIとは別に厳しく制限されている
+# <https://docs.bsky.app/docs/advanced-guides/rate-limits>
+WRITE_PATH = "/xrpc/com.atproto.repo."
+# 書き込みの上限はポイントで数えられ、操作ごとに消費するポイントが違う(applyWritesは中身によるので作成と同じとみなす)
+WRITE_POINTS = {"createRecord": 3, "putRecord": 2, "deleteRecord": 1, "applyWrites": 3}
+# 返信はcreateRecordなので、書き込みの速さ(PDS_WRITE_RATE)は作成の回数で指定する
+CREATE_POINTS = WRITE_POINTS["createRecord"]
+# createSessionなどはエンドポイントごとに別の(ずっと厳しい)上限があり、そのヘッダーで読み込みの速さを変えてはいけない
+SESSION_PATH = "/xrpc/com.atproto.server."
+
+DURATION_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str) -> t.Optional[float]:
+    # OpenAIのx-ratelimit-reset-*は "1s", "6m0s", "20ms" のような形式
+    parts = DURATION_PATTERN.findall(value)
+    if not parts or "".join(n + u for n, u in parts) != value.strip():
+        return None
+    return sum(float(n) * DURATION_UNITS[u] for n, u in parts)
+
+
+def parse_policy_window(policy: str) -> t.Optional[float]:
+    # RateLimit-Policy: 3000;w=300
+    for param in policy.split(",")[0].split(";")[1:]:
+        key, _, value = param.strip().partition("=")
+        if key == "w":
+            try:
+                return float(value)
+            except ValueError:
+                return None
+    return None
+
+
+def to_float(value: t.Optional[str]) -> t.Optional[float]:
+    try:
+        return None if value is None else float(value)
+    except ValueError:
+        return None
+
+
+class TokenBucket:
+    # 先に予約してから待つので、並行に呼ばれても到着順に必要最小限だけ待つ
+    def __init__(self, rate: float, capacity: float, clock: t.Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    @property
+    def tokens(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def reserve(self, amount: float = 1) -> float:
+        # 予約して、使えるようになるまでの秒数を返す。容量を超える量は容量分として扱う
+        with self._lock:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            self._refill()
+            self.rate = rate
+
+    def limit_to(self, remaining: float):
+        # サーバーが知っている残量の方が少なければ合わせる
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, remaining)
+
+    def block_for(self, seconds: float):
+        # seconds後まで次のトークンが使えないようにする
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+class RateLimiter:
+    # PDSの読み込み・書き込み、LLMのリクエスト数・トークン数をそれぞれ制限する。上限に達したら失敗させずに待つ
+    def __init__(
+        self,
+        read_rate: float = 10.0,
+        read_burst: float = 100,
+        write_rate: float = 0.13,
+        write_burst: float = 30,
+        llm_requests_per_minute: float = 200,
+        llm_tokens_per_minute: float = 40000,
+        clock: t.Callable[[], float] = time.monotonic,
+        wall_clock: t.Callable[[], float] = time.time,
+        sleep: t.Callable[[float], None] = time.sleep,
+        share: float = 1.0,
+        read_share: t.Optional[float] = None,
+    ):
+        # 同じアカウントを複数のプロセスで使うときは、上限をプロセス数で割った分だけを使う
+        # read_share: 読み込みだけ別の割合にする(通知を取得するだけのプロセスには読み込みを少しだけ割り当てる)
+        self.share = share
+        self.read_share = share if read_share is None else read_share
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.sleep = sleep
+        # WRITEはポイント単位
+        self.buckets = {
+            READ: TokenBucket(read_rate * self.read_share, read_burst * self.read_share, clock),
+            WRITE: TokenBucket(write_rate * CREATE_POINTS * share, write_burst * CREATE_POINTS * share, clock),
+            LLM_REQUESTS: TokenBucket(llm_requests_per_minute / 60 * share, llm_requests_per_minute * share, clock),
+            LLM_TOKENS: TokenBucket(llm_tokens_per_minute / 60 * share, llm_tokens_per_minute * share, clock),
+        }
+        # ヘッダーに合わせて遅くはするが、設定より速くはしない(書き込みのヘッダーは1時間の上限で、1日の上限から決めた設定より緩い)
+        self.max_rates = {name: bucket.rate for name, bucket in self.buckets.items()}
+        # for_accountで作ったものは、OpenAIのヘッダーを共有の方(parent)で見る
+        self.parent: t.Optional["RateLimiter"] = None
+        self._openai_installed = False
+
+    def for_account(self) -> "RateLimiter":
+        # 書き込みの上限はアカウントごと、読み込み(IPごと)とLLMの上限は共有する
+        limiter = RateLimiter(clock=self.clock, wall_clock=self.wall_clock, sleep=self.sleep, share=self.share, read_share=self.read_share)
+        write = self.buckets[WRITE]
+        limiter.buckets = {**self.buckets, WRITE: TokenBucket(self.max_rates[WRITE], write.capacity, self.clock)}
+        limiter.parent = self
+        return limiter
+
+    def acquire(self, name: str, amount: float = 1) -> float:
+        delay = self.buckets[name].reserve(amount)
+        if delay > 0:
+            METRICS.inc("rate_limit_waits_total", bucket=name)
+            METRICS.observe("rate_limit_wait_seconds", delay, bucket=name)
+            self.sleep(delay)
+        return delay
+
+    def observe_pds_headers(self, name: str, headers: t.Mapping[str, str]):
+        # RateLimit-Limit/Remaining/Reset/Policy(と429のRetry-After)に合わせる
+        headers = {k.lower(): v for k, v in headers.items()}
+        bucket = self.buckets[name]
+        share = self.read_share if name == READ else self.share
+        limit = to_float(headers.get("ratelimit-limit"))
+        window = parse_policy_window(headers.get("ratelimit-policy", ""))
+        if limit is not None and window:
+            bucket.set_rate(min(self.max_rates[name], limit / window * share))
+        remaining = to_float(headers.get("ratelimit-remaining"))
+        if remaining is not None:
+            bucket.limit_to(remaining * share)
+        delay = retry_delay_from_headers(headers, self.wall_clock())
+        if delay is not None:
+            bucket.block_for(delay)
+
+    def observe_openai_headers(self, headers: t.Mapping[str, str]):
+        # <https://platform.openai.com/docs/guides/rate-limits/rate-limits-in-headers>
+        headers = {k.lower(): v for k, v in headers.items()}
+        for name, suffix in ((LLM_REQUESTS, "requests"), (LLM_TOKENS, "tokens")):
+            bucket = self.buckets[name]
+            limit = to_float(headers.get(f"x-ratelimit-limit-{suffix}"))
+            if limit is not None:
+                bucket.set_rate(limit / 60 * self.share)
+            remaining = to_float(headers.get(f"x-ratelimit-remaining-{suffix}"))
+            if remaining is not None:
+                bucket.limit_to(remaining * self.share)
+                reset = parse_duration(headers.get(f"x-ratelimit-reset-{suffix}", ""))
+                if remaining <= 0 and reset is not None:
+                    bucket.block_for(reset)
+        retry_after = to_float(headers.get("retry-after"))
+        if retry_after is not None:
+            self.buckets[LLM_REQUESTS].block_for(retry_after)
+
+    def pds_bucket(self, method: str, path: str) -> str:
+        if method == "POST" and path.startswith(WRITE_PATH) and path[len(WRITE_PATH) :] in WRITE_POINTS:
+            return WRITE
+        return READ
+
+    def pds_cost(self, method: str, path: str) -> float:
+        return WRITE_POINTS[path[len(WRITE_PATH) :]] if self.pds_bucket(method, path) == WRITE else 1
+
+    def header_bucket(self, method: str, path: str) -> t.Optional[str]:
+        # そのエンドポイント自身の上限を返すものは、どのバケツにも反映しない
+        return None if path.startswith(SESSION_PATH) else self.pds_bucket(method, path)
+
+    def install(self, client) -> None:
+        # atprotoのClientが使うhttpxにフックを入れ、すべてのXRPC呼び出しを制限する
+        def on_request(request):
+            self.acquire(self.pds_bucket(request.method, request.url.path), self.pds_cost(request.method, request.url.path))
+
+        def on_response(response):
+            name = self.header_bucket(response.request.method, response.request.url.path)
+            if name is not None:
+                self.observe_pds_headers(name, response.headers)
+
+        hooks = client.request._client.event_hooks
+        client.request._client.event_hooks = {
+            "request": hooks.get("request", []) + [on_request],
+            "response": hooks.get("response", []) + [on_response],
+        }
+
+    def install_openai(self, openai) -> None:
+        # openaiが使うrequestsのセッションで、レスポンスヘッダーを見る。openaiはモジュールなので、共有の方に1回だけ入れる
+        if self.parent is not None:
+            return self.parent.install_openai(openai)
+        if self._openai_installed:
+            return
+        import requests
+
+        def on_response(response, *args, **kwargs):
+            self.observe_openai_headers(response.headers)
+
+        factory = openai.requestssession
+
+        def session() -> requests.Session:
+            # セッションを作る関数(Transport)があれば、それが作ったセッションにフックを足す
+            s = factory() if callable(factory) else requests.Session()
+            s.hooks["response"].append(on_response)
+            return s
+
+        if isinstance(factory, requests.Session):
+            factory.hooks["response"].append(on_response)
+        else:
+            openai.requestssession = session
+        self._openai_installed = True
@@ -0,0 +1,38 @@
+import os
+import sqlite3
+import threading
+import time
+import typing as t
+
+
+class RepliedIndex:
+    # 返信済みの通知URIをローカルに記録し、get_post_threadを呼ばずに重複を弾く
+    def __init__(self, path: str, retention: float = 24 * 60 * 60, clock: t.Callable[[], float] = time.time):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.retention = retention
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS replied (uri TEXT PRIMARY KEY, cid TEXT, replied_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS replied_replied_at ON replied (replied_at)")
+
+    def __contains__(self, uri: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM replied WHERE uri = ?", (uri,)).fetchone()
+        return row is not None
+
+    def add(self, uri: str, cid: t.Optional[str] = None):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO replied (uri, cid, replied_at) VALUES (?, ?, ?)", (uri, cid, self.clock()))
+
+    def compact(self) -> int:
+        # 未読判定の重複期間(2分)よりも十分古いものは、もう通知として再び現れないので消す
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM replied WHERE replied_at < ?", (self.clock() - self.retention,))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import typing as t
+import unicodedata
+from collections import OrderedDict
+
+SPACE_PATTERN = re.compile(r"\s+")
+# 文末の "!!" や "???" は1つにまとめる。"?" と "!" は意味が違うので区別する
+TRAILING_MARKS_PATTERN = re.compile(r"([!?])\1+$")
+
+
+def normalize_text(text: str, handle: t.Optional[str] = None) -> str:
+    # 大文字小文字、全角半角、空白の違いと、先頭のボット自身へのメンション("@aibot.bsky.social hi" と "hi")だけを同一視する
+    # 他のアカウントへのメンションや句読点は残す("@alice"と"@bob"、"3.5"と"35"で返信が変わる)
+    text = SPACE_PATTERN.sub(" ", unicodedata.normalize("NFKC", text or "").casefold()).strip()
+    if handle:
+        mention = re.escape("@" + unicodedata.normalize("NFKC", handle).casefold())
+        text = re.sub(f"^{mention}(?![\\w.-])", "", text).strip()
+    return TRAILING_MARKS_PATTERN.sub(r"\1", text)
+
+
+def cache_key(messages: t.Sequence[t.Mapping[str, t.Any]], namespace: str = "", handle: t.Optional[str] = None) -> str:
+    # 投稿者の名前は含めない。誰が送っても同じ内容なら同じ返信を使う。handleはボット自身のハンドル
+    normalized = [(m["role"], normalize_text(m.get("content") or "", handle)) for m in messages]
+    return hashlib.sha256(json.dumps([namespace, normalized], ensure_ascii=False).encode()).hexdigest()
+
+
+class ReplyCache:
+    # 正規化したメッセージ列のハッシュをキーに、生成した返信をLRU+TTLで保持する。pathを渡すとsqliteにも保存する
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 24 * 60 * 60,
+        max_depth: int = 1,
+        path: t.Optional[str] = None,
+        clock: t.Callable[[], float] = time.time,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # この件数以下の投稿からなるスレッドだけを対象にする。0ならキャッシュしない
+        self.max_depth = max_depth
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, t.Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is not None:
+            if path != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS reply_cache (key TEXT PRIMARY KEY, reply TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._load()
+
+    def _load(self):
+        # 期限内のものを、新しいものがLRUの末尾に来るように読み込む
+        self._conn.execute("DELETE FROM reply_cache WHERE expires_at <= ?", (self.clock(),))
+        rows = self._conn.execute("SELECT key, reply, expires_at FROM reply_cache ORDER BY expires_at DESC LIMIT ?", (self.max_entries,)).fetchall()
+        for key, reply, expires_at in reversed(rows):
+            self._entries[key] = (expires_at, reply)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def eligible(self, messages: t.Sequence[t.Mapping[str, t.Any]]) -> bool:
+        return 0 < len(messages) <= self.max_depth
+
+    def get(self, key: str) -> t.Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= self.clock():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, reply: str):
+        expires_at = self.clock() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, reply)
+            if self._conn is not None:
+                self._conn.execute("INSERT OR REPLACE INTO reply_cache (key, reply, expires_at) VALUES (?, ?, ?)", (key, reply, expires_at))
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def stats(self) -> t.Dict[str, t.Union[int, float]]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+
+    def _remove(self, key: str):
+        del self._entries[key]
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM reply_cache WHERE key = ?", (key,))
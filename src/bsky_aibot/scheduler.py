@@ -0,0 +1,80 @@
+import time
+import typing as t
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+
+def retry_delay_from_headers(headers: t.Mapping[str, str], now: float) -> t.Optional[float]:
+    # Retry-After(秒数またはHTTP-date)と、PDSが返すRateLimit-Remaining/RateLimit-Reset(epoch秒)を見る
+    headers = {k.lower(): v for k, v in headers.items()}
+    retry_after = headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(retry_after).timestamp() - now)
+            except (TypeError, ValueError):
+                pass
+    remaining = headers.get("ratelimit-remaining")
+    reset = headers.get("ratelimit-reset")
+    if remaining is not None and reset is not None:
+        try:
+            if int(remaining) <= 0:
+                return max(0.0, float(reset) - now)
+        except ValueError:
+            pass
+    return None
+
+
+class PollScheduler:
+    # 通知が来ている間は間隔を縮め、来なければ指数的に伸ばす
+    def __init__(
+        self,
+        min_interval: float = 2.0,
+        max_interval: float = 120.0,
+        initial_interval: float = 10.0,
+        factor: float = 2.0,
+        window: int = 20,
+        clock: t.Callable[[], float] = time.monotonic,
+        wall_clock: t.Callable[[], float] = time.time,
+        sleep: t.Callable[[float], None] = time.sleep,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.sleep = sleep
+        self.interval = min(max(initial_interval, min_interval), max_interval)
+        self._hits: t.Deque[bool] = deque(maxlen=window)
+        self._not_before = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return sum(self._hits) / len(self._hits) if self._hits else 0.0
+
+    def record(self, count: int):
+        hit = count > 0
+        self._hits.append(hit)
+        if hit:
+            self.interval = max(self.min_interval, self.interval / self.factor)
+        else:
+            self.interval = min(self.max_interval, self.interval * self.factor)
+
+    def defer(self, seconds: float):
+        self._not_before = max(self._not_before, self.clock() + seconds)
+
+    def observe_headers(self, headers: t.Optional[t.Mapping[str, str]]) -> t.Optional[float]:
+        if headers is None:
+            return None
+        delay = retry_delay_from_headers(headers, self.wall_clock())
+        if delay is not None:
+            self.defer(delay)
+        return delay
+
+    def next_delay(self) -> float:
+        return max(self.interval, self._not_before - self.clock())
+
+    def wait(self):
+        self.sleep(self.next_delay())
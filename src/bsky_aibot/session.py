@@ -0,0 +1,89 @@
+import json
+import logging
+import os
+import time
+import typing as t
+from types import SimpleNamespace
+
+from atproto import Client
+from atproto.exceptions import BadRequestError, UnauthorizedError
+from atproto.xrpc_client.client.auth import get_jwt_payload
+
+# アクセストークンの期限がこれより近ければ、使う前にリフレッシュする
+REFRESH_MARGIN = 15 * 60
+
+
+class SessionStore:
+    # createSessionで得たJWTを保存し、再起動しても使い回す
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> t.Optional[t.Dict[str, str]]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, client: Client):
+        session = {"did": client.me.did, "handle": client.me.handle, "accessJwt": client._access_jwt, "refreshJwt": client._refresh_jwt}
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+            json.dump(session, f)
+        os.replace(tmp, self.path)
+
+    def save_if_changed(self, client: Client):
+        # SDKはリクエストの前に自動でリフレッシュするので、新しいトークンになっていたら保存し直す
+        session = self.load()
+        if client._access_jwt is not None and (session is None or session.get("accessJwt") != client._access_jwt):
+            self.save(client)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def expires_in(token: str, now: t.Optional[float] = None) -> float:
+    return get_jwt_payload(token).exp - (time.time() if now is None else now)
+
+
+def resume_session(client: Client, store: SessionStore) -> bool:
+    # 保存済み(またはクライアントが持っている)セッションを再開する。パスワードでのログインが必要ならFalse
+    # ネットワークエラーなどはそのまま送出し、呼び出し側で待ってから再試行させる
+    session = store.load()
+    if client._refresh_jwt is not None:
+        session = {"accessJwt": client._access_jwt, "refreshJwt": client._refresh_jwt, "did": client.me.did if client.me else None}
+    if session is None or expires_in(session["refreshJwt"]) <= 0:
+        return False
+
+    try:
+        client._set_session(SimpleNamespace(accessJwt=session["accessJwt"], refreshJwt=session["refreshJwt"]))
+        if expires_in(session["accessJwt"]) <= REFRESH_MARGIN or client.me is not None:
+            # 例外からの復帰時は、トークンが無効になっている可能性があるので必ずリフレッシュする
+            client._refresh_and_set_session()
+        client.me = client.bsky.actor.get_profile({"actor": session["did"] or get_jwt_payload(session["accessJwt"]).sub})
+    except (BadRequestError, UnauthorizedError) as e:
+        # ExpiredToken, InvalidTokenなど
+        logging.warning(f"Could not resume session: {e}")
+        store.clear()
+        return False
+
+    store.save(client)
+    logging.info(f"Resumed session for {client.me.handle}")
+    return True
+
+
+def attach_session(client: Client, store: SessionStore) -> bool:
+    # ワーカープロセスは、ポーリングするプロセスが保存したセッションを使うだけで自分ではリフレッシュしない
+    # (リフレッシュトークンは使うと無効になるので、複数のプロセスがリフレッシュすると互いのセッションを壊す)
+    session = store.load()
+    if session is None:
+        return False
+    if session["accessJwt"] != client._access_jwt:
+        client._set_session(SimpleNamespace(accessJwt=session["accessJwt"], refreshJwt=session["refreshJwt"]))
+        client.me = SimpleNamespace(did=session["did"], handle=session["handle"])
+        client._should_refresh_session = lambda: False
+    return True
@@ -0,0 +1,110 @@
+import time
+import typing as t
+import unicodedata
+from dataclasses import dataclass
+
+# Blueskyの投稿は300書記素まで
+POST_MAX_GRAPHEMES = 300
+# 全角の句点などと改行は常に文末。半角の".!?"は、後ろが空白か文字列の終わりのときだけ文末とする("3.5", "bsky.app"で切らない)
+SENTENCE_ENDINGS = "。．！？\n"
+ASCII_SENTENCE_ENDINGS = ".!?"
+
+ZWJ = "\u200d"
+
+
+def is_grapheme_extender(c: str) -> bool:
+    code = ord(c)
+    return (
+        unicodedata.combining(c) != 0
+        or unicodedata.category(c) in ("Me", "Mn", "Mc")
+        or 0xFE00 <= code <= 0xFE0F  # variation selectors
+        or 0x1F3FB <= code <= 0x1F3FF  # emoji skin tone modifiers
+        or 0xE0020 <= code <= 0xE007F  # emoji tag sequences
+        or c == ZWJ
+    )
+
+
+def is_regional_indicator(c: str) -> bool:
+    return 0x1F1E6 <= ord(c) <= 0x1F1FF
+
+
+def grapheme_boundaries(text: str) -> t.List[int]:
+    # 書記素クラスタの終わりの位置を返す。結合文字、異体字セレクタ、ZWJ連結絵文字、国旗を1つとして数える簡易版
+    boundaries = []
+    i = 0
+    while i < len(text):
+        i += 1
+        if is_regional_indicator(text[i - 1]) and i < len(text) and is_regional_indicator(text[i]):
+            i += 1
+        while i < len(text) and (is_grapheme_extender(text[i]) or text[i - 1] == ZWJ):
+            i += 1
+        boundaries.append(i)
+    return boundaries
+
+
+def count_graphemes(text: str) -> int:
+    return len(grapheme_boundaries(text))
+
+
+def last_sentence_end(text: str, end: int) -> int:
+    # text[:end]の中で最後の文末の位置。無ければ-1
+    for i in range(end - 1, 0, -1):
+        c = text[i]
+        if c in SENTENCE_ENDINGS or (c in ASCII_SENTENCE_ENDINGS and (i + 1 == len(text) or text[i + 1].isspace())):
+            return i
+    return -1
+
+
+def last_word_end(text: str, end: int) -> int:
+    # text[:end]を単語の途中で切らない最後の位置(空白の位置)。無ければ0
+    for i in range(end, 0, -1):
+        if i == len(text) or text[i].isspace():
+            return i
+    return 0
+
+
+def truncate_graphemes(text: str, max_graphemes: int = POST_MAX_GRAPHEMES) -> str:
+    # 上限以内で最後の文末で切る。文末が上限の前半にしか無ければ(返信の大半を捨てることになるので)最後の単語の区切りで、
+    # それも無ければ上限の位置で切る
+    boundaries = grapheme_boundaries(text)
+    if len(boundaries) <= max_graphemes:
+        return text
+    end = boundaries[max_graphemes - 1]
+    half = boundaries[max_graphemes // 2 - 1] if max_graphemes >= 2 else 0
+    sentence_end = last_sentence_end(text, end)
+    if sentence_end + 1 >= half and sentence_end > 0:
+        return text[: sentence_end + 1].rstrip()
+    word_end = last_word_end(text, end)
+    if word_end >= half and word_end > 0:
+        return text[:word_end].rstrip()
+    return text[:end]
+
+
+@dataclass
+class GenerationTiming:
+    time_to_first_token: t.Optional[float]
+    total: float
+    truncated: bool
+
+
+def read_stream(
+    deltas: t.Iterable[str],
+    max_graphemes: int = POST_MAX_GRAPHEMES,
+    started_at: t.Optional[float] = None,
+    clock: t.Callable[[], float] = time.monotonic,
+) -> t.Tuple[str, GenerationTiming]:
+    # 上限を超えた時点で受信をやめる。呼び出し側はストリームを閉じてリクエストを打ち切る
+    started_at = clock() if started_at is None else started_at
+    first_token_at = None
+    text = ""
+    truncated = False
+    for delta in deltas:
+        if first_token_at is None:
+            first_token_at = clock()
+        text += delta or ""
+        if count_graphemes(text) > max_graphemes:
+            truncated = True
+            break
+    text = truncate_graphemes(text, max_graphemes)
+    time_to_first_token = None if first_token_at is None else first_token_at - started_at
+    return text, GenerationTiming(time_to_first_token, clock() - started_at, truncated)
@@ -0,0 +1,76 @@
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+Summarize = t.Callable[[t.Optional[str], t.List[t.Dict]], str]
+
+
+def summary_message(summary: str, count: int) -> t.Dict[str, str]:
+    return {"role": "system", "content": f"Summary of the {count} earlier posts in this thread: {summary}"}
+
+
+class SummaryStore:
+    # スレッドの根ごとに、古い投稿を要約したものを保持する。スレッドが伸びたら差分だけを要約に畳み込む
+    # 要約は「根からその投稿までを何件畳み込んだか」と最後の投稿のURIで引くので、枝分かれしたスレッドでも共有できる
+    def __init__(
+        self,
+        threshold: int = 20,
+        keep_recent: int = 8,
+        max_roots: int = 256,
+        ttl: float = 24 * 60 * 60,
+        clock: t.Callable[[], float] = time.monotonic,
+    ):
+        self.threshold = threshold
+        # 直近のこの件数(からその倍未満)はそのまま送る。要約はこの件数ごとにしか更新しない
+        self.keep_recent = max(1, keep_recent)
+        self.max_roots = max_roots
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.updates = 0
+        self.folded = 0
+        self._roots: "OrderedDict[str, t.Tuple[float, t.Dict[str, t.Tuple[int, str]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entries(self, root: str) -> t.Dict[str, t.Tuple[int, str]]:
+        with self._lock:
+            entry = self._roots.get(root)
+            if entry is None or entry[0] <= self.clock():
+                entry = (self.clock() + self.ttl, {})
+                self._roots[root] = entry
+            self._roots.move_to_end(root)
+            while len(self._roots) > self.max_roots:
+                self._roots.popitem(last=False)
+            return entry[1]
+
+    def compact(self, root: str, uris: t.Sequence[str], messages: t.List[t.Dict], summarize: Summarize) -> t.List[t.Dict]:
+        # messages と uris は古い順。しきい値を超えたら、要約 + 直近の投稿を返す
+        if self.threshold <= 0 or len(messages) <= self.threshold:
+            return messages
+        fold = (len(messages) - self.keep_recent) // self.keep_recent * self.keep_recent
+        if fold <= 0:
+            return messages
+
+        entries = self._entries(root)
+        with self._lock:
+            cached = entries.get(uris[fold - 1])
+            if cached is not None:
+                self.hits += 1
+                return [summary_message(cached[1], fold)] + messages[fold:]
+            # 途中までの要約があれば、その続きだけを畳み込む
+            base_count, base_summary = max((entries[uris[i - 1]] for i in range(1, fold) if uris[i - 1] in entries), default=(0, None))
+
+        # 再起動の後などに初めて見る長いスレッドでも、1回に要約させるのはkeep_recent件までにする(モデルのコンテキストに収める)
+        summary = base_summary
+        for start in range(base_count, fold, self.keep_recent):
+            end = min(start + self.keep_recent, fold)
+            summary = summarize(summary, messages[start:end])
+            with self._lock:
+                entries[uris[end - 1]] = (end, summary)
+                self.updates += 1
+                self.folded += end - start
+        return [summary_message(summary, fold)] + messages[fold:]
+
+    def stats(self) -> t.Dict[str, int]:
+        return {"roots": len(self._roots), "hits": self.hits, "updates": self.updates, "folded_posts": self.folded}
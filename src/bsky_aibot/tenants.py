@@ -0,0 +1,84 @@
+import contextlib
+import json
+import os
+import threading
+import typing as t
+from dataclasses import dataclass
+
+
+@dataclass
+class Account:
+    # 1つのプロセスで動かすボットのアカウント。system_promptとroutes(LLM_ROUTESの形式)は省略すると共通の設定を使う
+    handle: str
+    password: str
+    system_prompt: t.Optional[str] = None
+    routes: t.Optional[str] = None
+    weight: float = 1.0
+
+
+def load_accounts(path: str, environ: t.Mapping[str, str] = os.environ) -> t.List[Account]:
+    # {"accounts": [{"handle": "...", "password_env": "BOT1_PASSWORD", "system_prompt": "...", "model": "gpt-4", "weight": 2}]}
+    # パスワードはファイルに書かずに環境変数の名前で指定することもできる
+    with open(path) as f:
+        config = json.load(f)
+    accounts = []
+    for entry in config.get("accounts", []):
+        handle = entry.get("handle")
+        if not handle:
+            raise ValueError(f"An account in {path} has no handle")
+        password = entry.get("password")
+        if password is None and "password_env" in entry:
+            password = environ.get(entry["password_env"])
+        if password is None:
+            raise ValueError(f"No password for {handle}")
+        accounts.append(Account(handle, password, entry.get("system_prompt"), entry.get("model"), float(entry.get("weight", 1.0))))
+    if len({account.handle for account in accounts}) != len(accounts):
+        raise ValueError(f"Duplicate handles in {path}")
+    return accounts
+
+
+class FairShare:
+    # 全アカウントで同時に処理するスレッドの数を制限し、空いた枠は待っているアカウントに重みの比で順番に渡す
+    # (start-time fair queuing)。通知の多いアカウントがあっても、他のアカウントは枠が空くたびに順番が回ってくる
+    def __init__(self, slots: int, weights: t.Optional[t.Mapping[str, float]] = None):
+        self.slots = slots
+        self.weights = dict(weights or {})
+        self._cond = threading.Condition()
+        self._free = slots
+        self._waiting: t.Dict[str, int] = {}
+        self._start: t.Dict[str, float] = {}  # アカウントごとの仮想時刻。使うたびに1/重みだけ進む
+        self._now = 0.0
+        self.granted: t.Dict[str, int] = {}
+
+    def _next(self) -> t.Optional[str]:
+        return min(self._waiting, key=lambda name: (self._start[name], name), default=None)
+
+    def acquire(self, name: str):
+        with self._cond:
+            if name not in self._waiting:
+                # しばらく使っていなかったアカウントが、溜めた分でまとめて枠を取らないようにする
+                self._start[name] = max(self._start.get(name, 0.0), self._now)
+            self._waiting[name] = self._waiting.get(name, 0) + 1
+            while self._free == 0 or self._next() != name:
+                self._cond.wait()
+            self._waiting[name] -= 1
+            if self._waiting[name] == 0:
+                del self._waiting[name]
+            self._free -= 1
+            self._now = self._start[name]
+            self._start[name] += 1 / self.weights.get(name, 1.0)
+            self.granted[name] = self.granted.get(name, 0) + 1
+            self._cond.notify_all()
+
+    def release(self, name: str):
+        with self._cond:
+            self._free += 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, name: str) -> t.Iterator[None]:
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
@@ -0,0 +1,95 @@
+import threading
+import time
+import typing as t
+from collections import OrderedDict
+
+# 投稿1件あたりのおおよそのメモリ使用量(本文以外のuri, cid, authorなど)
+POST_OVERHEAD_BYTES = 1024
+
+
+def estimate_post_bytes(post) -> int:
+    text = post.record.text if post.record is not None else None
+    return POST_OVERHEAD_BYTES + (len(text.encode("utf-8")) if text else 0)
+
+
+class ThreadCache:
+    # 投稿URIをキーに、その投稿と親のURIを保持する。getでは親をたどって、根までの祖先チェーン(flatten_postsと同じく新しい順)を組み立てる
+    # 投稿はそれぞれ1つのエントリにだけ入るので、バイト数はキャッシュが実際に持っている投稿の分になる
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 10 * 60,
+        max_bytes: int = 32 * 1024 * 1024,
+        clock: t.Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        # uri -> (expires_at, size, post, parent_uri)。根の投稿はparent_uriがNone
+        self._entries: "OrderedDict[str, t.Tuple[float, int, t.Any, t.Optional[str]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, uri: str) -> t.Optional[t.List]:
+        with self._lock:
+            now = self.clock()
+            posts = []
+            current: t.Optional[str] = uri
+            while current is not None:
+                entry = self._entries.get(current)
+                if entry is not None and entry[0] <= now:
+                    self._remove(current)
+                    entry = None
+                if entry is None:
+                    # 祖先のどれかが追い出されていたら、途中までのチェーンは返さない
+                    self.misses += 1
+                    return None
+                posts.append(entry[2])
+                current = entry[3]
+            for post in posts:
+                self._entries.move_to_end(post.uri)
+            self.hits += 1
+            return posts
+
+    def put(self, uri: str, posts: t.List):
+        # posts: uriの投稿とその祖先(新しい順)。祖先も登録し直す。根に近いものほど後に使ったことにして、先に追い出されないようにする
+        with self._lock:
+            expires_at = self.clock() + self.ttl
+            for i, post in enumerate(posts):
+                key = uri if i == 0 else post.uri
+                if key in self._entries:
+                    self._remove(key)
+                size = estimate_post_bytes(post)
+                self._entries[key] = (expires_at, size, post, posts[i + 1].uri if i + 1 < len(posts) else None)
+                self.bytes += size
+            while len(self._entries) > self.max_entries or (self.bytes > self.max_bytes and len(self._entries) > 1):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def put_chain(self, posts: t.List):
+        # 祖先それぞれについても、そこから根までのチェーンが得られるようにしておく
+        if posts:
+            self.put(posts[0].uri, posts)
+
+    def stats(self) -> t.Dict[str, t.Union[int, float]]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _remove(self, uri: str):
+        _, size, _, _ = self._entries.pop(uri)
+        self.bytes -= size
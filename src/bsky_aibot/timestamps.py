@@ -0,0 +1,42 @@
+import functools
+import re
+from datetime import datetime, timedelta, timezone
+
+from dateutil.parser import isoparse
+
+# <https://www.rfc-editor.org/rfc/rfc3339#section-5.6> "2023-07-02T20:30:00.123Z", "2023-07-02T20:30:00+09:00" など
+RFC3339_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})[Tt ](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?(?:[Zz]|([+-])(\d{2}):(\d{2}))")
+
+
+def parse_rfc3339(value: str) -> datetime:
+    # dateutil.parser.parseのように形式を推測せず、RFC 3339の形式だけを受け付ける
+    match = RFC3339_PATTERN.fullmatch(value)
+    if match is None:
+        raise ValueError(f"Not an RFC 3339 timestamp: {value!r}")
+    year, month, day, hour, minute, second, fraction, sign, offset_hours, offset_minutes = match.groups()
+    tz = timezone.utc
+    if sign is not None and (offset_hours != "00" or offset_minutes != "00"):
+        offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        tz = timezone(offset if sign == "+" else -offset)
+    microsecond = int(fraction[:6].ljust(6, "0")) if fraction else 0
+    # うるう秒(:60)はdatetimeで表せないので、:59として扱う
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), min(int(second), 59), microsecond, tz)
+
+
+@functools.lru_cache(maxsize=8192)
+def timestamp(value: str) -> float:
+    # epoch秒。同じ通知はポーリングのたびに、また優先度の計算でも何度も見るので、文字列ごとにキャッシュする
+    try:
+        return parse_rfc3339(value).timestamp()
+    except ValueError:
+        # 形式から外れたもの(タイムゾーンが無いなど)は、UTCとして緩く解釈する
+        parsed = isoparse(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed.timestamp()
+
+
+def indexed_timestamp(item) -> float:
+    # bsky_aibot.posts.Postなら解析済みの値を使い、SDKのモデルや通知ならindexedAtを解析する
+    value = getattr(item, "timestamp", None)
+    return value if isinstance(value, float) else timestamp(item.indexedAt)
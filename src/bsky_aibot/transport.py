@@ -0,0 +1,195 @@
+import logging
+import random
+import threading
+import time
+import typing as t
+import weakref
+
+import httpx
+
+# XRPCのqueryはGETなので、再試行しても副作用が無い
+IDEMPOTENT_METHODS = {"GET", "HEAD"}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def has_h2() -> bool:
+    # HTTP/2にはh2が必要(pip install 'httpx[http2]')
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        logging.warning("h2 is not installed; falling back to HTTP/1.1")
+        return False
+    return True
+
+
+class ConnectionStats:
+    # 送ったリクエスト数と、そのために新しく張った接続の数
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.retries = 0
+
+    def record(self, new_connections: int):
+        with self._lock:
+            self.requests += 1
+            self.connections += new_connections
+
+    def retried(self):
+        with self._lock:
+            self.retries += 1
+
+    @property
+    def reuse_rate(self) -> float:
+        return 1 - self.connections / self.requests if self.requests else 0.0
+
+    def as_dict(self) -> t.Dict[str, float]:
+        return {"requests": self.requests, "connections": self.connections, "reuse_rate": round(self.reuse_rate, 3), "retries": self.retries}
+
+
+class RetryTransport(httpx.HTTPTransport):
+    # 冪等なリクエストだけを、接続エラーやタイムアウト、5xx/429のときに待ってから再試行する
+    # 待ち時間はfull jitter: [0, min(max_backoff, backoff * 2^n)) の一様乱数
+    def __init__(
+        self,
+        retries: int = 2,
+        backoff: float = 0.5,
+        max_backoff: float = 8.0,
+        sleep: t.Callable[[float], None] = time.sleep,
+        jitter: t.Callable[[], float] = random.random,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.jitter = jitter
+        self.stats = ConnectionStats()
+        self._seen: "weakref.WeakSet[t.Any]" = weakref.WeakSet()
+        self._seen_lock = threading.Lock()
+
+    def delay(self, attempt: int, response: t.Optional[httpx.Response] = None) -> float:
+        delay = self.jitter() * min(self.max_backoff, self.backoff * 2**attempt)
+        if response is not None and "retry-after" in response.headers:
+            try:
+                delay = max(delay, float(response.headers["retry-after"]))
+            except ValueError:
+                pass
+        return delay
+
+    def count_new_connections(self) -> int:
+        with self._seen_lock:
+            new = [c for c in self._pool.connections if c not in self._seen]
+            for connection in new:
+                self._seen.add(connection)
+        return len(new)
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        retryable = request.method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            try:
+                response = super().handle_request(request)
+            except (httpx.TimeoutException, httpx.NetworkError):
+                self.stats.record(self.count_new_connections())
+                if not retryable or attempt >= self.retries:
+                    raise
+                delay = self.delay(attempt)
+            else:
+                self.stats.record(self.count_new_connections())
+                if not retryable or attempt >= self.retries or response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = self.delay(attempt, response)
+                if delay > self.max_backoff:
+                    return response  # 長く待つ必要があるなら、呼び出し側(スケジューラ)に任せる
+                response.read()  # 読み切ってから閉じると、接続をプールに戻せる
+                response.close()
+            attempt += 1
+            self.stats.retried()
+            logging.info(f"Retrying {request.method} {request.url.path} in {delay:.2f}s (attempt {attempt})")
+            self.sleep(delay)
+
+
+class Transport:
+    # PDSとOpenAIへの接続を、タイムアウトとプールの大きさを決めたうえで使い回す
+    def __init__(
+        self,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 30.0,
+        llm_read_timeout: float = 120.0,
+        pool_size: int = 10,
+        keepalive_expiry: float = 60.0,
+        retries: int = 2,
+        backoff: float = 0.5,
+        http2: bool = False,
+    ):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.llm_read_timeout = llm_read_timeout
+        self.pool_size = pool_size
+        self.keepalive_expiry = keepalive_expiry
+        self.retries = retries
+        self.backoff = backoff
+        self.http2 = http2
+        self._pds_transport: t.Optional[RetryTransport] = None
+        self._openai_adapter = None
+
+    def pds_transport(self) -> RetryTransport:
+        if self._pds_transport is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size, keepalive_expiry=self.keepalive_expiry)
+            self._pds_transport = RetryTransport(self.retries, self.backoff, limits=limits, http2=self.http2 and has_h2())
+        return self._pds_transport
+
+    def install(self, client) -> None:
+        # atprotoのClientが持つhttpx.Clientを、設定済みのものに差し替える
+        old = client.request._client
+        if getattr(old, "_transport", None) is self._pds_transport:
+            return
+        client.request._client = httpx.Client(
+            transport=self.pds_transport(),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            event_hooks=old.event_hooks,
+        )
+        old.close()
+
+    @property
+    def openai_timeout(self) -> t.Tuple[float, float]:
+        # requestsの(connect, read)。ストリーミングでは、チャンクの間隔がread_timeoutを超えたら失敗する
+        return self.connect_timeout, self.llm_read_timeout
+
+    def install_openai(self, openai) -> None:
+        # openaiはスレッドごとにセッションを作り、180秒ごとに閉じて作り直す
+        # セッション自体は共有せず、スレッドごとのセッションに共有のアダプタ(接続プール)を付けて、プールを1つにする
+        if self._openai_adapter is not None:
+            return
+        import requests
+
+        class SharedHTTPAdapter(requests.adapters.HTTPAdapter):
+            def close(self):
+                pass  # 1つのスレッドがセッションを閉じても、他のスレッドが使っているプールは閉じない
+
+        adapter = SharedHTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=self.retries)
+
+        def session() -> requests.Session:
+            s = requests.Session()
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            return s
+
+        self._openai_adapter = adapter
+        openai.requestssession = session
+
+    def openai_stats(self) -> t.Dict[str, float]:
+        if self._openai_adapter is None:
+            return {}
+        requests_count = connections = 0
+        pools = self._openai_adapter.poolmanager.pools
+        for pool in (pools[key] for key in pools.keys()):
+            requests_count += pool.num_requests
+            connections += pool.num_connections
+        reuse_rate = 1 - connections / requests_count if requests_count else 0.0
+        return {"requests": requests_count, "connections": connections, "reuse_rate": round(reuse_rate, 3)}
+
+    def stats(self) -> t.Dict[str, t.Dict[str, float]]:
+        return {"pds": self.pds_transport().stats.as_dict(), "openai": self.openai_stats()}
@@ -0,0 +1,231 @@
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import typing as t
+
+from atproto.xrpc_client import models
+from atproto.xrpc_client.models.utils import get_model_as_dict, get_or_create
+
+from bsky_aibot.metrics import METRICS
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+DEAD = "dead"
+
+
+def encode_notification(notification: "models.AppBskyNotificationListNotifications.Notification") -> str:
+    return json.dumps(get_model_as_dict(notification), ensure_ascii=False)
+
+
+def decode_notification(payload: str) -> "models.AppBskyNotificationListNotifications.Notification":
+    data = json.loads(payload)
+    data.pop("$type", None)  # トップレベルの$typeはモデルのフィールドに無い
+    return get_or_create(data, models.AppBskyNotificationListNotifications.Notification)
+
+
+class WorkQueue:
+    # ポーリングするプロセスが積んだ通知を、複数のワーカープロセスで取り合うSQLiteのキュー
+    # 取ったものはlease秒以内に終えなければ、他のワーカーが取り直せる。失敗したものはretry_delay * 2^n秒後に取り直す
+    def __init__(
+        self,
+        path: str,
+        lease: float = 600.0,
+        max_attempts: int = 3,
+        retry_delay: float = 10.0,
+        retention: float = 24 * 60 * 60,
+        clock: t.Callable[[], float] = time.time,
+    ):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS work ("
+            " uri TEXT PRIMARY KEY, root TEXT NOT NULL, payload TEXT NOT NULL, state TEXT NOT NULL,"
+            " worker TEXT, claimed_at REAL, attempts INTEGER NOT NULL DEFAULT 0, created_at REAL NOT NULL, available_at REAL NOT NULL, finished_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS work_state_created_at ON work (state, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS work_root ON work (root, state)")
+
+    def put(self, uri: str, root: str, payload: str) -> bool:
+        # 未読判定の重複期間で同じ通知がまた届いても、1回しか積まない
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO work (uri, root, payload, state, created_at, available_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (uri, root, payload, PENDING, self.clock(), self.clock()),
+            )
+        return cursor.rowcount > 0
+
+    def claim(self, worker: str) -> t.List[t.Tuple[str, str]]:
+        # 他のワーカーが処理中でないスレッドのうち一番古いものを、そのスレッドへの通知ごと取る
+        # 同じスレッドへの返信は、プロセスをまたいでも届いた順に1つずつ処理される
+        now = self.clock()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("UPDATE work SET state = ?, worker = NULL WHERE state = ? AND claimed_at < ?", (PENDING, CLAIMED, now - self.lease))
+                row = self._conn.execute(
+                    "SELECT root FROM work w WHERE state = ? AND available_at <= ?"
+                    " AND NOT EXISTS (SELECT 1 FROM work c WHERE c.root = w.root AND c.state = ?) ORDER BY created_at LIMIT 1",
+                    (PENDING, now, CLAIMED),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return []
+                rows = self._conn.execute("SELECT uri, payload FROM work WHERE root = ? AND state = ? ORDER BY created_at", (row[0], PENDING)).fetchall()
+                self._conn.execute("UPDATE work SET state = ?, worker = ?, claimed_at = ? WHERE root = ? AND state = ?", (CLAIMED, worker, now, row[0], PENDING))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return rows
+
+    def done(self, uris: t.Sequence[str]):
+        with self._lock:
+            self._conn.executemany("UPDATE work SET state = ?, worker = NULL, finished_at = ? WHERE uri = ?", [(DONE, self.clock(), uri) for uri in uris])
+
+    def fail(self, uris: t.Sequence[str]):
+        # max_attempts回失敗したものは諦める(毎回ワーカーを落とす通知で詰まらないように)
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE work SET attempts = attempts + 1, worker = NULL, available_at = ? * (1 << attempts) + ?,"
+                " state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, finished_at = CASE WHEN attempts + 1 >= ? THEN ? ELSE NULL END WHERE uri = ?",
+                [(self.retry_delay, self.clock(), self.max_attempts, DEAD, PENDING, self.max_attempts, self.clock(), uri) for uri in uris],
+            )
+
+    def release_worker(self, worker: str) -> int:
+        # 落ちたワーカーが処理中だったものを戻す。落ちた原因かもしれないので失敗として数える
+        with self._lock:
+            uris = [row[0] for row in self._conn.execute("SELECT uri FROM work WHERE state = ? AND worker = ?", (CLAIMED, worker)).fetchall()]
+        self.fail(uris)
+        return len(uris)
+
+    def pending(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM work WHERE state IN (?, ?)", (PENDING, CLAIMED)).fetchone()[0]
+
+    def stats(self) -> t.Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM work GROUP BY state").fetchall()
+        return {**{state: 0 for state in (PENDING, CLAIMED, DONE, DEAD)}, **dict(rows)}
+
+    def compact(self) -> int:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM work WHERE state IN (?, ?) AND finished_at < ?", (DONE, DEAD, self.clock() - self.retention))
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def work(queue: WorkQueue, worker: str, handle: t.Callable[[t.List[str]], None], should_stop: t.Callable[[], bool], idle_wait: float = 0.5, sleep: t.Callable[[float], None] = time.sleep) -> int:
+    # キューが空なら少し待って取り直す。1件の失敗でワーカーを止めず、その通知だけを失敗として戻す
+    processed = 0
+    while not should_stop():
+        batch = queue.claim(worker)
+        if not batch:
+            sleep(idle_wait)
+            continue
+        uris = [uri for uri, _ in batch]
+        try:
+            handle([payload for _, payload in batch])
+        except Exception as e:
+            logging.exception(f"Failed to process {uris}: {e}")
+            queue.fail(uris)
+        else:
+            queue.done(uris)
+            processed += len(uris)
+    return processed
+
+
+class WorkerPool:
+    # ワーカープロセスを起動して見張り、落ちたものは処理中だった通知をキューに戻してから起動し直す
+    # targetは(番号, 停止のEvent)を受け取り、os.getpid()をワーカー名としてキューから取る
+    def __init__(self, target: t.Callable[[int, t.Any], None], size: int, queue: WorkQueue, check_interval: float = 1.0, context=None):
+        self.target = target
+        self.size = size
+        self.queue = queue
+        self.check_interval = check_interval
+        # forkだとスレッドやソケットを引き継いでしまうので、新しいインタプリタで起動する
+        self.context = context or multiprocessing.get_context("spawn")
+        self.stop_event = self.context.Event()
+        self.processes: t.List[t.Optional[multiprocessing.Process]] = [None] * size
+        self.restarts = 0
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._supervisor: t.Optional[threading.Thread] = None
+
+    def spawn(self, index: int):
+        process = self.context.Process(target=self.target, args=(index, self.stop_event), name=f"worker-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        logging.info(f"Started worker {index} (pid {process.pid})")
+
+    def start(self):
+        for index in range(self.size):
+            self.spawn(index)
+        self._supervisor = threading.Thread(target=self.supervise, name="worker-supervisor", daemon=True)
+        self._supervisor.start()
+
+    def check(self) -> int:
+        # 落ちたワーカーの数を返す
+        crashed = 0
+        with self._lock:
+            if self._stopped.is_set():
+                return 0
+            for index, process in enumerate(self.processes):
+                if process is None or process.is_alive():
+                    continue
+                crashed += 1
+                released = self.queue.release_worker(str(process.pid))
+                logging.error(f"Worker {index} (pid {process.pid}) exited with {process.exitcode}; released {released} notifications")
+                METRICS.inc("worker_restarts_total")
+                self.restarts += 1
+                self.spawn(index)
+        return crashed
+
+    def supervise(self):
+        while not self._stopped.wait(self.check_interval):
+            try:
+                self.check()
+            except Exception as e:
+                logging.exception(f"Failed to check workers: {e}")
+
+    def drain(self, timeout: float, sleep: t.Callable[[float], None] = time.sleep) -> bool:
+        # 積まれている通知がなくなるまで待つ。間に合わなければ残りはキューに残り、次の起動で処理される
+        deadline = time.monotonic() + timeout
+        while self.queue.pending() > 0:
+            if time.monotonic() >= deadline:
+                return False
+            sleep(min(self.check_interval, 0.2))
+        return True
+
+    def stop(self, timeout: float = 30.0):
+        # ワーカーは処理中の通知を終えてから止まる
+        with self._lock:
+            self._stopped.set()
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            if process is not None:
+                process.join(max(0.0, deadline - time.monotonic()))
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                logging.warning(f"Terminating {process.name} (pid {process.pid})")
+                process.terminate()
+                process.join()
+                self.queue.release_worker(str(process.pid))
+        if self._supervisor is not None:
+            self._supervisor.join()
@@ -1,7 +1,16 @@
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
 import pytest
 
+from bsky_aibot import app
 from bsky_aibot.app import (filter_mentions_and_replies_from_notifications,
-                            thread_to_messages)
+                            filter_unread_notifications, iter_notifications,
+                            reply_to_notifications, thread_to_messages,
+                            unread_notifications)
+from bsky_aibot.checkpoint import load_checkpoint
+from bsky_aibot.priority import ReplyPolicy
 
 
 class RecursiveDictWrapper:
@@ -474,5 +483,230 @@ def test_filter_mentions_and_replies_from_notifications(thread, expected):
         assert r == e, f"{r} != {e}"
 
 
+class FakeNotificationClient:
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+        self.bsky = RecursiveDictWrapper({"notification": {}})
+        self.bsky.notification.list_notifications = self.list_notifications
+
+    def list_notifications(self, params):
+        self.requests.append(params)
+        index = int(params.get("cursor", 0))
+        cursor = str(index + 1) if index + 1 < len(self.pages) else None
+        return RecursiveDictWrapper({"notifications": self.pages[index], "cursor": cursor})
+
+
+def notification(uri, indexed_at, root=None, reason="mention"):
+    record = {} if root is None else {"reply": {"root": {"uri": root, "cid": root}, "parent": {"uri": root, "cid": root}}}
+    return RecursiveDictWrapper({"uri": uri, "cid": uri, "reason": reason, "indexedAt": indexed_at, "record": record})
+
+
+def test_iter_notifications_stops_paging_at_checkpoint():
+    client = FakeNotificationClient(
+        [
+            [notification("at://a/3", "2023-07-02T20:30:00.000Z"), notification("at://a/2", "2023-07-02T20:20:00.000Z")],
+            [notification("at://a/1", "2023-07-02T20:10:00.000Z"), notification("at://a/0", "2023-07-02T20:00:00.000Z")],
+            [notification("at://a/-1", "2023-07-02T19:50:00.000Z")],
+        ]
+    )
+    seen_at = datetime(2023, 7, 2, 20, 7, tzinfo=timezone.utc)
+    result = list(filter_unread_notifications(iter_notifications(client, limit=2), seen_at))
+    assert [n.uri for n in result] == ["at://a/3", "at://a/2", "at://a/1"]
+    assert client.requests == [{"limit": 2}, {"limit": 2, "cursor": "1"}]
+
+
+def test_unread_notifications_bounds_an_old_checkpoint():
+    pages = [
+        [notification("at://a/3", "2023-07-02T20:30:00.000Z"), notification("at://a/2", "2023-07-02T20:20:00.000Z")],
+        [notification("at://a/1", "2023-07-02T20:10:00.000Z"), notification("at://a/0", "2023-07-02T19:50:00.000Z")],
+        [notification("at://a/-1", "2023-07-02T19:40:00.000Z")],
+    ]
+    now = datetime(2023, 7, 2, 21, 0, tzinfo=timezone.utc)
+    # 1週間止まっていた: 1時間より古い通知には返信せず、それより先のページも取得しない
+    client = FakeNotificationClient(pages)
+    result = list(unread_notifications(client, now - timedelta(days=7), max_age=60 * 60, now=now))
+    assert [n.uri for n in result] == ["at://a/3", "at://a/2", "at://a/1"]
+    assert len(client.requests) == 2
+    # ページ数の上限
+    client = FakeNotificationClient(pages)
+    result = list(unread_notifications(client, now - timedelta(days=7), max_pages=1, max_age=7 * 24 * 60 * 60, now=now))
+    assert [n.uri for n in result] == ["at://a/3", "at://a/2"]
+    assert len(client.requests) == 1
+
+
+def test_reply_to_notifications_keeps_per_thread_order(monkeypatch):
+    handled = []
+    monkeypatch.setattr(app, "reply_to_thread_notifications", lambda client, ns, did, services: handled.extend(n.uri for n in ns))
+    ns = [
+        notification("at://a/1", "2023-07-02T20:30:00.000Z", root="at://root/a"),
+        notification("at://b/1", "2023-07-02T20:29:00.000Z"),
+        notification("at://a/2", "2023-07-02T20:28:00.000Z", root="at://root/a"),
+    ]
+    assert reply_to_notifications(None, iter(ns), "did:plc:bot", max_in_flight=2, coalesce_window=0) == 3
+    assert sorted(handled) == ["at://a/1", "at://a/2", "at://b/1"]
+    assert handled.index("at://a/1") < handled.index("at://a/2")
+
+
+def test_reply_to_notifications_coalesces_same_thread(monkeypatch):
+    batches = []
+    monkeypatch.setattr(app, "reply_to_thread_notifications", lambda client, ns, did, services: batches.append([n.uri for n in ns]))
+    ns = [
+        notification("at://a/1", "2023-07-02T20:30:00.000Z", root="at://root/a"),
+        notification("at://b/1", "2023-07-02T20:29:00.000Z"),
+        notification("at://a/2", "2023-07-02T20:28:00.000Z", root="at://root/a"),
+    ]
+    reply_to_notifications(None, iter(ns), "did:plc:bot", max_in_flight=2, coalesce_window=0.1)
+    assert sorted(batches) == [["at://a/1", "at://a/2"], ["at://b/1"]]
+
+
+def test_reply_to_notifications_waits_only_while_input_can_grow(monkeypatch):
+    batches = []
+    monkeypatch.setattr(app, "reply_to_thread_notifications", lambda client, ns, did, services: batches.append([n.uri for n in ns]))
+
+    def stream():
+        yield notification("at://a/1", "2023-07-02T20:30:00.000Z", root="at://root/a")
+        time.sleep(0.05)  # ストリームでは、待っている間に同じスレッドへの通知が届く
+        yield notification("at://a/2", "2023-07-02T20:30:01.000Z", root="at://root/a")
+
+    started_at = time.monotonic()
+    reply_to_notifications(None, stream(), "did:plc:bot", max_in_flight=2, coalesce_window=10)
+    # 取得済みのページは、読み終えたらすぐに処理する
+    reply_to_notifications(None, iter([notification("at://b/1", "2023-07-02T20:29:00.000Z")]), "did:plc:bot", max_in_flight=2, coalesce_window=10)
+    assert time.monotonic() - started_at < 5
+    assert batches == [["at://a/1", "at://a/2"], ["at://b/1"]]
+
+
+def test_reply_to_notifications_reports_errors_without_stopping(monkeypatch):
+    handled = []
+
+    def reply(client, ns, did, services):
+        if ns[0].uri == "at://a/1":
+            raise RuntimeError("boom")
+        handled.extend(n.uri for n in ns)
+
+    monkeypatch.setattr(app, "reply_to_thread_notifications", reply)
+    errors = []
+
+    def stream():
+        yield notification("at://a/1", "2023-07-02T20:30:00.000Z", root="at://root/a")
+        time.sleep(0.1)
+        # 同じスレッドへの通知も、失敗したものの後で処理される
+        yield notification("at://a/2", "2023-07-02T20:30:01.000Z", root="at://root/a")
+        yield notification("at://b/1", "2023-07-02T20:30:02.000Z")
+
+    count = reply_to_notifications(None, stream(), "did:plc:bot", max_in_flight=2, coalesce_window=0, on_error=errors.append)
+    assert count == 3
+    assert sorted(handled) == ["at://a/2", "at://b/1"]
+    assert [str(e) for e in errors] == ["boom"]
+    # on_errorが無ければ従来通り例外を送出する
+    with pytest.raises(RuntimeError):
+        reply_to_notifications(None, iter([notification("at://a/1", "2023-07-02T20:30:00.000Z")]), "did:plc:bot", coalesce_window=0)
+
+
+def test_stream_housekeeping_runs_on_a_timer(tmp_path):
+    client = FakeNotificationClient([[]])
+    seen = []
+    client.bsky.notification.update_seen = lambda data: seen.append(data)
+    saved = []
+    session_store = SimpleNamespace(save_if_changed=lambda client: saved.append(client))
+    now = [0.0]
+    checkpoint_path = str(tmp_path / "checkpoint")
+    started_at = datetime.now(tz=timezone.utc)
+    tick = app.stream_housekeeping(client, app.Services(), session_store, checkpoint_path, interval=60, clock=lambda: now[0])
+    tick()
+    assert seen == [] and saved == []
+    now[0] = 61
+    tick()
+    tick()
+    assert len(seen) == 1 and len(saved) == 1
+    # 既読にするのは前回(ここでは作ったとき)の時刻まで
+    assert started_at <= load_checkpoint(checkpoint_path) <= datetime.now(tz=timezone.utc)
+    now[0] = 122
+    client.bsky.notification.update_seen = None  # 失敗しても購読は続ける
+    tick()
+    assert len(saved) == 1
+
+
+def test_reply_to_notifications_prioritizes_backlog(monkeypatch):
+    handled = []
+    monkeypatch.setattr(app, "reply_to_thread_notifications", lambda client, ns, did, services: handled.extend(n.uri for n in ns))
+    now = datetime(2023, 7, 2, 20, 30, tzinfo=timezone.utc).timestamp()
+    ns = [
+        notification("at://old/1", "2023-07-02T20:10:00.000Z", reason="mention"),
+        notification("at://reply/1", "2023-07-02T20:29:00.000Z", reason="reply"),
+        notification("at://mention/1", "2023-07-02T20:29:00.000Z", reason="mention"),
+        notification("at://did:plc:vip/1", "2023-07-02T20:25:00.000Z", reason="reply"),
+        notification("at://low/1", "2023-07-02T20:28:00.000Z", reason="reply"),
+        notification("at://low/2", "2023-07-02T20:28:00.000Z", reason="reply"),
+    ]
+    services = app.Services(reply_policy=ReplyPolicy(author_weights={"did:plc:vip": 8}, deadline=600, high_water=4))
+    assert reply_to_notifications(None, iter(ns), "did:plc:bot", max_in_flight=1, services=services, coalesce_window=0.1, clock=lambda: now) == 6
+    # 溢れた分は、期限切れのものと優先度の低いものから捨てる
+    assert handled == ["at://did:plc:vip/1", "at://mention/1", "at://reply/1", "at://low/1"]
+
+
+@pytest.mark.parametrize("action, expected", [("drop", ["at://new/1"]), ("defer", ["at://new/1", "at://old/1"])])
+def test_reply_to_notifications_applies_deadline(monkeypatch, action, expected):
+    handled = []
+    monkeypatch.setattr(app, "reply_to_thread_notifications", lambda client, ns, did, services: handled.extend(n.uri for n in ns))
+    now = datetime(2023, 7, 2, 20, 30, tzinfo=timezone.utc).timestamp()
+    ns = [
+        notification("at://old/1", "2023-07-02T20:10:00.000Z"),
+        notification("at://new/1", "2023-07-02T20:29:00.000Z", reason="reply"),
+    ]
+    services = app.Services(reply_policy=ReplyPolicy(deadline=600, deadline_action=action))
+    reply_to_notifications(None, iter(ns), "did:plc:bot", max_in_flight=1, services=services, coalesce_window=0.1, clock=lambda: now)
+    assert handled == expected
+
+
+def thread_view(uri, did, replies=()):
+    # getPostThreadの応答のJSON
+    post = {"uri": uri, "cid": uri, "author": {"did": did, "handle": "hiroga.bsky.social", "avatar": "https://cdn.bsky.app/avatar"}, "record": {"text": uri}, "indexedAt": "2023-07-02T20:00:00.000Z"}
+    return {"$type": "app.bsky.feed.defs#threadViewPost", "post": post, "replies": list(replies)}
+
+
+class FakeThreadClient:
+    def __init__(self, thread):
+        self.thread = thread
+        self.requests = []
+
+    def invoke_query(self, nsid, params):
+        self.requests.append(params)
+        return SimpleNamespace(content={"thread": self.thread})
+
+
+@pytest.mark.parametrize(
+    "mode, expected",
+    [
+        ("each", ["at://a/1", "at://a/3"]),
+        ("latest", ["at://a/3"]),
+    ],
+)
+def test_reply_to_thread_notifications_fetches_thread_once(monkeypatch, mode, expected):
+    user, bot = "did:plc:et47te5fb7uv64pbltu37lcc", "did:plc:d7mnkzaznaop33oiowcbco7g"
+    thread = thread_view(
+        "at://root/a",
+        user,
+        [
+            thread_view("at://a/1", user),
+            thread_view("at://a/2", user, [thread_view("at://bot/1", bot)]),
+            thread_view("at://a/3", user),
+        ],
+    )
+    client = FakeThreadClient(thread)
+    sent = []
+    monkeypatch.setattr(app, "send_reply", lambda client, n, posts, did, services: sent.append((n.uri, [p.uri for p in posts])))
+    ns = [
+        notification("at://a/3", "2023-07-02T20:30:00.000Z", root="at://root/a"),
+        notification("at://a/2", "2023-07-02T20:29:00.000Z", root="at://root/a"),
+        notification("at://a/1", "2023-07-02T20:28:00.000Z", root="at://root/a"),
+    ]
+    app.reply_to_thread_notifications(client, ns, bot, app.Services(), mode=mode)
+    assert len(client.requests) == 1
+    assert sorted(uri for uri, _ in sent) == expected
+    assert all(posts[-1] == "at://root/a" for _, posts in sent)
+
+
 if __name__ == "__main__":
     pytest.main()
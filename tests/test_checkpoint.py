@@ -0,0 +1,11 @@
+from datetime import datetime, timezone
+
+from bsky_aibot.checkpoint import load_checkpoint, save_checkpoint
+
+
+def test_checkpoint_roundtrip(tmp_path):
+    path = str(tmp_path / "state" / "checkpoint")
+    assert load_checkpoint(path) is None
+    seen_at = datetime(2023, 7, 2, 20, 20, 24, 142000, tzinfo=timezone.utc)
+    save_checkpoint(path, seen_at)
+    assert load_checkpoint(path) == seen_at
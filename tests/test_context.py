@@ -0,0 +1,32 @@
+from bsky_aibot.context import build_context, count_messages_tokens
+
+SYSTEM = [{"role": "system", "content": "Reply friendly in 280 characters or less. No @mentions."}]
+
+
+def turns(n):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"turn {i} " + "word " * 40, "name": "hiroga_bsky_social"} for i in range(n)]
+
+
+def test_build_context_keeps_short_threads():
+    messages, saved = build_context(SYSTEM, turns(3), budget=10000, recent_turns=2)
+    assert messages == SYSTEM + turns(3)
+    assert saved == 0
+
+
+def test_build_context_elides_middle():
+    posts = turns(20)
+    budget = count_messages_tokens(SYSTEM + posts[:1] + posts[-5:]) + 20
+    messages, saved = build_context(SYSTEM, posts, budget=budget, recent_turns=4)
+    assert messages[0] == SYSTEM[0]
+    assert messages[1] == posts[0]
+    assert messages[2]["role"] == "system" and "omitted" in messages[2]["content"]
+    assert messages[-4:] == posts[-4:]
+    assert count_messages_tokens(messages) <= budget
+    assert saved > 0
+
+
+def test_build_context_drops_oldest_recent_turns_when_over_budget():
+    posts = turns(10)
+    messages, _ = build_context(SYSTEM, posts, budget=count_messages_tokens(SYSTEM + posts[-1:]) + 10, recent_turns=4)
+    assert messages[-1] == posts[-1]
+    assert posts[0] not in messages
@@ -0,0 +1,138 @@
+import base64
+import hashlib
+import socket
+import threading
+import time
+
+import dag_cbor
+from atproto.xrpc_client.models.utils import get_or_create
+from multiformats import CID, multihash
+
+from bsky_aibot.firehose import RepoStream, load_cursor, notification_reason
+
+BOT_DID = "did:plc:d7mnkzaznaop33oiowcbco7g"
+USER_DID = "did:plc:et47te5fb7uv64pbltu37lcc"
+
+
+def cid_for(block: dict) -> CID:
+    return CID("base32", 1, "dag-cbor", multihash.digest(dag_cbor.encode(block), "sha2-256"))
+
+
+def varint(n: int) -> bytes:
+    out = b""
+    while True:
+        byte = n & 0x7F
+        n >>= 7
+        if n:
+            out += bytes([byte | 0x80])
+        else:
+            return out + bytes([byte])
+
+
+def car_bytes(blocks: list) -> bytes:
+    header = dag_cbor.encode({"version": 1, "roots": [cid_for(blocks[0])]})
+    data = varint(len(header)) + header
+    for block in blocks:
+        body = bytes(cid_for(block)) + dag_cbor.encode(block)
+        data += varint(len(body)) + body
+    return data
+
+
+def commit_frame(seq: int, repo: str, rkey: str, record: dict) -> bytes:
+    body = {
+        "seq": seq,
+        "repo": repo,
+        "time": "2023-07-02T20:20:24.142Z",
+        "commit": cid_for(record),
+        "prev": None,
+        "rebase": False,
+        "tooBig": False,
+        "blobs": [],
+        "ops": [{"action": "create", "path": f"app.bsky.feed.post/{rkey}", "cid": cid_for(record)}],
+        "blocks": car_bytes([record]),
+    }
+    return dag_cbor.encode({"op": 1, "t": "#commit"}) + dag_cbor.encode(body)
+
+
+def mention(text: str) -> dict:
+    return {
+        "$type": "app.bsky.feed.post",
+        "text": text,
+        "createdAt": "2023-07-02T20:20:23.873Z",
+        "facets": [
+            {
+                "index": {"byteStart": 0, "byteEnd": 18},
+                "features": [{"$type": "app.bsky.richtext.facet#mention", "did": BOT_DID}],
+            }
+        ],
+    }
+
+
+def reply(text: str, parent: str, root: str = None) -> dict:
+    ref = {"uri": parent, "cid": "bafyreihhaywzcphtjj43mknbmv3czuhv4r6gps3hz6zcmqld5l5vs2ebyu"}
+    root_ref = ref if root is None else {"uri": root, "cid": ref["cid"]}
+    return {"$type": "app.bsky.feed.post", "text": text, "createdAt": "2023-07-02T20:20:23.873Z", "reply": {"root": root_ref, "parent": ref}}
+
+
+class ReplayServer:
+    # 記録済みのフレームを送ってから切断するだけのwebsocketサーバー
+    def __init__(self, frames: list):
+        self.frames = frames
+        self.requests = []
+        self.sock = socket.socket()
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.listen()
+        self.url = f"ws://127.0.0.1:{self.sock.getsockname()[1]}/xrpc/com.atproto.sync.subscribeRepos"
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            request = conn.recv(65536).decode()
+            self.requests.append(request.split("\r\n")[0])
+            key = [line.split(":", 1)[1].strip() for line in request.split("\r\n") if line.lower().startswith("sec-websocket-key")][0]
+            accept = base64.b64encode(hashlib.sha1((key + "258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode()).digest()).decode()
+            conn.sendall(f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n".encode())
+            time.sleep(0.1)  # ハンドシェイクの応答とフレームが同じ読み込みに入らないようにする
+            for frame in self.frames:
+                header = bytes([0x82]) + (bytes([len(frame)]) if len(frame) < 126 else bytes([126]) + len(frame).to_bytes(2, "big"))
+                conn.sendall(header + frame)
+            conn.sendall(bytes([0x88, 2]) + (1001).to_bytes(2, "big"))  # going away
+            conn.close()
+
+
+def test_repo_stream_filters_mentions_and_replies_and_resumes(tmp_path):
+    frames = [
+        commit_frame(1, USER_DID, "3jzkusvkvp72u", mention("@aibot.bsky.social hi")),
+        commit_frame(2, USER_DID, "3jzkusvkvp72v", {"$type": "app.bsky.feed.post", "text": "unrelated", "createdAt": "2023-07-02T20:20:23.873Z"}),
+        commit_frame(3, USER_DID, "3jzkusvkvp72w", reply("more please", f"at://{BOT_DID}/app.bsky.feed.post/3jzkv2kmakh2k")),
+        commit_frame(4, BOT_DID, "3jzkusvkvp72x", mention("talking to myself")),
+    ]
+    server = ReplayServer(frames)
+    cursor_path = str(tmp_path / "firehose_cursor")
+    ticks = []
+    stream = RepoStream(BOT_DID, server.url, cursor_path, on_tick=lambda: ticks.append(stream.seq))
+
+    ns = list(stream)
+    # 自分宛てでないフレームでも呼ばれる
+    assert len(ticks) == 4
+
+    assert [(n.uri, n.reason) for n in ns] == [
+        (f"at://{USER_DID}/app.bsky.feed.post/3jzkusvkvp72u", "mention"),
+        (f"at://{USER_DID}/app.bsky.feed.post/3jzkusvkvp72w", "reply"),
+    ]
+    assert ns[1].record.reply.root.uri == f"at://{BOT_DID}/app.bsky.feed.post/3jzkv2kmakh2k"
+    assert stream.dropped
+    assert load_cursor(cursor_path) == 4
+
+    server.frames = []
+    list(RepoStream(BOT_DID, server.url, cursor_path))
+    assert "cursor=4" in server.requests[-1]
+
+
+def test_replies_deeper_in_own_threads_are_notified():
+    bot_post = f"at://{BOT_DID}/app.bsky.feed.post/3jzkv2kmakh2k"
+    user_post = f"at://{USER_DID}/app.bsky.feed.post/3jzkusvkvp72w"
+    other_post = "at://did:plc:other/app.bsky.feed.post/3jzkusvkvp72z"
+    assert notification_reason(get_or_create(reply("deeper", parent=user_post, root=bot_post), strict=False), BOT_DID) == "reply"
+    assert notification_reason(get_or_create(reply("unrelated", parent=user_post, root=other_post), strict=False), BOT_DID) is None
@@ -0,0 +1,129 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from benchmarks.fake_servers import FakeOpenAI
+from bsky_aibot.llm import Backend, OpenAIBackend, Route, Router, StubBackend, parse_routes
+
+MESSAGES = [{"role": "user", "content": "hello", "name": "alice_bsky_social"}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_stub_backend_is_deterministic():
+    text, timing = StubBackend().generate(MESSAGES)
+    assert text == StubBackend().generate(MESSAGES)[0]
+    assert "alice_bsky_social" in text
+    assert timing.time_to_first_token is not None
+
+
+def test_router_routes_short_threads_to_fast_backend():
+    router = Router({"fast": StubBackend("fast"), "slow": StubBackend("slow")}, [Route("fast", max_messages=2), Route("slow")])
+    assert router.generate(MESSAGES, thread_length=1)[2] == "fast"
+    assert router.generate(MESSAGES * 3, thread_length=3)[2] == "slow"
+    assert router.stats()["decisions"] == {"fast/route": 1, "slow/route": 1}
+    assert set(router.stats()["latency"]) == {"fast", "slow"}
+
+
+def test_router_skips_slow_backend_until_probe():
+    clock = FakeClock()
+    router = Router({"fast": StubBackend("fast"), "slow": StubBackend("slow")}, [Route("fast", latency_budget=1.0), Route("slow")], probe_interval=60, clock=clock)
+    router.record_decision("fast", "route")
+    router.record_latency("fast", 5.0)
+    assert router.select(1, 10) == "slow"
+    clock.now += 61
+    assert router.select(1, 10) == "fast"
+
+
+def test_router_falls_back_on_timeout():
+    slept = []
+    router = Router({"primary": StubBackend("primary", latency=30, sleep=slept.append), "secondary": StubBackend("secondary")}, [Route("primary")], fallback="secondary", fallback_timeout=2)
+    text, _, backend = router.generate(MESSAGES, thread_length=1)
+    assert backend == "secondary"
+    assert slept == [2]
+    assert router.stats()["decisions"] == {"primary/route": 1, "secondary/fallback": 1}
+
+
+def test_router_waits_for_primary_without_fallback():
+    slept = []
+    router = Router({"primary": StubBackend("primary", latency=30, sleep=slept.append)}, [Route("primary")], fallback_timeout=2)
+    assert router.generate(MESSAGES, thread_length=1)[2] == "primary"
+    assert slept == [30]
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_openai_backend_talks_to_local_compatible_server(stream):
+    import openai
+
+    with FakeOpenAI(reply="Hi there from a local model.") as server:
+        backend = OpenAIBackend("llama3", lambda: openai, stream=stream, api_base=f"{server.url}/v1")
+        text, _ = backend.generate(MESSAGES)
+    assert text == "Hi there from a local model."
+    assert server.requests == 1
+
+
+@pytest.mark.parametrize("stream", [True, False])
+def test_openai_backend_applies_fallback_timeout_only_to_first_token(stream):
+    import openai
+
+    # 応答はすぐに始まるが、全体ではtimeoutより長くかかる
+    with FakeOpenAI(reply="Slow but steady reply.", token_delay=0.3) as server:
+        backend = OpenAIBackend("gpt-4", lambda: openai, stream=stream, api_base=f"{server.url}/v1", read_timeout=5)
+        text, _ = backend.generate(MESSAGES, timeout=0.2)
+    assert text == "Slow but steady reply."
+
+
+def test_openai_backend_stops_the_request_when_cut_off():
+    import openai
+
+    with FakeOpenAI(reply=" ".join(["cheese"] * 2000), token_delay=0.001) as server:
+        backend = OpenAIBackend("gpt-4", lambda: openai, stream=True, api_base=f"{server.url}/v1")
+        text, timing = backend.generate(MESSAGES)
+        assert timing.truncated
+        deadline = time.monotonic() + 5
+        while server.aborted == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert server.aborted == 1
+
+
+def test_parse_routes():
+    assert parse_routes("gpt-3.5-turbo?messages<=4&latency<=3, local/llama3?tokens<=2000,gpt-4") == [
+        Route("gpt-3.5-turbo", max_messages=4, latency_budget=3.0),
+        Route("local/llama3", max_tokens=2000),
+        Route("gpt-4"),
+    ]
+    with pytest.raises(ValueError):
+        parse_routes("gpt-4?turns<=3")
+
+
+def test_backend_requires_generate():
+    class Incomplete(Backend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_get_router_creates_one_router_for_concurrent_replies(monkeypatch):
+    from bsky_aibot import app
+
+    created = []
+
+    def create_router(services):
+        time.sleep(0.01)  # 作っている間に、他のスレッドも来る
+        created.append(Router({"stub": StubBackend()}, [Route("stub")]))
+        return created[-1]
+
+    monkeypatch.setattr(app, "create_router", create_router)
+    services = app.Services()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        routers = list(executor.map(lambda _: app.get_router(services), range(8)))
+    assert len(created) == 1
+    assert all(router is created[0] for router in routers)
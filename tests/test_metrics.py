@@ -0,0 +1,45 @@
+import urllib.request
+
+import pytest
+
+from bsky_aibot.metrics import NULL_TIMER, Metrics
+
+
+def test_disabled_metrics_record_nothing():
+    metrics = Metrics()
+    assert metrics.time("get_thread") is NULL_TIMER
+    metrics.inc("notifications_skipped_total", reason="index")
+    assert metrics.exposition() == "\n"
+    assert metrics.cycle_summary() == ""
+
+
+def test_stage_timer_records_latency_and_errors():
+    metrics = Metrics(enabled=True)
+    with metrics.time("get_thread"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.time("get_thread"):
+            raise ValueError()
+    metrics.inc("notifications_skipped_total", reason="index")
+
+    text = metrics.exposition()
+    assert 'bsky_aibot_stage_duration_seconds_count{stage="get_thread"} 2' in text
+    assert 'bsky_aibot_stage_duration_seconds_bucket{stage="get_thread",le="+Inf"} 2' in text
+    assert 'bsky_aibot_stage_errors_total{stage="get_thread"} 1' in text
+    assert 'bsky_aibot_notifications_skipped_total{reason="index"} 1' in text
+
+    summary = metrics.cycle_summary()
+    assert "get_thread=2x" in summary
+    assert "notifications_skipped_total[index]=1" in summary
+    assert metrics.cycle_summary() == ""
+
+
+def test_metrics_endpoint():
+    metrics = Metrics(enabled=True)
+    metrics.add_gauge("queued_notifications", 3)
+    server = metrics.serve(0)
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+            assert "bsky_aibot_queued_notifications 3" in response.read().decode()
+    finally:
+        server.shutdown()
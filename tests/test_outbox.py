@@ -0,0 +1,151 @@
+import pytest
+from atproto.exceptions import BadRequestError, NetworkError
+
+from bsky_aibot import app
+from bsky_aibot.outbox import Outbox, OutboxItem, new_tid
+from tests.test_app import RecursiveDictWrapper
+
+
+def item(key="at://did:plc:et47te5fb7uv64pbltu37lcc/app.bsky.feed.post/3jzkusvkvp72u"):
+    return OutboxItem(
+        key=key,
+        rkey=new_tid(),
+        text="チーズがおすすめです。",
+        root_uri=key,
+        root_cid="bafyreibcyrb2kzk225jyzz4m7qizc2vqsxaoqoqjvvvkacltv73o4tm26q",
+        parent_uri=key,
+        parent_cid="bafyreibcyrb2kzk225jyzz4m7qizc2vqsxaoqoqjvvvkacltv73o4tm26q",
+    )
+
+
+class FakeRepoClient:
+    def __init__(self, fail_times=0, exists=False):
+        self.fail_times = fail_times
+        self.exists = exists
+        self.created = []
+        self.me = RecursiveDictWrapper({"did": "did:plc:d7mnkzaznaop33oiowcbco7g"})
+        self.com = RecursiveDictWrapper({"atproto": {"repo": {}}})
+        self.com.atproto.repo.create_record = self.create_record
+        self.com.atproto.repo.get_record = self.get_record
+
+    def create_record(self, data):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise NetworkError()
+        self.created.append(data)
+        return RecursiveDictWrapper({"uri": f"at://{data.repo}/app.bsky.feed.post/{data.rkey}", "cid": "cid"})
+
+    def get_record(self, params):
+        if not self.exists:
+            raise BadRequestError()
+        return RecursiveDictWrapper({"uri": f"at://{params['repo']}/app.bsky.feed.post/{params['rkey']}", "cid": "cid"})
+
+
+def test_new_tid_is_sortable():
+    assert len(new_tid(1688300000.0, 0)) == 13
+    assert new_tid(1688300000.0, 0) < new_tid(1688300000.5, 0)
+
+
+def test_outbox_survives_reopen(tmp_path):
+    path = str(tmp_path / "outbox.sqlite3")
+    outbox = Outbox(path)
+    added = outbox.add(item())
+    outbox.close()
+
+    outbox = Outbox(path)
+    assert outbox.pending() == [added]
+    # 追加したばかりのものは、送っている途中かもしれないので除ける
+    assert outbox.pending(older_than=60) == []
+    outbox.mark_sent(added.key, "at://sent")
+    assert outbox.pending() == []
+
+
+def test_deliver_retries_with_same_rkey():
+    outbox = Outbox(":memory:")
+    pending = outbox.add(item())
+    client = FakeRepoClient(fail_times=1)
+    with pytest.raises(NetworkError):
+        app.deliver(client, pending, outbox)
+
+    pending = outbox.get(pending.key)
+    assert pending.attempts == 1
+    response = app.deliver(client, pending, outbox)
+    assert client.created[0].rkey == pending.rkey
+    assert outbox.get(pending.key).sent_uri == response.uri
+
+
+def test_deliver_does_not_post_twice():
+    outbox = Outbox(":memory:")
+    pending = outbox.add(item())
+    outbox.attempt(pending.key)
+    client = FakeRepoClient(exists=True)
+    app.flush_outbox(client, app.Services(outbox=outbox))
+    assert client.created == []
+    assert outbox.pending() == []
+
+
+def test_failing_reply_does_not_block_later_notifications(monkeypatch):
+    outbox = Outbox(":memory:", max_attempts=2, retry_delay=0)
+    poison = outbox.add(item("at://did:plc:user/app.bsky.feed.post/deleted-parent"))
+    client = FakeRepoClient()
+    attempted = []
+
+    def create_post(client, item):
+        attempted.append(item.key)
+        if item.key == poison.key:
+            raise BadRequestError()  # 親の投稿が削除されているなど、何度送っても失敗する
+        return RecursiveDictWrapper({"uri": f"at://{client.me.did}/app.bsky.feed.post/{item.rkey}", "cid": "cid"})
+
+    unread = []
+    monkeypatch.setattr(app, "create_post", create_post)
+    monkeypatch.setattr(app, "unread_notifications", lambda client, last_seen_at, **kwargs: iter(unread))
+    monkeypatch.setattr(app, "get_thread_posts", lambda client, notification, did, thread_cache=None: [])
+    monkeypatch.setattr(app, "generate_reply", lambda messages, services, handle=None: "チーズがおすすめです。")
+    monkeypatch.setattr(app, "update_seen", lambda client, seen_at: None)
+    services = app.Services(outbox=outbox)
+
+    for i in range(2):
+        unread[:] = [RecursiveDictWrapper({"uri": f"at://did:plc:user/app.bsky.feed.post/{i}", "cid": "cid", "reason": "mention", "indexedAt": "2023-07-02T20:00:00.000Z", "record": {}})]
+        app.read_notifications_and_reply(client, services=services)
+        assert outbox.get(unread[0].uri).sent_uri is not None
+    assert attempted.count(poison.key) == 2
+    assert outbox.pending() == []
+
+    # 諦めた返信は、元の通知をもう一度読んでも送らない
+    unread[:] = [RecursiveDictWrapper({"uri": poison.key, "cid": "cid", "reason": "mention", "indexedAt": "2023-07-02T20:00:00.000Z", "record": {}})]
+    app.read_notifications_and_reply(client, services=services)
+    assert attempted.count(poison.key) == 2
+
+
+def test_compact_purges_dead_items():
+    now = [0.0]
+    outbox = Outbox(":memory:", retention=60, clock=lambda: now[0], max_attempts=1)
+    dead = outbox.add(item("at://a/dead"))
+    outbox.attempt(dead.key)
+    assert outbox.fail(dead.key, permanent=True)
+    assert outbox.is_dead(dead.key)
+    now[0] = 61
+    assert outbox.compact() == 1
+    assert outbox.get(dead.key) is None
+
+
+def test_transient_failures_back_off_but_never_give_up():
+    now = [0.0]
+    outbox = Outbox(":memory:", clock=lambda: now[0], max_attempts=2, retry_delay=10, max_retry_delay=40)
+    pending = outbox.add(item())
+    client = FakeRepoClient(fail_times=100)  # PDSが落ちている
+    delays = []
+    for _ in range(5):
+        with pytest.raises(NetworkError):
+            app.deliver(client, outbox.pending()[0], outbox)
+        assert outbox.pending() == [] and outbox.is_waiting(pending.key)
+        retry_at = now[0]
+        while not outbox.pending():
+            now[0] += 1
+        delays.append(now[0] - retry_at)
+    assert delays == [10, 20, 40, 40, 40]
+    assert not outbox.is_dead(pending.key)
+
+    client.fail_times = 0
+    app.deliver(client, outbox.pending()[0], outbox)
+    assert outbox.get(pending.key).sent_uri is not None
@@ -0,0 +1,41 @@
+import sys
+
+from benchmarks.thread_parse import run, thread_json
+from bsky_aibot.app import flatten_posts, is_already_replied_to, posts_to_sorted_messages
+from bsky_aibot.posts import Thread, decode_thread
+
+
+def test_decode_thread_keeps_only_what_the_bot_uses():
+    data = thread_json(depth=3, replies=2, authors=1)["thread"]
+    data["replies"].append({"$type": "app.bsky.feed.defs#blockedPost", "uri": "at://blocked", "blocked": True})
+    data["parent"]["parent"]["post"]["record"]["reply"] = {"root": {"uri": "at://root", "cid": "c1"}, "parent": {"uri": "at://parent", "cid": "c2"}}
+
+    view = decode_thread(data)
+    posts = flatten_posts(view)
+    assert [p.uri for p in posts] == [data["post"]["uri"], data["parent"]["post"]["uri"], data["parent"]["parent"]["post"]["uri"]]
+    assert posts[2].record.reply.parent.uri == "at://parent"
+    assert posts[0].author is posts[1].author  # 同じ投稿者は1つにまとめる
+    assert not hasattr(posts[0], "__dict__")
+    assert len(view.replies) == 2
+    assert not is_already_replied_to(Thread(view), "did:plc:bot")
+    assert is_already_replied_to(Thread(view), "did:plc:user0")
+
+
+def test_not_found_parent_ends_the_chain():
+    data = thread_json(depth=2, replies=0)["thread"]
+    data["parent"] = {"$type": "app.bsky.feed.defs#notFoundPost", "uri": "at://deleted", "notFound": True}
+    assert [p.uri for p in flatten_posts(decode_thread(data))] == [data["post"]["uri"]]
+
+
+def test_deep_threads_do_not_recurse():
+    depth = sys.getrecursionlimit() * 2
+    posts = flatten_posts(decode_thread(thread_json(depth=depth, replies=0)["thread"]))
+    assert len(posts) == depth
+    messages = posts_to_sorted_messages(posts, "did:plc:user1")
+    assert sum(m["role"] == "assistant" for m in messages) == len(range(1, depth, 3))
+
+
+def test_thread_parse_benchmark_reports_savings():
+    result = run(depth=20, replies=2, iterations=2)
+    assert result["posts"] == 22
+    assert result["compact"]["retained_bytes"] < result["sdk"]["retained_bytes"]
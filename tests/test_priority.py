@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+
+from bsky_aibot.priority import ReplyPolicy, parse_weights
+
+NOW = 1688329800.0  # 2023-07-02T20:30:00Z
+
+
+def notification(uri, indexed_at, reason="mention", author=None):
+    return SimpleNamespace(uri=uri, indexedAt=indexed_at, reason=reason, author=author)
+
+
+def test_score_orders_by_reason_freshness_and_author():
+    policy = ReplyPolicy(author_weights={"vip.bsky.social": 4}, half_life=60)
+    mention = notification("at://did:plc:a/1", "2023-07-02T20:29:00.000Z")
+    reply = notification("at://did:plc:b/1", "2023-07-02T20:29:00.000Z", reason="reply")
+    older = notification("at://did:plc:c/1", "2023-07-02T20:27:00.000Z")
+    vip = notification("at://did:plc:d/1", "2023-07-02T20:27:00.000Z", reason="reply", author=SimpleNamespace(did="did:plc:d", handle="vip.bsky.social"))
+    scores = {n.uri: policy.score(n, NOW) for n in (mention, reply, older, vip)}
+    assert sorted(scores, key=scores.get, reverse=True) == ["at://did:plc:a/1", "at://did:plc:b/1", "at://did:plc:d/1", "at://did:plc:c/1"]
+    assert scores["at://did:plc:a/1"] - scores["at://did:plc:b/1"] == pytest.approx(1)
+
+
+def test_author_weight_matches_did_in_uri():
+    policy = ReplyPolicy(author_weights={"did:plc:muted": 0})
+    assert policy.score(notification("at://did:plc:muted/app.bsky.feed.post/1", "2023-07-02T20:29:00.000Z"), NOW) == float("-inf")
+
+
+def test_priority_puts_expired_threads_last():
+    policy = ReplyPolicy(deadline=600)
+    fresh = [notification("at://a/1", "2023-07-02T20:20:00.000Z", reason="reply")]
+    expired = [notification("at://b/1", "2023-07-02T20:10:00.000Z")]
+    assert policy.priority(fresh, NOW) > policy.priority(expired, NOW)
+
+
+def test_parse_weights():
+    assert parse_weights("alice.bsky.social=2, did:plc:xyz=0.5") == {"alice.bsky.social": 2, "did:plc:xyz": 0.5}
+    assert parse_weights(None) == {}
@@ -0,0 +1,95 @@
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from bsky_aibot.metrics import METRICS
+from bsky_aibot.profiling import Profiler
+
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        sum(range(1000))
+
+
+def fake_cycle():
+    # read_notifications_and_replyと同じく、返信はワーカースレッドで行う
+    def reply():
+        with METRICS.time("get_thread"):
+            busy(0.01)
+        with METRICS.time("generate_reply"):
+            busy(0.05)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        for future in [executor.submit(reply) for _ in range(2)]:
+            future.result()
+
+
+def captured_files(path):
+    [capture] = os.listdir(path)
+    return {name: os.path.join(path, capture, name) for name in os.listdir(os.path.join(path, capture))}
+
+
+def test_profiles_the_requested_number_of_cycles(tmp_path):
+    profiler = Profiler(str(tmp_path), cycles=2)
+    with profiler.cycle():
+        fake_cycle()
+    assert not tmp_path.exists() or os.listdir(tmp_path) == []
+
+    profiler.request()
+    for _ in range(3):
+        with profiler.cycle():
+            fake_cycle()
+    assert profiler.captures == 1
+    assert METRICS.tracer is None
+
+    files = captured_files(str(tmp_path))
+    assert set(files) == {"profile.prof", "profile.txt", "spans.json", "memory.txt", "memory.snapshot"}
+    with open(files["profile.txt"]) as f:
+        assert "busy" in f.read()  # ワーカースレッドの中もプロファイルされている
+    with open(files["spans.json"]) as f:
+        spans = json.load(f)["traceEvents"]
+    assert sorted({span["name"] for span in spans}) == ["generate_reply", "get_thread"]
+    assert len(spans) == 8
+
+
+def test_sampling_tags_stacks_with_stages(tmp_path):
+    profiler = Profiler(str(tmp_path), cycles=1, mode="sample", sample_interval=0.001, trace_memory=False)
+    profiler.request()
+    with profiler.cycle():
+        fake_cycle()
+
+    files = captured_files(str(tmp_path))
+    assert set(files) == {"profile.collapsed", "spans.json"}
+    with open(files["profile.collapsed"]) as f:
+        stacks = f.read()
+    assert "[generate_reply];" in stacks
+    assert "busy (test_profiling.py:" in stacks
+
+
+def test_trigger_file_starts_a_capture(tmp_path):
+    trigger = tmp_path / "profile"
+    profiler = Profiler(str(tmp_path / "profiles"), cycles=1, trace_memory=False, trigger_path=str(trigger))
+    trigger.touch()
+    with profiler.cycle():
+        fake_cycle()
+    assert profiler.captures == 1
+    assert not trigger.exists()
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGUSR1"), reason="SIGUSR1 is not available")
+def test_signal_requests_a_capture(tmp_path):
+    profiler = Profiler(str(tmp_path), cycles=1, trace_memory=False)
+    previous = signal.getsignal(signal.SIGUSR1)
+    try:
+        assert profiler.install_signal()
+        os.kill(os.getpid(), signal.SIGUSR1)
+        with profiler.cycle():
+            fake_cycle()
+    finally:
+        signal.signal(signal.SIGUSR1, previous)
+    assert profiler.captures == 1
@@ -0,0 +1,192 @@
+import threading
+from types import SimpleNamespace
+
+import httpx
+import pytest
+import requests
+
+from bsky_aibot.rate_limit import LLM_REQUESTS, LLM_TOKENS, READ, WRITE, RateLimiter, TokenBucket, parse_duration, parse_policy_window
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_waits_minimal_time():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=2, clock=clock)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.5)
+    # 予約済みの分の後ろに並ぶ
+    assert bucket.reserve() == pytest.approx(1.0)
+    clock.now += 1.0
+    assert bucket.tokens == pytest.approx(0)
+
+
+def test_token_bucket_is_shared_between_threads():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=1, capacity=1, clock=clock)
+    delays = []
+    threads = [threading.Thread(target=lambda: delays.append(bucket.reserve())) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(delays) == [0, 1, 2, 3, 4]
+
+
+def test_rate_limiter_sleeps_instead_of_failing():
+    clock = FakeClock()
+    limiter = RateLimiter(write_rate=0.5, write_burst=1, clock=clock, sleep=clock.sleep)
+    # 書き込みはポイントで数える。返信(createRecord)は3ポイント
+    limiter.acquire(WRITE, 3)
+    limiter.acquire(WRITE, 3)
+    assert clock.slept == [pytest.approx(2.0)]
+
+
+def test_rate_limiter_adapts_from_pds_headers():
+    clock = FakeClock()
+    limiter = RateLimiter(read_rate=100, read_burst=100, clock=clock, wall_clock=lambda: 1000.0, sleep=clock.sleep)
+    limiter.observe_pds_headers(READ, {"RateLimit-Limit": "3000", "RateLimit-Remaining": "5", "RateLimit-Policy": "3000;w=300"})
+    assert limiter.buckets[READ].rate == 10
+    assert limiter.buckets[READ].tokens == 5
+
+    limiter.observe_pds_headers(READ, {"RateLimit-Remaining": "0", "RateLimit-Reset": "1030"})
+    assert limiter.acquire(READ) == pytest.approx(30)
+
+
+def test_rate_limiter_adapts_from_openai_headers():
+    clock = FakeClock()
+    limiter = RateLimiter(clock=clock, sleep=clock.sleep)
+    limiter.observe_openai_headers(
+        {
+            "x-ratelimit-limit-requests": "60",
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "1s",
+            "x-ratelimit-limit-tokens": "6000",
+            "x-ratelimit-remaining-tokens": "100",
+            "x-ratelimit-reset-tokens": "9m59.5s",
+        }
+    )
+    assert limiter.acquire(LLM_TOKENS, 200) == pytest.approx(1.0)
+    # 待っている間に1秒経ったので、リクエスト数はリセットされている
+    assert limiter.acquire(LLM_REQUESTS) == 0
+
+
+def test_install_limits_xrpc_calls():
+    clock = FakeClock()
+    limiter = RateLimiter(read_rate=1, read_burst=1, write_rate=1, write_burst=1, clock=clock, wall_clock=lambda: 0.0, sleep=clock.sleep)
+
+    def handler(request):
+        return httpx.Response(200, headers={"RateLimit-Remaining": "0", "RateLimit-Reset": "10"}, json={})
+
+    class FakeRequest:
+        _client = httpx.Client(transport=httpx.MockTransport(handler))
+
+    class FakeClient:
+        request = FakeRequest()
+
+    limiter.install(FakeClient)
+    FakeClient.request._client.post("https://bsky.social/xrpc/com.atproto.repo.createRecord")
+    assert clock.slept == []
+    assert limiter.buckets[WRITE].tokens <= -9
+    FakeClient.request._client.get("https://bsky.social/xrpc/app.bsky.feed.getPostThread")
+    assert clock.slept == []
+
+
+@pytest.mark.parametrize("value, expected", [("1s", 1), ("6m0s", 360), ("20ms", 0.02), ("1h2m", 3720), ("", None), ("soon", None)])
+def test_parse_duration(value, expected):
+    assert parse_duration(value) == expected
+
+
+def test_parse_policy_window():
+    assert parse_policy_window("3000;w=300") == 300
+    assert parse_policy_window("3000") is None
+
+
+def test_accounts_share_reads_but_not_writes():
+    clock = FakeClock()
+    shared = RateLimiter(read_rate=1, read_burst=1, write_rate=1, write_burst=1, clock=clock, sleep=clock.sleep)
+    a, b = shared.for_account(), shared.for_account()
+    assert a.acquire(WRITE) == 0
+    assert b.acquire(WRITE) == 0
+    assert a.acquire(READ) == 0
+    assert b.acquire(READ) == pytest.approx(1.0)
+
+
+def test_session_endpoint_headers_do_not_change_reads():
+    clock = FakeClock()
+    limiter = RateLimiter(read_rate=10, read_burst=100, clock=clock, wall_clock=lambda: 0.0, sleep=clock.sleep)
+    assert limiter.header_bucket("POST", "/xrpc/com.atproto.server.createSession") is None
+    assert limiter.header_bucket("POST", "/xrpc/com.atproto.server.refreshSession") is None
+    assert limiter.header_bucket("GET", "/xrpc/app.bsky.feed.getPostThread") == READ
+
+    def handler(request):
+        return httpx.Response(200, headers={"RateLimit-Limit": "30", "RateLimit-Remaining": "29", "RateLimit-Policy": "30;w=300"}, json={})
+
+    class FakeRequest:
+        _client = httpx.Client(transport=httpx.MockTransport(handler))
+
+    class FakeClient:
+        request = FakeRequest()
+
+    limiter.install(FakeClient)
+    FakeClient.request._client.post("https://bsky.social/xrpc/com.atproto.server.createSession")
+    assert limiter.buckets[READ].rate == 10
+    assert limiter.buckets[READ].tokens == pytest.approx(99)
+
+
+def test_write_bucket_counts_points_per_operation():
+    clock = FakeClock()
+    limiter = RateLimiter(write_rate=0.13, write_burst=10, clock=clock, sleep=clock.sleep)
+    assert limiter.pds_cost("POST", "/xrpc/com.atproto.repo.createRecord") == 3
+    assert limiter.pds_cost("POST", "/xrpc/com.atproto.repo.deleteRecord") == 1
+    # uploadBlobは書き込みのポイントを使わない
+    assert limiter.pds_bucket("POST", "/xrpc/com.atproto.repo.uploadBlob") == READ
+    # 1時間に5000ポイントのヘッダーでは、1日の上限から決めた0.13回/秒より速くしない
+    limiter.observe_pds_headers(WRITE, {"RateLimit-Limit": "5000", "RateLimit-Remaining": "30", "RateLimit-Policy": "5000;w=3600"})
+    assert limiter.buckets[WRITE].rate == pytest.approx(0.39)
+    # 残り30ポイントは、返信なら10回分
+    for _ in range(10):
+        assert limiter.acquire(WRITE, 3) == 0
+    assert limiter.acquire(WRITE, 3) == pytest.approx(3 / 0.39)
+    # ヘッダーが設定より厳しければ合わせる
+    limiter.observe_pds_headers(WRITE, {"RateLimit-Limit": "360", "RateLimit-Policy": "360;w=3600"})
+    assert limiter.buckets[WRITE].rate == pytest.approx(0.1)
+
+
+def test_accounts_install_openai_hooks_once_on_the_shared_limiter():
+    shared = RateLimiter()
+    a, b = shared.for_account(), shared.for_account()
+    openai = SimpleNamespace(requestssession=requests.Session())
+    a.install_openai(openai)
+    b.install_openai(openai)
+    shared.install_openai(openai)
+    assert len(openai.requestssession.hooks["response"]) == 1
+    # アカウントのどれから入れても、ヘッダーは共有のLLMのバケツに反映される
+    response = requests.Response()
+    response.headers["x-ratelimit-limit-requests"] = "60"
+    openai.requestssession.hooks["response"][0](response)
+    assert a.buckets[LLM_REQUESTS] is shared.buckets[LLM_REQUESTS]
+    assert shared.buckets[LLM_REQUESTS].rate == 1
+
+
+def test_read_share_splits_reads_separately():
+    poller = RateLimiter(read_rate=10, read_burst=100, write_rate=0.13, share=1.0, read_share=0.1)
+    workers = [RateLimiter(read_rate=10, read_burst=100, write_rate=0.13, share=0.5, read_share=0.45) for _ in range(2)]
+    # 読み込みは親と2つのワーカーで合わせて10回/秒
+    assert poller.buckets[READ].rate + sum(w.buckets[READ].rate for w in workers) == pytest.approx(10)
+    assert sum(w.buckets[WRITE].rate for w in workers) == pytest.approx(0.13 * 3)
+    workers[0].observe_pds_headers(READ, {"RateLimit-Limit": "3000", "RateLimit-Policy": "3000;w=300"})
+    assert workers[0].buckets[READ].rate == pytest.approx(4.5)
+    assert workers[0].for_account().read_share == 0.45
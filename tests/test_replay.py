@@ -0,0 +1,28 @@
+import json
+
+from benchmarks.replay import load_traffic, percentile, run, synthetic_traffic
+
+
+def test_replay_answers_every_notification():
+    events = synthetic_traffic(threads=3, posts_per_thread=2, spread=0.2)
+    result = run(events, poll_interval=0.05, timeout=20)
+    assert result["replies"] == result["notifications"] == 6
+    assert result["llm_requests"] == 6
+    assert result["rpcs"]["com.atproto.repo.createRecord"] == 6
+    assert result["rpcs_per_reply"] >= 1
+    assert result["latency_seconds"]["p50"] <= result["latency_seconds"]["p99"]
+    json.dumps(result)
+
+
+def test_load_traffic(tmp_path):
+    path = tmp_path / "traffic.jsonl"
+    events = synthetic_traffic(threads=2, posts_per_thread=2)
+    path.write_text("\n".join(json.dumps(e) for e in events) + "\n")
+    assert load_traffic(str(path)) == events
+
+
+def test_percentile():
+    values = [float(i) for i in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([], 50) is None
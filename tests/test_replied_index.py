@@ -0,0 +1,24 @@
+from bsky_aibot.replied_index import RepliedIndex
+
+
+def test_replied_index_survives_reopen(tmp_path):
+    path = str(tmp_path / "state" / "replied.sqlite3")
+    index = RepliedIndex(path)
+    index.add("at://did:plc:et47te5fb7uv64pbltu37lcc/app.bsky.feed.post/3jzkusvkvp72u", "bafyreibcyrb2kzk225jyzz4m7qizc2vqsxaoqoqjvvvkacltv73o4tm26q")
+    index.close()
+
+    index = RepliedIndex(path)
+    assert "at://did:plc:et47te5fb7uv64pbltu37lcc/app.bsky.feed.post/3jzkusvkvp72u" in index
+    assert "at://did:plc:et47te5fb7uv64pbltu37lcc/app.bsky.feed.post/other" not in index
+
+
+def test_replied_index_compact():
+    now = [1000.0]
+    index = RepliedIndex(":memory:", retention=60, clock=lambda: now[0])
+    index.add("at://a/1")
+    now[0] += 30
+    index.add("at://a/2")
+    now[0] += 45
+    assert index.compact() == 1
+    assert "at://a/1" not in index
+    assert "at://a/2" in index
@@ -0,0 +1,71 @@
+import pytest
+
+from bsky_aibot import app
+from bsky_aibot.llm import Route, Router, StubBackend
+from bsky_aibot.reply_cache import ReplyCache, cache_key, normalize_text
+
+
+def message(content, name="alice_bsky_social", role="user"):
+    return {"role": role, "content": content, "name": name}
+
+
+def test_normalized_key_ignores_own_mention_case_and_author():
+    assert normalize_text("@AIBot.bsky.social  Hi!!", "aibot.bsky.social") == "hi!"
+    assert normalize_text("@aibot.bsky.social.evil hi", "aibot.bsky.social") == "@aibot.bsky.social.evil hi"
+    assert cache_key([message("@aibot.bsky.social hi")], handle="aibot.bsky.social") == cache_key([message("ＨＩ", name="bob_bsky_social")], handle="aibot.bsky.social")
+    assert cache_key([message("@aibot.bsky.social hi")], handle="aibot.bsky.social") != cache_key([message("@aibot.bsky.social hello")], handle="aibot.bsky.social")
+    assert cache_key([message("hi")], namespace="a") != cache_key([message("hi")], namespace="b")
+
+
+@pytest.mark.parametrize(
+    "a, b",
+    [
+        ("@aibot.bsky.social what do you think of @alice.bsky.social?", "@aibot.bsky.social what do you think of @bob.bsky.social?"),
+        ("is 3.5 > 35?", "is 35 > 35?"),
+        ("yes or no?", "yes or no!"),
+        ("hi @aibot.bsky.social", "hi"),
+    ],
+)
+def test_different_prompts_do_not_share_a_key(a, b):
+    assert cache_key([message(a)], handle="aibot.bsky.social") != cache_key([message(b)], handle="aibot.bsky.social")
+
+
+def test_reply_cache_ttl_lru_and_hit_rate():
+    now = [0.0]
+    cache = ReplyCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    cache.put("a", "reply a")
+    cache.put("b", "reply b")
+    assert cache.get("a") == "reply a"
+    cache.put("c", "reply c")
+    assert cache.get("b") is None
+    now[0] = 11
+    assert cache.get("a") is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 2, "evictions": 1, "hit_rate": 1 / 3}
+
+
+def test_reply_cache_persists(tmp_path):
+    path = str(tmp_path / "reply_cache.sqlite3")
+    now = [0.0]
+    cache = ReplyCache(path=path, ttl=10, clock=lambda: now[0])
+    cache.put("a", "reply a")
+    cache.put("b", "reply b")
+    cache.close()
+    now[0] = 5
+    reopened = ReplyCache(path=path, ttl=10, clock=lambda: now[0])
+    assert reopened.get("a") == "reply a"
+    now[0] = 11
+    assert ReplyCache(path=path, clock=lambda: now[0]).get("b") is None
+
+
+def test_generate_reply_uses_cache_for_shallow_threads():
+    backend = StubBackend()
+    calls = []
+    generate = backend.generate
+    backend.generate = lambda messages, timeout=None: calls.append(messages) or generate(messages, timeout)
+    services = app.Services(llm=Router({"stub": backend}, [Route("stub")]), reply_cache=ReplyCache(max_depth=1))
+    first = app.generate_reply([message("@aibot hi")], services, "aibot")
+    assert app.generate_reply([message("Hi", name="bob_bsky_social")], services, "aibot") == first
+    app.generate_reply([message("hi"), message("hello", role="assistant")], services)
+    app.generate_reply([message("hi"), message("hello", role="assistant")], services)
+    assert len(calls) == 3
+    assert services.reply_cache.stats()["hits"] == 1
@@ -0,0 +1,50 @@
+import pytest
+
+from bsky_aibot.scheduler import PollScheduler, retry_delay_from_headers
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_poll_scheduler_backs_off_and_speeds_up():
+    clock = FakeClock()
+    scheduler = PollScheduler(min_interval=2, max_interval=30, initial_interval=10, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        scheduler.record(0)
+    assert scheduler.interval == 30
+    scheduler.record(5)
+    scheduler.record(1)
+    assert scheduler.interval == 7.5
+    assert scheduler.hit_rate == pytest.approx(2 / 5)
+    scheduler.wait()
+    assert clock.now == 7.5
+
+
+def test_poll_scheduler_honors_retry_after():
+    clock = FakeClock()
+    scheduler = PollScheduler(min_interval=2, initial_interval=2, clock=clock, wall_clock=lambda: 1000.0, sleep=clock.sleep)
+    assert scheduler.observe_headers({"Retry-After": "45"}) == 45
+    scheduler.wait()
+    assert clock.now == 45
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({}, None),
+        ({"retry-after": "12"}, 12),
+        ({"retry-after": "Thu, 01 Jan 1970 00:17:00 GMT"}, 20),
+        ({"RateLimit-Remaining": "0", "RateLimit-Reset": "1090"}, 90),
+        ({"RateLimit-Remaining": "10", "RateLimit-Reset": "1090"}, None),
+    ],
+)
+def test_retry_delay_from_headers(headers, expected):
+    assert retry_delay_from_headers(headers, 1000.0) == expected
@@ -0,0 +1,81 @@
+import time
+
+import jwt
+from atproto import Client
+from atproto.exceptions import BadRequestError
+
+from bsky_aibot.session import SessionStore, attach_session, resume_session
+from tests.test_app import RecursiveDictWrapper
+
+DID = "did:plc:d7mnkzaznaop33oiowcbco7g"
+
+
+def token(expires_in, scope="com.atproto.access"):
+    now = int(time.time())
+    return jwt.encode({"exp": now + expires_in, "iat": now, "scope": scope, "sub": DID}, "secret", algorithm="HS256")
+
+
+def fake_client(refresh_error=None):
+    client = Client()
+    client.refreshed = 0
+
+    def refresh():
+        if refresh_error is not None:
+            raise refresh_error
+        client.refreshed += 1
+        client._set_session(RecursiveDictWrapper({"accessJwt": token(7200), "refreshJwt": token(86400, "com.atproto.refresh")}))
+
+    client._refresh_and_set_session = refresh
+    client.bsky.actor.get_profile = lambda params: RecursiveDictWrapper({"did": params["actor"], "handle": "aibot.bsky.social"})
+    return client
+
+
+def save(store, access_expires_in):
+    client = fake_client()
+    client._set_session(RecursiveDictWrapper({"accessJwt": token(access_expires_in), "refreshJwt": token(86400, "com.atproto.refresh")}))
+    client.me = RecursiveDictWrapper({"did": DID, "handle": "aibot.bsky.social"})
+    store.save(client)
+
+
+def test_resume_session_without_refresh(tmp_path):
+    store = SessionStore(str(tmp_path / "session.json"))
+    save(store, 7200)
+    client = fake_client()
+    assert resume_session(client, store)
+    assert client.refreshed == 0
+    assert client.me.did == DID
+
+
+def test_resume_session_refreshes_expiring_token(tmp_path):
+    store = SessionStore(str(tmp_path / "session.json"))
+    save(store, 60)
+    client = fake_client()
+    assert resume_session(client, store)
+    assert client.refreshed == 1
+    assert store.load()["accessJwt"] == client._access_jwt
+
+
+def test_resume_session_falls_back_to_login(tmp_path):
+    store = SessionStore(str(tmp_path / "session.json"))
+    assert not resume_session(fake_client(), store)
+
+    save(store, 60)
+    assert not resume_session(fake_client(refresh_error=BadRequestError()), store)
+    assert store.load() is None
+
+
+def test_attach_session_never_refreshes(tmp_path):
+    store = SessionStore(str(tmp_path / "session.json"))
+    client = fake_client()
+    assert not attach_session(client, store)
+
+    save(store, access_expires_in=60)
+    assert attach_session(client, store)
+    assert client.me.did == DID
+    assert not client._should_refresh_session()
+    assert client.refreshed == 0
+
+    # 他のプロセスがリフレッシュして保存したら、それに切り替える
+    save(store, access_expires_in=7200)
+    attach_session(client, store)
+    assert client._access_jwt == store.load()["accessJwt"]
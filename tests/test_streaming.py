@@ -0,0 +1,73 @@
+import pytest
+
+from bsky_aibot.streaming import count_graphemes, read_stream, truncate_graphemes
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("hello", 5),
+        ("スイスのチーズ", 7),
+        ("é", 1),
+        ("👍🏽", 1),
+        ("👨‍👩‍👧", 1),
+        ("🇯🇵🇨🇭", 2),
+        ("❤️!", 2),
+    ],
+)
+def test_count_graphemes(text, expected):
+    assert count_graphemes(text) == expected
+
+
+def test_truncate_graphemes_at_sentence_boundary():
+    text = "チーズがおすすめです。" * 40
+    result = truncate_graphemes(text, 300)
+    assert count_graphemes(result) <= 300
+    assert result.endswith("。")
+
+
+@pytest.mark.parametrize(
+    "tail",
+    [
+        "See https://bsky.app/profile/aibot.bsky.social for more and more details",
+        "The answer is 3.5 which is less than 35 and more than three",
+        "Ask @aibot.bsky.social about cheese and crackers anytime at all",
+    ],
+)
+def test_truncate_graphemes_does_not_cut_inside_urls_decimals_or_handles(tail):
+    head = "Swiss cheese is great. "
+    text = head + tail + " " + "x" * 300
+    # 前の文末は上限の前半にあるので、単語の区切りで切る
+    result = truncate_graphemes(text, len(head) + len(tail) - 5)
+    assert text.startswith(result) and text[len(result)] == " "
+    assert len(result) > len(head)
+
+
+def test_truncate_graphemes_ignores_early_sentence_ends():
+    assert truncate_graphemes("Hello! " + "a b " * 100, 300) == ("Hello! " + "a b " * 100)[:300]
+    assert truncate_graphemes("はい。" + "あ" * 400, 300) == ("はい。" + "あ" * 400)[:300]
+    text = "Swiss cheese is great. " * 10 + "Crackers too. " + "x" * 200
+    assert truncate_graphemes(text, 300) == text[: text.rindex("too.") + 4]
+
+
+def test_truncate_graphemes_without_sentence_boundary():
+    assert truncate_graphemes("a" * 400, 300) == "a" * 300
+
+
+def test_read_stream_stops_early():
+    now = [0.0]
+    consumed = []
+
+    def deltas():
+        for i in range(100):
+            now[0] += 0.1
+            consumed.append(i)
+            yield "Swiss cheese is great. "
+
+    text, timing = read_stream(deltas(), 100, started_at=0.0, clock=lambda: now[0])
+    assert count_graphemes(text) <= 100
+    assert text.endswith(".")
+    assert len(consumed) == 5
+    assert timing.truncated
+    assert timing.time_to_first_token == pytest.approx(0.1)
+    assert timing.total == pytest.approx(0.5)
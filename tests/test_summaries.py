@@ -0,0 +1,98 @@
+from bsky_aibot.summaries import SummaryStore
+
+
+def thread(n, branch="a"):
+    uris = [f"at://{branch if i >= 20 else 'a'}/{i}" for i in range(n)]
+    return uris, [{"role": "user", "content": f"post {i}", "name": "alice"} for i in range(n)]
+
+
+class FakeSummarizer:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, summary, messages):
+        self.calls.append((summary, [m["content"] for m in messages]))
+        return f"{summary or ''}+{len(messages)}"
+
+
+def test_short_threads_are_sent_as_is():
+    store = SummaryStore(threshold=20, keep_recent=8)
+    uris, messages = thread(20)
+    assert store.compact(uris[0], uris, messages, FakeSummarizer()) == messages
+
+
+def test_summary_is_folded_incrementally():
+    store = SummaryStore(threshold=20, keep_recent=8)
+    summarize = FakeSummarizer()
+
+    uris, messages = thread(30)
+    compacted = store.compact(uris[0], uris, messages, summarize)
+    assert compacted[0] == {"role": "system", "content": "Summary of the 16 earlier posts in this thread: +8+8"}
+    assert compacted[1:] == messages[16:]
+
+    # 要約を更新する区切りまでは、同じ要約を使い回す
+    uris, messages = thread(31)
+    assert store.compact(uris[0], uris, messages, summarize)[0]["content"].endswith("+8+8")
+    assert len(summarize.calls) == 2
+
+    # 増えた分だけを前の要約に畳み込む
+    uris, messages = thread(33)
+    compacted = store.compact(uris[0], uris, messages, summarize)
+    assert summarize.calls[-1] == ("+8+8", [f"post {i}" for i in range(16, 24)])
+    assert compacted[0]["content"] == "Summary of the 24 earlier posts in this thread: +8+8+8"
+    assert len(compacted) == 1 + 9
+    assert store.stats() == {"roots": 1, "hits": 1, "updates": 3, "folded_posts": 24}
+
+
+def test_long_threads_are_folded_in_chunks():
+    # 初めて見る300件のスレッドでも、1回に要約させるのはkeep_recent件まで
+    store = SummaryStore(threshold=20, keep_recent=8)
+    summarize = FakeSummarizer()
+    uris, messages = thread(300)
+    compacted = store.compact(uris[0], uris, messages, summarize)
+    assert max(len(call[1]) for call in summarize.calls) == 8
+    assert sum(len(call[1]) for call in summarize.calls) == 288
+    assert compacted[1:] == messages[288:]
+
+
+def test_branches_share_common_history():
+    store = SummaryStore(threshold=20, keep_recent=8)
+    summarize = FakeSummarizer()
+    uris, messages = thread(30, branch="b")
+    store.compact(uris[0], uris, messages, summarize)
+    calls = len(summarize.calls)
+    uris, messages = thread(30, branch="c")
+    store.compact(uris[0], uris, messages, summarize)
+    assert len(summarize.calls) == calls
+
+
+def test_thread_messages_summarizes_long_threads():
+    from bsky_aibot import app
+    from bsky_aibot.llm import Route, Router, StubBackend
+    from tests.test_app import RecursiveDictWrapper
+
+    posts = [
+        RecursiveDictWrapper({"uri": f"at://a/{i}", "indexedAt": f"2023-07-02T20:{i:02d}:00.000Z", "author": {"did": "did:plc:user", "handle": "alice.bsky.social"}, "record": {"text": f"post {i}"}})
+        for i in range(25)
+    ]
+    services = app.Services(llm=Router({"stub": StubBackend()}, [Route("stub")]), summaries=SummaryStore(threshold=20, keep_recent=8))
+    messages = app.thread_messages(list(reversed(posts)), "did:plc:bot", services)
+    assert messages[0]["role"] == "system" and "16 earlier posts" in messages[0]["content"]
+    assert [m["content"] for m in messages[1:]] == [f"post {i}" for i in range(16, 25)]
+
+
+def test_thread_messages_falls_back_when_summarizing_fails(monkeypatch):
+    from bsky_aibot import app
+    from tests.test_app import RecursiveDictWrapper
+
+    def fail(services, summary, messages):
+        raise RuntimeError("context_length_exceeded")
+
+    monkeypatch.setattr(app, "summarize_messages", fail)
+    posts = [
+        RecursiveDictWrapper({"uri": f"at://a/{i}", "indexedAt": f"2023-07-02T20:{i:02d}:00.000Z", "author": {"did": "did:plc:user", "handle": "alice.bsky.social"}, "record": {"text": f"post {i}"}})
+        for i in range(25)
+    ]
+    services = app.Services(summaries=SummaryStore(threshold=20, keep_recent=8))
+    messages = app.thread_messages(list(reversed(posts)), "did:plc:bot", services)
+    assert [m["content"] for m in messages] == [f"post {i}" for i in range(25)]
@@ -0,0 +1,105 @@
+import json
+import threading
+import time
+
+import pytest
+
+from bsky_aibot import app
+from bsky_aibot.llm import StubBackend
+from bsky_aibot.tenants import Account, FairShare, load_accounts
+
+
+def test_load_accounts(tmp_path):
+    path = tmp_path / "accounts.json"
+    path.write_text(
+        json.dumps(
+            {
+                "accounts": [
+                    {"handle": "cat.bsky.social", "password": "p1", "system_prompt": "Reply like a cat.", "model": "gpt-3.5-turbo"},
+                    {"handle": "dog.bsky.social", "password_env": "DOG_PASSWORD", "weight": 2},
+                ]
+            }
+        )
+    )
+    accounts = load_accounts(str(path), {"DOG_PASSWORD": "p2"})
+    assert accounts == [
+        Account("cat.bsky.social", "p1", "Reply like a cat.", "gpt-3.5-turbo"),
+        Account("dog.bsky.social", "p2", weight=2.0),
+    ]
+    with pytest.raises(ValueError):
+        load_accounts(str(path), {})
+
+
+def grant_order(share, waiters, holder="hold"):
+    # holderが枠をふさいでいる間に全員を待たせてから空け、枠を得た順番を返す
+    order = []
+    share.acquire(holder)
+
+    def run(name):
+        with share.slot(name):
+            order.append(name)
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in waiters]
+    for thread in threads:
+        thread.start()
+        while sum(share._waiting.values()) < threads.index(thread) + 1:
+            time.sleep(0.001)
+    share.release(holder)
+    for thread in threads:
+        thread.join()
+    return order
+
+
+def test_fair_share_does_not_let_a_busy_account_starve_others():
+    share = FairShare(1)
+    # busyは先に枠を使っているので、後から来たquietが先になる
+    assert grant_order(share, ["busy"] * 4 + ["quiet"], holder="busy") == ["quiet", "busy", "busy", "busy", "busy"]
+
+
+def test_fair_share_follows_weights():
+    share = FairShare(1, {"a": 2})
+    order = grant_order(share, ["a"] * 4 + ["b"] * 4)
+    assert order[:6].count("a") == 4
+
+
+def test_account_services_share_pools_but_not_replied_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STATE_DIR", str(tmp_path))
+    shared = app.create_services(shared=True)
+    # アカウントごとの記録は、共有の方では開かない
+    assert shared.replied_index is None and shared.outbox is None
+    assert not (tmp_path / "replied.sqlite3").exists() and not (tmp_path / "outbox.sqlite3").exists()
+    backends = dict(shared.llm.backends)
+    share = FairShare(2)
+    cat = app.account_services(shared, Account("cat.bsky.social", "p1", "Reply like a cat."), share, backends)
+    dog = app.account_services(shared, Account("dog.bsky.social", "p2", routes="stub,gpt-4"), share, backends)
+
+    assert cat.thread_cache is dog.thread_cache is shared.thread_cache
+    assert cat.transport is dog.transport
+    assert cat.llm.backends["gpt-4"] is dog.llm.backends["gpt-4"]
+    assert cat.rate_limiter.buckets["read"] is dog.rate_limiter.buckets["read"]
+    assert cat.rate_limiter.buckets["write"] is not dog.rate_limiter.buckets["write"]
+    cat.replied_index.add("at://post")
+    assert "at://post" not in dog.replied_index
+    assert dog.llm.select(1, 10) == "stub"
+
+
+def test_reply_cache_is_not_shared_across_models(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "STATE_DIR", str(tmp_path))
+    shared = app.create_services(shared=True)
+    calls = []
+
+    class CountingBackend(StubBackend):
+        def generate(self, messages, timeout=None):
+            calls.append(self.name)
+            return super().generate(messages, timeout)
+
+    backends = {"stub": CountingBackend("stub"), "echo": CountingBackend("echo")}
+    share = FairShare(2)
+    # システムプロンプトは同じ(既定)で、使うモデルだけが違う
+    cat = app.account_services(shared, Account("cat.bsky.social", "p1", routes="stub"), share, backends)
+    dog = app.account_services(shared, Account("dog.bsky.social", "p2", routes="echo"), share, backends)
+    owl = app.account_services(shared, Account("owl.bsky.social", "p3", routes="stub"), share, backends)
+    for services in (cat, dog, owl):
+        app.generate_reply([{"role": "user", "content": "hi", "name": "alice_bsky_social"}], services)
+    assert calls == ["stub", "echo"]
+    assert shared.reply_cache.stats()["hits"] == 1
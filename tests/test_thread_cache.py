@@ -0,0 +1,60 @@
+from bsky_aibot.thread_cache import ThreadCache
+from tests.test_app import RecursiveDictWrapper
+
+
+def post(uri, text="hello"):
+    return RecursiveDictWrapper({"uri": uri, "record": {"text": text}})
+
+
+def test_thread_cache_ttl_and_counters():
+    now = [0.0]
+    cache = ThreadCache(ttl=10, clock=lambda: now[0])
+    cache.put_chain([post("at://a/2"), post("at://a/1"), post("at://a/0")])
+    assert [p.uri for p in cache.get("at://a/1")] == ["at://a/1", "at://a/0"]
+    assert cache.get("at://a/3") is None
+    now[0] = 11
+    assert cache.get("at://a/2") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 2
+
+
+def test_thread_cache_lru_eviction():
+    cache = ThreadCache(max_entries=2)
+    cache.put("at://a/0", [post("at://a/0")])
+    cache.put("at://a/1", [post("at://a/1")])
+    cache.get("at://a/0")
+    cache.put("at://a/2", [post("at://a/2")])
+    assert cache.get("at://a/1") is None
+    assert cache.get("at://a/0") is not None
+    assert cache.evictions == 1
+
+
+def test_thread_cache_memory_cap():
+    cache = ThreadCache(max_bytes=3000)
+    cache.put("at://a/0", [post("at://a/0", "x" * 1000)])
+    cache.put("at://a/1", [post("at://a/1", "x" * 1000)])
+    assert len(cache) == 1
+    assert cache.bytes <= 3000
+
+
+def test_thread_cache_bytes_grow_linearly_with_depth():
+    posts = [post(f"at://a/{i}", "x" * 100) for i in reversed(range(200))]
+    cache = ThreadCache(max_bytes=1024 * 1024)
+    cache.put_chain(posts[100:])
+    half = cache.bytes
+    cache.put_chain(posts)
+    assert len(cache) == 200
+    assert cache.bytes == 2 * half == 200 * (1024 + 100)
+    assert cache.evictions == 0
+
+
+def test_thread_cache_evicts_leaves_before_ancestors():
+    cache = ThreadCache(max_entries=3)
+    cache.put_chain([post("at://a/1"), post("at://a/0")])
+    cache.put("at://b/0", [post("at://b/0")])
+    # 根に近い投稿ほど後に使ったことになるので、先に追い出されるのはat://a/1で、at://a/0のチェーンは残る
+    cache.put("at://c/0", [post("at://c/0")])
+    assert cache.get("at://a/1") is None
+    assert [p.uri for p in cache.get("at://a/0")] == ["at://a/0"]
+    # 投稿はそれぞれ1回だけ数える
+    assert cache.bytes == len(cache) * (1024 + 5)
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.notification_window import notification_pages, run
+from bsky_aibot.app import filter_unread_notifications, filter_unread_pages, posts_to_sorted_messages, unread_window
+from bsky_aibot.posts import decode_post
+from bsky_aibot.timestamps import parse_rfc3339, timestamp
+
+
+def test_parse_rfc3339():
+    assert parse_rfc3339("2023-07-02T20:30:00Z") == datetime(2023, 7, 2, 20, 30, tzinfo=timezone.utc)
+    assert parse_rfc3339("2023-07-02T20:30:00.1234567+09:00") == datetime(2023, 7, 2, 20, 30, 0, 123456, tzinfo=timezone(timedelta(hours=9)))
+    assert parse_rfc3339("2023-07-02t20:30:00.5-00:30").utcoffset() == -timedelta(minutes=30)
+    assert parse_rfc3339("2016-12-31T23:59:60Z").second == 59
+    for value in ("2023-07-02T20:30:00", "2023-07-02", "2023-07-02T20:30:00.Z", "2023-07-02T20:30:00Zjunk"):
+        with pytest.raises(ValueError):
+            parse_rfc3339(value)
+
+
+def test_timestamp_falls_back_to_utc_for_naive_values():
+    assert timestamp("2023-07-02T20:30:00.000Z") == timestamp("2023-07-03T05:30:00+09:00") == timestamp("2023-07-02T20:30:00")
+
+
+def test_posts_sort_by_time_not_by_string():
+    # 文字列として比べると、"20:30:00Z" は "20:30:00.500Z" より後になってしまう
+    post = lambda uri, did, indexed_at: decode_post({"uri": uri, "cid": uri, "author": {"did": did, "handle": did}, "record": {"text": uri}, "indexedAt": indexed_at})
+    posts = [post("at://a/2", "did:plc:bot", "2023-07-02T20:30:00Z"), post("at://a/1", "did:plc:user", "2023-07-02T20:30:00.500+00:00"), post("at://a/0", "did:plc:user", "2023-07-03T05:29:59.900+09:00")]
+    assert posts[0].timestamp == timestamp("2023-07-02T20:30:00Z")
+    assert [m["content"] for m in posts_to_sorted_messages(posts, "did:plc:bot")] == ["at://a/0", "at://a/2", "at://a/1"]
+
+
+@pytest.mark.parametrize("unread", [0, 1, 99, 100, 101, 250, 300])
+def test_filter_unread_pages_matches_the_linear_scan(unread):
+    pages = notification_pages(3, 100)
+    seen_at = datetime(2023, 7, 2, 20, 2, tzinfo=timezone.utc) - timedelta(seconds=unread, microseconds=-1)
+    expected = list(filter_unread_notifications((n for page in pages for n in page), seen_at))
+    assert len(expected) == unread
+    consumed = []
+    result = list(filter_unread_pages((consumed.append(page) or page for page in pages), seen_at))
+    assert result == expected
+    # 既読の通知を含むページより先は取得しない
+    assert len(consumed) == min(unread // 100 + 1, 3)
+
+
+def test_unread_window_parses_only_log_n_notifications():
+    parsed = []
+
+    class Notification(SimpleNamespace):
+        @property
+        def indexedAt(self):
+            parsed.append(self.i)
+            return f"2023-07-02T20:{59 - self.i // 60:02d}:{59 - self.i % 60:02d}Z"
+
+    page = [Notification(i=i) for i in range(1024)]
+    cutoff = timestamp("2023-07-02T20:50:00Z")
+    assert unread_window(page, cutoff) == 599
+    assert len(parsed) <= 11
+
+
+def test_notification_window_benchmark_agrees():
+    result = run(pages=2, page_size=50, unread=60, iterations=1)
+    assert result["bisect_cold"]["unread"] == result["dateutil_scan"]["unread"] == 60
@@ -0,0 +1,130 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from bsky_aibot.rate_limit import RateLimiter
+from bsky_aibot.transport import RetryTransport, Transport
+
+
+class FlakyServer:
+    # 最初のfailures回は503を返すHTTP/1.1(keep-alive)のサーバー
+    def __init__(self, failures=0):
+        state = self
+        self.failures = failures
+        self.requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def respond(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                state.requests.append((self.command, self.path))
+                status = 503 if state.failures > 0 else 200
+                state.failures -= 1
+                body = b"{}"
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = respond
+            do_POST = respond
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def flaky():
+    servers = []
+
+    def start(failures=0):
+        servers.append(FlakyServer(failures))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_retry_transport_retries_idempotent_reads_with_jitter(flaky):
+    server = flaky(failures=2)
+    slept = []
+    transport = RetryTransport(retries=2, backoff=1.0, sleep=slept.append, jitter=lambda: 0.5)
+    with httpx.Client(transport=transport) as client:
+        assert client.get(f"{server.url}/xrpc/app.bsky.feed.getPostThread").status_code == 200
+    assert slept == [0.5, 1.0]
+    assert transport.stats.retries == 2
+    # 3回とも同じ接続を使う
+    assert transport.stats.as_dict() == {"requests": 3, "connections": 1, "reuse_rate": pytest.approx(0.667), "retries": 2}
+
+
+def test_retry_transport_does_not_retry_writes(flaky):
+    server = flaky(failures=1)
+    slept = []
+    transport = RetryTransport(retries=2, sleep=slept.append)
+    with httpx.Client(transport=transport) as client:
+        assert client.post(f"{server.url}/xrpc/com.atproto.repo.createRecord", json={}).status_code == 503
+    assert slept == []
+    assert len(server.requests) == 1
+
+
+def test_retry_transport_gives_up_after_retries(flaky):
+    server = flaky(failures=5)
+    transport = RetryTransport(retries=1, sleep=lambda seconds: None)
+    with httpx.Client(transport=transport) as client:
+        assert client.get(f"{server.url}/xrpc/app.bsky.notification.listNotifications").status_code == 503
+    assert len(server.requests) == 2
+
+
+def test_transport_install_keeps_event_hooks(flaky):
+    server = flaky()
+    seen = []
+
+    class FakeRequest:
+        _client = httpx.Client(event_hooks={"request": [lambda request: seen.append(request.url.path)]})
+
+    class FakeClient:
+        request = FakeRequest()
+
+    transport = Transport(connect_timeout=1, read_timeout=2, pool_size=2)
+    transport.install(FakeClient)
+    transport.install(FakeClient)
+    http = FakeClient.request._client
+    assert http.timeout == httpx.Timeout(2, connect=1)
+    for _ in range(3):
+        http.get(f"{server.url}/xrpc/app.bsky.actor.getProfile")
+    assert seen == ["/xrpc/app.bsky.actor.getProfile"] * 3
+    assert transport.stats()["pds"]["connections"] == 1
+
+
+def test_openai_sessions_share_a_pool_but_close_independently(flaky):
+    server = flaky()
+    openai = SimpleNamespace(requestssession=None)
+    transport = Transport(pool_size=2)
+    transport.install_openai(openai)
+    limiter = RateLimiter()
+    limiter.install_openai(openai)
+
+    # openaiはスレッドごとにセッションを作り、古くなったら閉じて作り直す
+    first, second = openai.requestssession(), openai.requestssession()
+    assert first is not second
+    assert first.get(f"{server.url}/v1/chat/completions").status_code == 200
+    first.close()
+    assert second.get(f"{server.url}/v1/chat/completions").status_code == 200
+    assert openai.requestssession().get(f"{server.url}/v1/chat/completions").status_code == 200
+    assert transport.stats()["openai"] == {"requests": 3, "connections": 1, "reuse_rate": pytest.approx(0.667)}
+    assert all(s.hooks["response"] for s in (first, second))
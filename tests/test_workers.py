@@ -0,0 +1,145 @@
+import functools
+import os
+from datetime import datetime, timezone
+
+from atproto.xrpc_client import models
+from atproto.xrpc_client.models.utils import get_or_create
+
+from bsky_aibot import app
+from bsky_aibot.workers import WorkerPool, WorkQueue, decode_notification, encode_notification, work
+from tests.test_app import FakeNotificationClient, notification
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_notification_survives_encoding():
+    n = get_or_create(
+        {
+            "uri": "at://did:plc:a/app.bsky.feed.post/2",
+            "cid": "bafy",
+            "author": {"did": "did:plc:a", "handle": "a.test"},
+            "reason": "reply",
+            "record": {
+                "$type": "app.bsky.feed.post",
+                "text": "こんにちは",
+                "createdAt": "2023-07-02T20:00:00Z",
+                "reply": {"root": {"uri": "at://root", "cid": "c"}, "parent": {"uri": "at://parent", "cid": "c"}},
+            },
+            "isRead": False,
+            "indexedAt": "2023-07-02T20:00:00Z",
+        },
+        models.AppBskyNotificationListNotifications.Notification,
+    )
+    decoded = decode_notification(encode_notification(n))
+    assert decoded.record.text == "こんにちは"
+    assert app.thread_root_uri(decoded) == "at://root"
+    assert decoded.author.handle == "a.test"
+
+
+def test_claim_takes_whole_thread_and_excludes_it_from_others():
+    queue = WorkQueue(":memory:", clock=Clock())
+    assert queue.put("at://a/1", "at://root/a", "a1")
+    assert not queue.put("at://a/1", "at://root/a", "a1")
+    queue.put("at://b/1", "at://root/b", "b1")
+    queue.put("at://a/2", "at://root/a", "a2")
+
+    assert queue.claim("w1") == [("at://a/1", "a1"), ("at://a/2", "a2")]
+    # 処理中のスレッドに後から届いた通知は、終わるまで他のワーカーに渡さない
+    queue.put("at://a/3", "at://root/a", "a3")
+    assert queue.claim("w2") == [("at://b/1", "b1")]
+    assert queue.claim("w2") == []
+
+    queue.done(["at://a/1", "at://a/2"])
+    assert queue.claim("w2") == [("at://a/3", "a3")]
+    assert queue.pending() == 2
+
+
+def test_failed_items_are_retried_then_given_up():
+    clock = Clock()
+    queue = WorkQueue(":memory:", lease=60, max_attempts=2, retry_delay=10, clock=clock)
+    queue.put("at://a/1", "at://root/a", "a1")
+
+    queue.claim("w1")
+    assert queue.release_worker("w1") == 1
+    assert queue.claim("w2") == []
+    clock.now += 10
+    assert queue.claim("w2") == [("at://a/1", "a1")]
+    # リースが切れたら取り直せる
+    clock.now += 61
+    assert queue.claim("w3") == [("at://a/1", "a1")]
+    queue.fail(["at://a/1"])
+    assert queue.claim("w3") == []
+    assert queue.stats() == {"pending": 0, "claimed": 0, "done": 0, "dead": 1}
+
+
+def test_work_keeps_going_after_failures():
+    queue = WorkQueue(":memory:", retry_delay=60)
+    queue.put("at://a/1", "at://root/a", "a1")
+    queue.put("at://b/1", "at://root/b", "b1")
+    handled = []
+
+    def handle(payloads):
+        if payloads == ["a1"]:
+            raise RuntimeError("boom")
+        handled.extend(payloads)
+
+    processed = work(queue, "w1", handle, should_stop=lambda: len(handled) > 0, sleep=lambda _: None)
+    assert processed == 1
+    assert handled == ["b1"]
+    assert queue.stats()["pending"] == 1
+
+
+def crash_once(path, index, stop):
+    queue = WorkQueue(path, retry_delay=0)
+    marker = f"{path}.crashed"
+
+    def handle(payloads):
+        if "crash" in payloads and not os.path.exists(marker):
+            open(marker, "w").close()
+            os._exit(1)
+
+    work(queue, str(os.getpid()), handle, stop.is_set, idle_wait=0.05)
+
+
+def test_worker_pool_restarts_crashed_workers(tmp_path):
+    path = str(tmp_path / "work_queue.sqlite3")
+    queue = WorkQueue(path, retry_delay=0)
+    for i, payload in enumerate(["ok", "crash", "ok"]):
+        queue.put(f"at://a/{i}", f"at://root/{i}", payload)
+
+    pool = WorkerPool(functools.partial(crash_once, path), 2, queue, check_interval=0.05)
+    pool.start()
+    try:
+        assert pool.drain(30)
+    finally:
+        pool.stop(10)
+    assert pool.restarts == 1
+    assert queue.stats()["done"] == 3
+    assert all(not process.is_alive() for process in pool.processes)
+
+
+def test_enqueue_notifications_marks_seen_once_queued(monkeypatch):
+    monkeypatch.setattr(app, "encode_notification", lambda n: n.uri)
+    # 通知が古すぎるとして読み飛ばされないよう、現在時刻を通知の少し後にする
+    monkeypatch.setattr(app, "unread_notifications", functools.partial(app.unread_notifications, now=datetime(2023, 7, 2, 21, 0, tzinfo=timezone.utc)))
+    client = FakeNotificationClient(
+        [[notification("at://a/2", "2023-07-02T20:30:00.000Z", root="at://root/a"), notification("at://a/1", "2023-07-02T20:20:00.000Z", reason="like")]]
+    )
+    seen = []
+    client.bsky.notification.update_seen = lambda data: seen.append(data)
+    queue = WorkQueue(":memory:")
+
+    last_seen_at = datetime(2023, 7, 2, 20, 0, tzinfo=timezone.utc)
+    app.enqueue_notifications(client, last_seen_at, queue)
+    assert queue.claim("w1") == [("at://a/2", "at://a/2")]
+    assert len(seen) == 1
+
+    # 同じ通知がまた見えても積み直さず、update_seenも呼ばない
+    app.enqueue_notifications(client, last_seen_at, queue)
+    assert len(seen) == 1